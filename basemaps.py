@@ -0,0 +1,124 @@
+"""
+Shared map background for the ship track plots (plot_hake_daily.py, plot_hake_10days.py).
+
+The expensive part of a track figure is the background -- 50m coastlines and the contoured ETOPO2 bathymetry.
+add_basemap() renders that layer once per (extent snapped to a grid, projection, levels, size of the map axes in
+output pixels, bathymetry source), keeps it as an RGBA image in memory and in ~/.cache/hake_survey/basemaps (or
+$HAKE_BASEMAP_CACHE), and pastes it onto the axes pixel for pixel. Figures whose extents snap to the same cell
+reuse it, so only the tracks are drawn fresh. Re-ingesting the bathymetry (see bathy_cache.py) changes the source
+and so renders new layers.
+"""
+
+
+import os
+import uuid
+import hashlib
+import numpy as np
+import cartopy.crs as ccrs
+from cartopy.mpl.gridliner import LATITUDE_FORMATTER, LONGITUDE_FORMATTER
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from topomaps import add_etopo2
+import bathy_cache
+
+### City locations [lat, lon]
+LANDMARKS = [
+   ('San Diego', [32.7157, -117.1611]),
+   ('San Miguel Island', [34.0376, -120.3724]),
+   ('San Francisco', [37.7749, -122.4194]),
+   ('Cape Mendocino', [40.4401, -124.4095]),
+   ('Cape Blanco', [42.8376, -124.5640]),
+   ('Yaquina Head', [44.6737, -124.0774]),
+   ('Columbia River', [46.1879, -123.8313]),
+   ('Neah Bay', [48.3681, -124.6250]),
+]
+
+_layers = {}
+
+
+def default_cachedir():
+   return os.environ.get('HAKE_BASEMAP_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'hake_survey', 'basemaps'))
+
+
+def snap_extent(extent, step=0.25):
+   ### grow the extent outwards to multiples of step, so nearby chunks land on the same cached background
+   return [float(np.floor(extent[0] / step) * step), float(np.ceil(extent[1] / step) * step),
+           float(np.floor(extent[2] / step) * step), float(np.ceil(extent[3] / step) * step)]
+
+
+def render_layer(extent, size, dpi=120, levels=None, projection=ccrs.PlateCarree()):
+   ### draw coastlines + bathymetry alone on an off-screen figure of size = (width, height) pixels and return the
+   ### pixels inside the axes
+   fig = Figure(figsize=(size[0] / dpi, size[1] / dpi), dpi=dpi)
+   canvas = FigureCanvasAgg(fig)
+   ax = fig.add_axes([0, 0, 1, 1], projection=projection)
+   ax.set_extent(extent, crs=ccrs.PlateCarree())
+   ax.coastlines(resolution='50m')
+   add_etopo2(extent, ax, levels)
+   if 'geo' in ax.spines:
+      ax.spines['geo'].set_visible(False)
+   else:
+      ax.outline_patch.set_visible(False)
+   canvas.draw()
+   bbox = ax.get_window_extent()
+   img = np.asarray(canvas.buffer_rgba())
+   h = img.shape[0]
+   return img[int(round(h - bbox.y1)):int(round(h - bbox.y0)), int(round(bbox.x0)):int(round(bbox.x1))].copy()
+
+
+def get_layer(extent, size, dpi=120, levels=None, projection=ccrs.PlateCarree(), cachedir=None):
+   key = repr((list(extent), type(projection).__name__, None if levels is None else list(levels), list(size), dpi, bathy_cache.source_id()))
+   if key in _layers:
+      return _layers[key]
+
+   cachedir = cachedir or default_cachedir()
+   cachefile = os.path.join(cachedir, hashlib.sha1(key.encode()).hexdigest() + '.npy')
+   if os.path.exists(cachefile):
+      layer = np.load(cachefile)
+   else:
+      layer = render_layer(extent, size, dpi, levels, projection)
+      os.makedirs(cachedir, exist_ok=True)
+      ### render workers may be writing the same layer at once; each writes its own temporary file
+      tmpfile = '%s.%d.%s.tmp.npy' % (cachefile, os.getpid(), uuid.uuid4().hex)
+      np.save(tmpfile, layer)
+      os.replace(tmpfile, cachefile)
+
+   _layers[key] = layer
+   return layer
+
+
+def axes_pixels(ax, extent, dpi=120):
+   ### (width, height) the map axes will have in the PNG saved at dpi, once its aspect is fixed by the extent
+   ax.set_extent(extent, crs=ccrs.PlateCarree())
+   ax.apply_aspect()
+   bbox = ax.get_window_extent()
+   scale = dpi / ax.figure.dpi
+   return int(round(bbox.width * scale)), int(round(bbox.height * scale))
+
+
+def add_basemap(ax, extent, dpi=120, levels=None):
+   ### extent should already be snapped (see snap_extent) for the cache to be any use; dpi is the dpi the figure
+   ### will be saved at, so the layer is rendered at the axes' size in the PNG rather than resampled. Call it once
+   ### the figure is laid out (legend, title, tight_layout), and save without bbox_inches='tight', or the axes will
+   ### have changed size by the time the PNG is written.
+   layer = get_layer(extent, axes_pixels(ax, extent, dpi), dpi, levels, ax.projection)
+   ax.imshow(layer, extent=extent, transform=ccrs.PlateCarree(), origin='upper', zorder=0, interpolation='nearest')
+   ax.set_extent(extent, crs=ccrs.PlateCarree())
+
+
+def add_gridlines(ax):
+   gl = ax.gridlines(crs=ccrs.PlateCarree(), linewidth=1, color='black', alpha=0.2, linestyle='-', draw_labels=True)
+   gl.xlabels_top = False
+   gl.ylabels_right= False
+   gl.xlabel_style = {'rotation': 45}
+   gl.xformatter = LONGITUDE_FORMATTER
+   gl.yformatter = LATITUDE_FORMATTER
+   return gl
+
+
+def add_landmarks(ax, extent, dx=0.03):
+   ### add locations of interest/landmarks if they are nearby
+   for name, (lat, lon) in LANDMARKS:
+      if (extent[2] <= lat <= extent[3]) and (extent[0] <= lon <= extent[1]):
+         ax.plot(lon, lat, marker='o', color='k')
+         ax.text(x=lon + dx, y=lat, s=name, fontsize=18)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+"""
+Local, memory-mapped bathymetry store used by topomaps.add_etopo2, so ship track plots never need the network.
+
+A one-time ingest reads a regular lon/lat grid (the ETOPO2 OPeNDAP URL, or any local NetCDF or GeoTIFF stand-in)
+and writes it to [cachedir]/tiles.npy as square tiles (shape: lat tiles x lon tiles x TILE x TILE) plus
+[cachedir]/meta.json describing the grid. Subsetting an extent memory-maps the file and touches only the tiles
+that overlap it.
+
+The cache directory defaults to ~/.cache/hake_survey/etopo2 and can be moved with $HAKE_BATHY_CACHE.
+
+example (whole grid):  python bathy_cache.py http://gamone.whoi.edu/thredds/dodsC/usgs/data0/bathy/ETOPO2v2c_f4.nc
+example (West Coast):  python bathy_cache.py ETOPO2v2c_f4.nc --extent -140 -115 25 60
+
+"""
+
+
+import os
+import json
+import argparse
+import numpy as np
+
+ETOPO2_URL = "http://gamone.whoi.edu/thredds/dodsC/usgs/data0/bathy/ETOPO2v2c_f4.nc"
+TILE = 256
+
+
+def default_cachedir():
+   return os.environ.get('HAKE_BATHY_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'hake_survey', 'etopo2'))
+
+
+def is_populated(cachedir=None):
+   cachedir = cachedir or default_cachedir()
+   return os.path.exists(os.path.join(cachedir, 'meta.json')) and os.path.exists(os.path.join(cachedir, 'tiles.npy'))
+
+
+def source_id(cachedir=None):
+   ### What add_etopo2() would contour from: the cached grid (its source and when it was ingested), or the THREDDS URL
+   cachedir = cachedir or default_cachedir()
+   if not is_populated(cachedir):
+      return ETOPO2_URL
+   with open(os.path.join(cachedir, 'meta.json')) as f:
+      meta = json.load(f)
+   return '%s %dx%d %d' % (meta['source'], meta['nlat'], meta['nlon'], os.path.getmtime(os.path.join(cachedir, 'tiles.npy')))
+
+
+def read_source(source, extent=None):
+   ### Returns (lons, lats, z) with lons/lats ascending 1-D arrays and z[lat, lon]
+   if source.lower().endswith(('.tif', '.tiff')):
+      import rasterio
+      with rasterio.open(source) as src:
+         z = src.read(1).astype('float32')
+         t = src.transform
+         lons = t.c + t.a * (np.arange(src.width) + 0.5)
+         lats = t.f + t.e * (np.arange(src.height) + 0.5)
+   else:
+      import xarray as xr
+      ds = xr.open_dataset(source)
+      var = [v for v in ds.data_vars if ds[v].ndim == 2][0]
+      da = ds[var]
+      latname, lonname = da.dims
+      if extent is not None:
+         da = da.sel({lonname: slice(extent[0], extent[1])})
+         lat = ds[latname].values
+         da = da.sel({latname: slice(extent[2], extent[3]) if lat[0] < lat[-1] else slice(extent[3], extent[2])})
+      lons = da[lonname].values
+      lats = da[latname].values
+      z = da.values.astype('float32')
+      extent = None
+
+   if lats[0] > lats[-1]:
+      lats = lats[::-1]
+      z = z[::-1, :]
+   if extent is not None:
+      i = (lats >= extent[2]) & (lats <= extent[3])
+      j = (lons >= extent[0]) & (lons <= extent[1])
+      lats, lons, z = lats[i], lons[j], z[i][:, j]
+   return lons, lats, z
+
+
+def ingest(source=ETOPO2_URL, cachedir=None, extent=None):
+   cachedir = cachedir or default_cachedir()
+   os.makedirs(cachedir, exist_ok=True)
+   lons, lats, z = read_source(source, extent)
+   nlat, nlon = z.shape
+   nty, ntx = -(-nlat // TILE), -(-nlon // TILE)
+
+   ### write to temporary names and swap in, so a half-built cache is never picked up
+   tilesfile = os.path.join(cachedir, 'tiles.npy')
+   tiles = np.lib.format.open_memmap(tilesfile + '.tmp.npy', mode='w+', dtype='float32', shape=(nty, ntx, TILE, TILE))
+   tiles[:] = np.nan
+   for ty in range(nty):
+      for tx in range(ntx):
+         block = z[ty * TILE:(ty + 1) * TILE, tx * TILE:(tx + 1) * TILE]
+         tiles[ty, tx, :block.shape[0], :block.shape[1]] = block
+   tiles.flush()
+   del tiles
+   os.replace(tilesfile + '.tmp.npy', tilesfile)
+
+   meta = {'source': source, 'lon0': float(lons[0]), 'dlon': float((lons[-1] - lons[0]) / max(nlon - 1, 1)), 'nlon': nlon,
+           'lat0': float(lats[0]), 'dlat': float((lats[-1] - lats[0]) / max(nlat - 1, 1)), 'nlat': nlat, 'tile': TILE}
+   with open(os.path.join(cachedir, 'meta.json.tmp'), 'w') as f:
+      json.dump(meta, f, indent=1)
+   os.replace(os.path.join(cachedir, 'meta.json.tmp'), os.path.join(cachedir, 'meta.json'))
+   print("Cached " + str(nlat) + " x " + str(nlon) + " grid from " + source + " in " + cachedir)
+
+
+def subset(extent, cachedir=None):
+   ### Returns (lons, lats, z) for the grid cells inside extent = [lon_min, lon_max, lat_min, lat_max]
+   cachedir = cachedir or default_cachedir()
+   with open(os.path.join(cachedir, 'meta.json')) as f:
+      meta = json.load(f)
+   tiles = np.load(os.path.join(cachedir, 'tiles.npy'), mmap_mode='r')
+   T = meta['tile']
+
+   j0 = max(int(np.ceil((extent[0] - meta['lon0']) / meta['dlon'])), 0)
+   j1 = min(int(np.floor((extent[1] - meta['lon0']) / meta['dlon'])) + 1, meta['nlon'])
+   i0 = max(int(np.ceil((extent[2] - meta['lat0']) / meta['dlat'])), 0)
+   i1 = min(int(np.floor((extent[3] - meta['lat0']) / meta['dlat'])) + 1, meta['nlat'])
+   if j1 <= j0 or i1 <= i0:
+      raise ValueError('Extent ' + str(extent) + ' is outside the cached bathymetry in ' + cachedir)
+
+   ### copy just the overlapping tiles into the output
+   z = np.empty((i1 - i0, j1 - j0), dtype='float32')
+   for ty in range(i0 // T, (i1 - 1) // T + 1):
+      for tx in range(j0 // T, (j1 - 1) // T + 1):
+         r0, r1 = max(i0, ty * T), min(i1, (ty + 1) * T)
+         c0, c1 = max(j0, tx * T), min(j1, (tx + 1) * T)
+         z[r0 - i0:r1 - i0, c0 - j0:c1 - j0] = tiles[ty, tx, r0 - ty * T:r1 - ty * T, c0 - tx * T:c1 - tx * T]
+
+   lons = meta['lon0'] + meta['dlon'] * np.arange(j0, j1)
+   lats = meta['lat0'] + meta['dlat'] * np.arange(i0, i1)
+   return lons, lats, z
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Ingest a bathymetry grid into the local cache used by topomaps.add_etopo2')
+   parser.add_argument('source', nargs='?', default=ETOPO2_URL, help='NetCDF/OPeNDAP URL or GeoTIFF (default: ETOPO2 on THREDDS)')
+   parser.add_argument('--cachedir', default=None, help='cache location (default: $HAKE_BATHY_CACHE or ~/.cache/hake_survey/etopo2)')
+   parser.add_argument('--extent', type=float, nargs=4, metavar=('LON_MIN', 'LON_MAX', 'LAT_MIN', 'LAT_MAX'), help='only cache this region')
+   args = parser.parse_args()
+   ingest(args.source, args.cachedir, args.extent)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+"""
+Command line tool for benchmarking the processing pipeline end to end on synthetic cruises (see synthetic_ek60.py).
+
+For each --sizes preset a synthetic cruise is written to a scratch directory, then each stage is run on it as its
+own process, as run_cruise.py would run it:
+   summarize  -- survey_hake.py (summary extraction and the ping timing report)
+   calibrate  -- calibrate_hake.py --ping-chunk 2000
+   echograms  -- plot_hake_daily.py all --only echogram
+   catalog    -- catalog.py (navigation store and catalog)
+   tracks     -- plot_hake_daily.py all --only tracks
+   tracks10   -- plot_hake_10days.py
+recording wall time, CPU time, peak RSS (of the largest of the stage's processes) and throughput in files/s and
+MB/s of converted data. Each stage's output goes to [scratch]/[size]/[stage].log (kept if --workdir is given). A
+stage that fails is recorded as failed and the rest still run.
+
+Results are written as JSON to --output. Given a --baseline from an earlier run, any stage whose wall time grew by
+more than --tolerance (a ratio) is reported as a regression and the exit status is 1.
+
+example: python benchmark.py --sizes small medium --output bench.json
+example: python benchmark.py --sizes small medium --baseline bench.json --output bench_new.json --workers 4
+
+"""
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SIZES = {
+   'small':  {'days': 1, 'files_per_day': 4, 'pings': 1000, 'nrange': 500},
+   'medium': {'days': 3, 'files_per_day': 10, 'pings': 2000, 'nrange': 1000},
+   'large':  {'days': 12, 'files_per_day': 24, 'pings': 3000, 'nrange': 1500},
+}
+
+
+def stages(basedir, cruisename, workers=1):
+   cruisedir = os.path.join(basedir, cruisename)
+   w = ['--workers', str(workers)]
+   return [('summarize', ['survey_hake.py', basedir, cruisename] + w),
+           ('calibrate', ['calibrate_hake.py', basedir, cruisename, '--ping-chunk', '2000'] + w),
+           ('echograms', ['plot_hake_daily.py', cruisedir, 'all', '--only', 'echogram'] + w),
+           ('catalog', ['catalog.py', cruisedir]),
+           ('tracks', ['plot_hake_daily.py', cruisedir, 'all', '--only', 'tracks'] + w),
+           ('tracks10', ['plot_hake_10days.py', cruisedir] + w)]
+
+
+def run_stage(cmd, logpath):
+   ### Run one script; returns its wall time, CPU time (its own and its children's) and peak RSS
+   t0 = time.perf_counter()
+   with open(logpath, 'w') as log:
+      p = subprocess.Popen([sys.executable, os.path.join(HERE, cmd[0])] + cmd[1:], stdout=log, stderr=subprocess.STDOUT)
+      ### wait4 rather than wait, for the resource usage of this one stage
+      pid, status, usage = os.wait4(p.pid, 0)
+      p.returncode = os.waitstatus_to_exitcode(status)
+   ### ru_maxrss is in kB on Linux, bytes on macOS
+   rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+   return {'ok': p.returncode == 0, 'wall_s': time.perf_counter() - t0, 'cpu_s': usage.ru_utime + usage.ru_stime,
+           'peak_rss_mb': rss / 2 ** 20}
+
+
+def bench_size(workdir, size, workers=1):
+   from synthetic_ek60 import make_cruise
+   basedir = os.path.join(workdir, size)
+   cruisename = 'synth'
+   t0 = time.perf_counter()
+   files = make_cruise(basedir, cruisename, **SIZES[size])
+   mb = sum(os.path.getsize(f) for f in files) / 2 ** 20
+   print("%s: %d files, %.1f MB generated in %.1f s" % (size, len(files), mb, time.perf_counter() - t0))
+
+   result = dict(SIZES[size], files=len(files), mb=mb, workers=workers, stages={})
+   for name, cmd in stages(basedir, cruisename, workers):
+      r = run_stage(cmd, os.path.join(basedir, name + '.log'))
+      r['files_per_s'] = len(files) / r['wall_s']
+      r['mb_per_s'] = mb / r['wall_s']
+      result['stages'][name] = r
+      print("   %-10s %-6s %8.1f s wall %8.1f s cpu %8.0f MB peak %7.2f files/s %7.1f MB/s" % (name, 'ok' if r['ok'] else 'FAILED',
+            r['wall_s'], r['cpu_s'], r['peak_rss_mb'], r['files_per_s'], r['mb_per_s']))
+   return result
+
+
+def regressions(results, baseline, tolerance):
+   ### [(size, stage, old wall, new wall)] for every stage that slowed down by more than the tolerance ratio
+   slow = []
+   for size, result in results.items():
+      for name, r in result['stages'].items():
+         old = baseline.get(size, {}).get('stages', {}).get(name)
+         if old and old['ok'] and r['ok'] and r['wall_s'] > tolerance * old['wall_s']:
+            slow.append((size, name, old['wall_s'], r['wall_s']))
+   return slow
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Benchmark the pipeline on synthetic cruises')
+   parser.add_argument('--sizes', nargs='+', choices=sorted(SIZES), default=['small'])
+   parser.add_argument('--workers', type=int, default=1, help='passed on to the stages with process pools (default: 1)')
+   parser.add_argument('--output', default='benchmark_results.json', help='where to write the results (default: benchmark_results.json)')
+   parser.add_argument('--baseline', help='results of an earlier run to compare against')
+   parser.add_argument('--tolerance', type=float, default=1.25, help='wall time ratio over the baseline that counts as a regression (default: 1.25)')
+   parser.add_argument('--workdir', help='scratch directory for the synthetic cruises (default: a temporary one, removed afterwards)')
+   args = parser.parse_args()
+
+   workdir = args.workdir or tempfile.mkdtemp(prefix='hake_bench_')
+   try:
+      results = {size: bench_size(workdir, size, args.workers) for size in args.sizes}
+   finally:
+      if not args.workdir:
+         shutil.rmtree(workdir, ignore_errors=True)
+
+   with open(args.output + '.tmp', 'w') as f:
+      json.dump(results, f, indent=1, sort_keys=True)
+   os.replace(args.output + '.tmp', args.output)
+   print("Saved " + args.output)
+
+   if args.baseline:
+      with open(args.baseline) as f:
+         slow = regressions(results, json.load(f), args.tolerance)
+      for size, name, old, new in slow:
+         print("REGRESSION %s %s: %.1f s -> %.1f s" % (size, name, old, new))
+      if slow:
+         sys.exit(1)
+      print("No regressions against " + args.baseline)
+
+
+
+if __name__ == '__main__':
+    main()
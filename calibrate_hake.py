@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+"""
+Command line tool for calibrating converted .nc files to Sv (*_Sv.nc), cruise-wide or for chosen days.
+
+Files whose _Sv.nc is newer than the .nc are skipped, and files are spread over --workers processes. The EK60 Sv
+equation of echopype's ModelEK60.calibrate() is applied --ping-chunk pings at a time (2000 by default) and appended
+to the output, so memory stays flat however long the file is. --ping-chunk 0 hands each whole file to
+ModelEK60.calibrate() instead, which holds the whole backscatter array in memory. With --layout chunked the _Sv.nc
+is chunked along ping_time and compressed (see nc_layout.py).
+
+Errors are logged to ek60_convert_error/[file]-calibrate-error.txt.
+
+With --shared, several hosts can calibrate the same cruise at once: each file is leased by the host calibrating it
+(see lease.py) and checked again under the lease, so it is calibrated once.
+
+example: python calibrate_hake.py /media/paulr/ncei_data/shimada/ sh1707 --workers 8
+example: python calibrate_hake.py /media/paulr/ncei_data/shimada/ sh1707 --day D20170720 --day D20170721
+
+"""
+
+
+import os
+import socket
+import argparse
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import xarray as xr
+import runlog
+import lease
+from hake_utils import log_error
+import nc_layout
+
+PING_CHUNK = 2000
+
+
+def sv_path(nc_file):
+   return os.path.splitext(nc_file)[0] + '_Sv.nc'
+
+
+def is_calibrated(nc_file):
+   Sv_file = sv_path(nc_file)
+   return os.path.exists(Sv_file) and os.path.getmtime(Sv_file) >= os.path.getmtime(nc_file)
+
+
+def calibrate_chunked(nc_file, ping_chunk, layout='default', held=None):
+   ### EK60 Sv equation as in echopype's ModelEK60.calibrate(), applied ping_chunk pings at a time:
+   ###    Sv = backscatter_r + 20 log10(r) + 2 alpha r - CSv - 2 sa_correction
+   ### ModelEK60 still supplies the range, sound speed and absorption, none of which depend on ping.
+   ### The _Sv.nc is written to a temporary file of this process's own and moved into place only if `held` (the
+   ### file's lease, in shared mode) is still held; otherwise LeaseLost is raised. Whatever goes wrong, the
+   ### temporary file is removed.
+   import netCDF4
+   from echopype.model.ek60 import ModelEK60
+   model = ModelEK60(nc_file)
+   range_meter = model.range.where(model.range > 0, other=0)
+   tvg = np.real(20 * np.log10(range_meter.where(range_meter != 0, other=1)))
+   absorption = 2 * model.seawater_absorption * range_meter
+
+   Sv_file = sv_path(nc_file)
+   tmpfile = '%s.tmp-%s-%d' % (Sv_file, socket.gethostname(), os.getpid())
+   try:
+      with xr.open_dataset(nc_file, group='Beam') as beam:
+         wavelength = model.sound_speed / beam.frequency
+         CSv = 10 * np.log10((beam.transmit_power * (10 ** (beam.gain_correction / 10)) ** 2 * wavelength ** 2 * model.sound_speed *
+                              beam.transmit_duration_nominal * 10 ** (beam.equivalent_beam_angle / 10)) / (32 * np.pi ** 2))
+         offset = (tvg + absorption - CSv - 2 * beam.sa_correction).transpose('frequency', 'range_bin')
+         ping_time = beam.ping_time.values
+
+         out = netCDF4.Dataset(tmpfile, 'w')
+         try:
+            out.createDimension('frequency', beam.sizes['frequency'])
+            out.createDimension('ping_time', None)
+            out.createDimension('range_bin', beam.sizes['range_bin'])
+            out.createVariable('frequency', 'f8', ('frequency',))[:] = beam.frequency.values
+            out.createVariable('range_bin', 'i4', ('range_bin',))[:] = np.arange(beam.sizes['range_bin'])
+            times = out.createVariable('ping_time', 'i8', ('ping_time',))
+            times.units = 'nanoseconds since 1970-01-01'
+            times.calendar = 'gregorian'
+            out.createVariable('range', 'f8', ('frequency', 'range_bin'))[:] = model.range.transpose('frequency', 'range_bin').values
+            ### in the chunked layout the file's chunks are nc_layout's, whatever size of chunk is being calibrated
+            file_chunk = nc_layout.PING_CHUNK if layout == 'chunked' else ping_chunk
+            Sv = out.createVariable('Sv', 'f8', ('frequency', 'ping_time', 'range_bin'), zlib=True, complevel=nc_layout.COMPLEVEL, shuffle=True,
+                                    chunksizes=(1, min(file_chunk, max(len(ping_time), 1)), beam.sizes['range_bin']))
+            if layout == 'chunked':
+               setattr(out, nc_layout.LAYOUT_ATTR, nc_layout.layout_name())
+            Sv.units = 'dB'
+            for i in range(0, len(ping_time), ping_chunk):
+               back = beam.backscatter_r.isel(ping_time=slice(i, i + ping_chunk)).transpose('frequency', 'ping_time', 'range_bin')
+               n = back.sizes['ping_time']
+               times[i:i + n] = ping_time[i:i + n].astype('datetime64[ns]').view('int64')
+               Sv[:, i:i + n, :] = back.values + offset.values[:, None, :]
+         finally:
+            out.close()
+      if held is not None:
+         held.check()
+      os.replace(tmpfile, Sv_file)
+   except BaseException:
+      ### a failed or abandoned write (a read error, a full disk, a lost lease) takes its temporary file with it
+      if os.path.exists(tmpfile):
+         os.remove(tmpfile)
+      raise
+
+
+def calibrate_file(job):
+   ### Worker entry point: job is (nc_file, errsdir, ping_chunk, layout). Returns True if the file was calibrated.
+   nc_file, errsdir, ping_chunk, layout = job
+   with lease.claim(os.path.dirname(errsdir), 'calibrate-' + os.path.basename(nc_file)) as mine:
+      if not mine:
+         print(nc_file + " is being calibrated by another host")
+         return False
+      if is_calibrated(nc_file):
+         print("Calibration already completed for " + nc_file)
+         return False
+      with runlog.measure('calibrate', nc_file) as m:
+         try:
+            print("Calibrating " + nc_file)
+            if ping_chunk:
+               calibrate_chunked(nc_file, ping_chunk, layout, held=mine)
+            else:
+               from echopype.model.ek60 import ModelEK60
+               nc = ModelEK60(nc_file)
+               nc.calibrate(save=True)
+               mine.check()
+               if layout == 'chunked':
+                  nc_layout.rewrite(sv_path(nc_file))
+            return True
+
+         except lease.LeaseLost as e:
+            print(str(e) + "; not committing " + nc_file)
+            m['ok'], m['error'] = False, str(e)
+            return False
+         except Exception as e:
+            print('An error occurred: ' + str(e))
+            m['ok'], m['error'] = False, str(e)
+            filebase = os.path.basename(nc_file).split('.')[0]
+            log_error(os.path.join(errsdir, filebase + '-calibrate-error.txt'), nc_file + "  Calibration Error")
+            return False
+
+
+def calibrate_files(nc_files, errsdir, workers=1, ping_chunk=PING_CHUNK, layout='default'):
+   ### Returns the number of files calibrated; ping_chunk=0 calibrates whole files with ModelEK60
+   jobs = [(nc_file, errsdir, ping_chunk, layout) for nc_file in nc_files if not is_calibrated(nc_file)]
+   if workers <= 1:
+      return sum(calibrate_file(job) for job in jobs)
+   with ProcessPoolExecutor(max_workers=workers) as pool:
+      return sum(pool.map(calibrate_file, jobs))
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Calibrate converted .nc files to Sv')
+   parser.add_argument('basedir')
+   parser.add_argument('cruisename')
+   parser.add_argument('--day', action='append', default=[], help='only calibrate this day, DYYYYMMDD (repeatable; default: whole cruise)')
+   parser.add_argument('--workers', type=int, default=1, help='number of calibration processes (default: 1)')
+   parser.add_argument('--ping-chunk', type=int, default=PING_CHUNK, help='calibrate this many pings at a time, or 0 for whole files via ModelEK60 (default: %d)' % PING_CHUNK)
+   parser.add_argument('--layout', choices=['default', 'chunked'], default='default', help='chunked: chunk along ping_time and compress the _Sv.nc (see nc_layout.py)')
+   parser.add_argument('--shared', action='store_true', help='cooperate with other hosts calibrating the same cruise (see lease.py)')
+   args = parser.parse_args()
+   if args.shared:
+      lease.enable()
+
+   ncsdir = os.path.join(args.basedir, args.cruisename, 'ek60_nc')
+   errsdir = os.path.join(args.basedir, args.cruisename, 'ek60_convert_error')
+   runlog.start(os.path.join(args.basedir, args.cruisename))
+   patterns = ['*' + day + '*[0-9].nc' for day in args.day] or ['*[0-9].nc']
+   nc_files = sorted(set(f for pattern in patterns for f in glob(os.path.join(ncsdir, pattern))))
+   n = calibrate_files(nc_files, errsdir, args.workers, args.ping_chunk, args.layout)
+   print("Calibrated " + str(n) + " of " + str(len(nc_files)) + " files")
+   runlog.finish()
+
+
+
+if __name__ == '__main__':
+    main()
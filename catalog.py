@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+"""
+Spatio-temporal catalog of the converted files in a cruise, for picking files by time, region or frequency
+without opening them.
+
+Per .nc file the catalog records its ping time range, lat/lon bounding box, frequencies, sample interval, transmit
+duration and transmit power. It is assembled from the navigation store (navstore.py) and the summary index
+(summary_index.py, written by survey_hake.py) -- ping times come from the summary when available, otherwise from
+the GPS fixes -- and cached as [cruise]/nav/catalog.npz, rebuilt whenever either source changes.
+
+Array-valued fields (one value per channel) are stored as 2-D arrays padded with NaN.
+
+example: python catalog.py /media/paulr/ncei_data/shimada/sh1701/ --day D20170720
+example: python catalog.py /media/paulr/ncei_data/shimada/sh1701/ --bbox -125 -124 44 45 --freq 38000
+
+"""
+
+
+import os
+import argparse
+import numpy as np
+import navstore
+import runlog
+import lease
+from hake_utils import file_day
+from summary_index import index_path, load_index
+
+CHANNEL_FIELDS = [('frequency', 4), ('sample_interval', 5), ('transmit_duration', 6), ('transmit_power', 7)]
+
+
+def catalog_path(cruisedir):
+   return os.path.join(navstore.navdir(cruisedir), 'catalog.npz')
+
+
+def summary_path(cruisedir):
+   cruisename = os.path.basename(os.path.normpath(cruisedir))
+   return index_path(os.path.dirname(os.path.normpath(cruisedir)), cruisename)
+
+
+def padded(rows, width):
+   out = np.full((len(rows), width), np.nan)
+   for k, row in enumerate(rows):
+      values = np.atleast_1d(np.asarray(row, dtype='float64')) if row not in (None, 'NA') else []
+      out[k, :len(values)] = values
+   return out
+
+
+def build(cruisedir):
+   files, arrays = navstore.open_store(cruisedir)
+   summary = load_index(summary_path(cruisedir))
+   names = sorted(files['files'])
+   n = len(names)
+   cat = {'name': np.array(names, dtype='U'), 't0': np.zeros(n, dtype='int64'), 't1': np.zeros(n, dtype='int64'),
+          'lon_min': np.full(n, np.nan), 'lon_max': np.full(n, np.nan), 'lat_min': np.full(n, np.nan), 'lat_max': np.full(n, np.nan)}
+   rows = []
+   for k, name in enumerate(names):
+      entry = files['files'][name]
+      lo, hi = entry['start'], entry['stop']
+      if hi > lo:
+         cat['lon_min'][k], cat['lon_max'][k] = np.nanmin(arrays['lon'][lo:hi]), np.nanmax(arrays['lon'][lo:hi])
+         cat['lat_min'][k], cat['lat_max'][k] = np.nanmin(arrays['lat'][lo:hi]), np.nanmax(arrays['lat'][lo:hi])
+         cat['t0'][k], cat['t1'][k] = arrays['time'][lo:hi].min(), arrays['time'][lo:hi].max()
+
+      row = summary.get(name.split('.')[0], {}).get('row')
+      if row is not None and row[1] != 'NA':
+         cat['t0'][k] = np.datetime64(row[1], 'ns').view('int64')
+         cat['t1'][k] = np.datetime64(row[2], 'ns').view('int64')
+      rows.append(row)
+
+   width = max([len(np.atleast_1d(r[4])) for r in rows if r is not None and r[4] != 'NA'] + [1])
+   for field, col in CHANNEL_FIELDS:
+      cat[field] = padded([None if r is None else r[col] for r in rows], width)
+   return cat
+
+
+def load(cruisedir, refresh=True):
+   ### Load the cached catalog, rebuilding it first if the navigation store or summary index is newer
+   path = catalog_path(cruisedir)
+   if refresh:
+      sources = [os.path.join(navstore.navdir(cruisedir), 'files.json'), summary_path(cruisedir)]
+      newest = max([os.path.getmtime(p) for p in sources if os.path.exists(p)] + [0])
+      if not os.path.exists(path) or os.path.getmtime(path) < newest:
+         with lease.hold(cruisedir, 'catalog') as held:
+            ### another host may have rebuilt it while we waited
+            if not os.path.exists(path) or os.path.getmtime(path) < newest:
+               cat = build(cruisedir)
+               np.savez(path + '.tmp.npz', **cat)
+               held.check()
+               os.replace(path + '.tmp.npz', path)
+               return cat
+   with np.load(path) as f:
+      return {k: f[k] for k in f.files}
+
+
+def to_ns(t):
+   return np.datetime64(t, 'ns').view('int64')
+
+
+def query(cat, start=None, end=None, bbox=None, frequencies=None):
+   ### Boolean mask of the files whose ping times overlap [start, end), whose track intersects
+   ### bbox = [lon_min, lon_max, lat_min, lat_max], and which recorded all of the given frequencies
+   mask = np.ones(len(cat['name']), dtype=bool)
+   if start is not None:
+      mask &= cat['t1'] >= to_ns(start)
+   if end is not None:
+      mask &= cat['t0'] < to_ns(end)
+   if bbox is not None:
+      mask &= (cat['lon_max'] >= bbox[0]) & (cat['lon_min'] <= bbox[1]) & (cat['lat_max'] >= bbox[2]) & (cat['lat_min'] <= bbox[3])
+   for freq in frequencies or []:
+      mask &= np.any(cat['frequency'] == freq, axis=1)
+   return mask
+
+
+def files(cat, cruisedir, mask):
+   return [os.path.join(cruisedir, 'ek60_nc', name) for name in cat['name'][mask]]
+
+
+def day_of(cat):
+   ### 'DYYYYMMDD' of each file, taken from its name like everywhere else (echogram globs, cruise_days, run_cruise.py),
+   ### so a file that runs past midnight belongs to the day it started on in every product
+   return np.array([file_day(name) or '' for name in cat['name']], dtype='U9')
+
+
+def day_mask(cat, day):
+   return day_of(cat) == day
+
+
+def extent(cat, mask, dx=0.25, dy=0.25):
+   ### [lon_min, lon_max, lat_min, lat_max] covering the selected files, padded by dx/dy degrees. Files without nav
+   ### fixes (NaN bounds) are left out; None if none of the selected files has any.
+   for field in ['lon_min', 'lon_max', 'lat_min', 'lat_max']:
+      mask = mask & np.isfinite(cat[field])
+   if not mask.any():
+      return None
+   return [cat['lon_min'][mask].min() - dx, cat['lon_max'][mask].max() + dx,
+           cat['lat_min'][mask].min() - dy, cat['lat_max'][mask].max() + dy]
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Query the file catalog of a cruise')
+   parser.add_argument('cruisedir')
+   parser.add_argument('--day', help='DYYYYMMDD')
+   parser.add_argument('--start', help='ISO time, e.g. 2017-07-20T06:00')
+   parser.add_argument('--end', help='ISO time')
+   parser.add_argument('--bbox', type=float, nargs=4, metavar=('LON_MIN', 'LON_MAX', 'LAT_MIN', 'LAT_MAX'))
+   parser.add_argument('--freq', type=float, action='append', help='frequency in Hz (repeatable)')
+   args = parser.parse_args()
+
+   runlog.start(args.cruisedir)
+   with runlog.measure('catalog'):
+      navstore.update(args.cruisedir)
+      cat = load(args.cruisedir)
+   mask = query(cat, args.start, args.end, args.bbox, args.freq)
+   if args.day:
+      mask &= day_mask(cat, args.day)
+   for path in files(cat, args.cruisedir, mask):
+      print(path)
+   runlog.finish()
+
+
+
+if __name__ == '__main__':
+    main()
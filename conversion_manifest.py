@@ -0,0 +1,70 @@
+"""
+Persistent record of which .raw files have been converted, and what they produced.
+
+The manifest lives at [cruise]/[cruise]_convert_manifest.json and has one entry per .raw file, keyed by
+the .raw file name:
+   {"sh1707-D20170720-T123456.raw": {"raw_path": ..., "size": ..., "mtime": ..., "sha1": ... (or null),
+                                     "outputs": [...], "echopype_version": ..., "status": "converted" | "error"}}
+
+A file is re-converted when its size or mtime (or sha1, if hashing was requested) no longer match the entry.
+"""
+
+
+import os
+import json
+import hashlib
+
+
+def manifest_path(basedir, cruisename):
+   return os.path.join(basedir, cruisename, cruisename + '_convert_manifest.json')
+
+
+def load_manifest(path):
+   if not os.path.exists(path):
+      return {}
+   with open(path) as f:
+      return json.load(f)
+
+
+def save_manifest(manifest, path):
+   ### write to a temporary file and swap it in, so a crash mid-write never leaves a truncated manifest
+   tmppath = path + '.tmp'
+   with open(tmppath, 'w') as f:
+      json.dump(manifest, f, indent=1, sort_keys=True)
+   os.replace(tmppath, path)
+
+
+def sha1sum(path, blocksize=1 << 20):
+   h = hashlib.sha1()
+   with open(path, 'rb') as f:
+      for block in iter(lambda: f.read(blocksize), b''):
+         h.update(block)
+   return h.hexdigest()
+
+
+def scan_raw(rawdir, pattern_suffix='raw'):
+   ### one pass over ek60_raw; returns {name: (path, size, mtime)}
+   found = {}
+   with os.scandir(rawdir) as entries:
+      for entry in entries:
+         if entry.is_file() and entry.name.endswith(pattern_suffix):
+            st = entry.stat()
+            found[entry.name] = (entry.path, st.st_size, st.st_mtime)
+   return found
+
+
+def is_current(entry, size, mtime, sha1=None):
+   ### True if the manifest entry still describes this .raw file
+   if entry is None:
+      return False
+   if entry['size'] != size or entry['mtime'] != mtime:
+      return False
+   if sha1 is not None and entry.get('sha1') is not None and entry['sha1'] != sha1:
+      return False
+   return True
+
+
+def make_entry(raw_path, size, mtime, sha1, outputs, echopype_version, status):
+   return {'raw_path': raw_path, 'size': size, 'mtime': mtime, 'sha1': sha1,
+           'outputs': [os.path.basename(o) for o in outputs],
+           'echopype_version': echopype_version, 'status': status}
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+"""
+Shape-preserving decimation of ship tracks before they are handed to matplotlib.
+
+A 10-day panel holds millions of GPS fixes but only a few thousand pixels, so most vertices are invisible.
+decimate_track() first drops consecutive fixes that land in the same pixel, then runs Douglas-Peucker on what is
+left with a tolerance of half a pixel (see pixel_tolerance), so the drawn line is indistinguishable from the full
+one. NaN fixes are kept as breaks in the line.
+
+Running this file measures the saving on a synthetic track:
+example: python decimate.py 2000000
+
+"""
+
+
+import sys
+import time
+import numpy as np
+
+
+def pixel_tolerance(fig, ax, extent, dpi, fraction=0.5):
+   ### size of `fraction` of a pixel, in degrees, for axes showing extent at dpi
+   pos = ax.get_position()
+   px_x = fig.get_figwidth() * pos.width * dpi
+   px_y = fig.get_figheight() * pos.height * dpi
+   return fraction * min((extent[1] - extent[0]) / px_x, (extent[3] - extent[2]) / px_y)
+
+
+def douglas_peucker(x, y, tol):
+   ### indices of the points to keep; iterative, each split vectorized over its segment
+   n = len(x)
+   if n < 3:
+      return np.arange(n)
+   keep = np.zeros(n, dtype=bool)
+   keep[0] = keep[-1] = True
+   stack = [(0, n - 1)]
+   while stack:
+      i0, i1 = stack.pop()
+      if i1 - i0 < 2:
+         continue
+      dx, dy = x[i1] - x[i0], y[i1] - y[i0]
+      px, py = x[i0 + 1:i1] - x[i0], y[i0 + 1:i1] - y[i0]
+      ### distance to the segment, not the line through its ends: a track that doubles back past an end point
+      ### (out-and-back transects) must keep its turnaround
+      norm2 = dx * dx + dy * dy
+      u = np.clip((px * dx + py * dy) / norm2, 0, 1) if norm2 > 0 else np.zeros(len(px))
+      dist = np.hypot(px - u * dx, py - u * dy)
+      k = np.argmax(dist)
+      if dist[k] > tol:
+         k += i0 + 1
+         keep[k] = True
+         stack.append((i0, k))
+         stack.append((k, i1))
+   return np.nonzero(keep)[0]
+
+
+def decimate_run(x, y, tol):
+   ### drop consecutive fixes in the same tol-sized cell, then Douglas-Peucker
+   if len(x) < 3 or tol <= 0:
+      return x, y
+   cx = np.floor(x / tol).astype('int64')
+   cy = np.floor(y / tol).astype('int64')
+   moved = np.ones(len(x), dtype=bool)
+   moved[1:] = (cx[1:] != cx[:-1]) | (cy[1:] != cy[:-1])
+   moved[-1] = True
+   x, y = x[moved], y[moved]
+   keep = douglas_peucker(x, y, tol)
+   return x[keep], y[keep]
+
+
+def decimate_track(lon, lat, tol):
+   ### Returns decimated (lon, lat); runs separated by NaN fixes are decimated separately and joined with NaN
+   lon = np.asarray(lon, dtype='float64')
+   lat = np.asarray(lat, dtype='float64')
+   good = np.isfinite(lon) & np.isfinite(lat)
+   if good.all():
+      return decimate_run(lon, lat, tol)
+
+   edges = np.flatnonzero(np.diff(np.r_[0, good.astype('int8'), 0]))
+   xs, ys = [], []
+   for start, stop in zip(edges[::2], edges[1::2]):
+      x, y = decimate_run(lon[start:stop], lat[start:stop], tol)
+      xs += [x, [np.nan]]
+      ys += [y, [np.nan]]
+   if not xs:
+      return lon[:0], lat[:0]
+   return np.concatenate(xs[:-1]), np.concatenate(ys[:-1])
+
+
+def main():
+   import tracemalloc
+   import matplotlib
+   matplotlib.use('Agg')
+   from matplotlib.figure import Figure
+   from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+   n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+   ### a wandering track off Oregon
+   rng = np.random.default_rng(0)
+   lon = -124.5 + np.cumsum(rng.normal(0, 1e-4, n))
+   lat = 44.0 + np.cumsum(rng.normal(2e-6, 1e-4, n))
+   extent = [lon.min() - 0.25, lon.max() + 0.25, lat.min() - 0.25, lat.max() + 0.25]
+
+   for label, decimated in [('full', False), ('decimated', True)]:
+      tracemalloc.start()
+      t0 = time.perf_counter()
+      fig = Figure(figsize=[11, 8.5])
+      FigureCanvasAgg(fig)
+      ax = fig.add_subplot(1, 1, 1)
+      ax.set_xlim(extent[:2])
+      ax.set_ylim(extent[2:])
+      x, y = decimate_track(lon, lat, pixel_tolerance(fig, ax, extent, 120)) if decimated else (lon, lat)
+      ax.plot(x, y, linewidth=3)
+      fig.savefig('/dev/null', format='png', dpi=120)
+      elapsed = time.perf_counter() - t0
+      peak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+      print("%-10s %9d vertices  %6.2f s  peak %7.1f MB" % (label, len(x), elapsed, peak / 1e6))
+
+
+
+if __name__ == '__main__':
+    main()
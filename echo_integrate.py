@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+"""
+Command line tool for echo integration: mean Sv and NASC per time interval x range cell, from the *_Sv.nc files.
+
+Files are streamed in time order a chunk of pings at a time. Each chunk's samples are converted to the linear
+domain and summed into cells with one bincount, so no file is ever held in memory whole. Time cells are fixed
+--interval second bins (aligned to the clock, not to files), so a cell that straddles two files simply keeps
+accumulating until a later file starts past it. Range cells are --range metres of range from the transducer, out
+to --max-range. No transducer depth is added, so they are not depths below the surface.
+
+Outputs, in [cruise]/integration/:
+   DYYYYMMDD_integration.nc  -- one per day
+   [cruise]_integration.nc   -- the whole cruise
+each with Sv_mean (dB), NASC (m^2 nmi^-2) and sample counts on (frequency, time, range).
+
+The size and mtime of each Sv file, and the days its pings fall in, are kept in [cruise]/integration/state.json.
+A rerun integrates again only the days that a new, changed or removed Sv file touches (reading just the files
+that overlap them), and rebuilds the cruise file from the daily ones. Changing --interval, --range or --max-range,
+or --rebuild, redoes every day.
+
+example: python echo_integrate.py /media/paulr/ncei_data/shimada/ sh1707 --interval 60 --range 5
+
+"""
+
+
+import os
+import json
+import argparse
+from glob import glob
+import numpy as np
+import xarray as xr
+import runlog
+
+
+def day_of(tb, interval_ns):
+   return 'D' + str(np.datetime64(int(tb) * interval_ns, 'ns').astype('datetime64[D]')).replace('-', '')
+
+
+def days_spanned(t, interval_ns):
+   ### every day from that of the first time cell of pings t to that of the last
+   first, last = (np.datetime64(int(tb) * interval_ns, 'ns').astype('datetime64[D]') for tb in (t.min() // interval_ns, t.max() // interval_ns))
+   return ['D' + str(d).replace('-', '') for d in np.arange(first, last + np.timedelta64(1, 'D'))]
+
+
+def state_path(outdir):
+   return os.path.join(outdir, 'state.json')
+
+
+def load_state(path):
+   if not os.path.exists(path):
+      return {}
+   with open(path) as f:
+      return json.load(f)
+
+
+def save_state(state, path):
+   with open(path + '.tmp', 'w') as f:
+      json.dump(state, f, indent=1, sort_keys=True)
+   os.replace(path + '.tmp', path)
+
+
+def plan(Sv_files, state, interval_ns):
+   ### Compare the Sv files against the state. Returns (new {name: entry} for every file, set of days to redo).
+   files, dirty = {}, set()
+   old = state.get('files', {})
+   for f in Sv_files:
+      name = os.path.basename(f)
+      st = os.stat(f)
+      entry = old.get(name)
+      if entry is not None and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+         files[name] = entry
+         continue
+      with xr.open_dataset(f) as ds:
+         t = ds.ping_time.values.astype('datetime64[ns]').view('int64')
+      files[name] = {'size': st.st_size, 'mtime': st.st_mtime, 'days': days_spanned(t, interval_ns) if len(t) else []}
+      dirty.update(files[name]['days'])
+      if entry is not None:
+         dirty.update(entry['days'])
+   for name in set(old) - set(files):
+      dirty.update(old[name]['days'])
+   return files, dirty
+
+
+def sample_range(Sv_file, ds):
+   ### range (m) of each range_bin, per frequency. The chunked calibration (calibrate_hake.py) stores it in the
+   ### _Sv.nc; files from ModelEK60.calibrate() (--ping-chunk 0) may not have it, so it is recomputed from the
+   ### source .nc the same way (ModelEK60.range) rather than guessed from the Sv file.
+   if 'range' in ds:
+      return ds['range']
+   from echopype.model.ek60 import ModelEK60
+   return ModelEK60(Sv_file[:-len('_Sv.nc')] + '.nc').range
+
+
+def write_day(path, bins, interval_ns, dz, nrange):
+   ### bins: sorted list of (time bin, {frequency: (sums, counts)})
+   freqs = sorted(set(f for tb, cells in bins for f in cells))
+   sums = np.zeros((len(freqs), len(bins), nrange))
+   counts = np.zeros((len(freqs), len(bins), nrange), dtype='int64')
+   for j, (tb, cells) in enumerate(bins):
+      for f, (s, c) in cells.items():
+         sums[freqs.index(f), j] = s
+         counts[freqs.index(f), j] = c
+
+   with np.errstate(divide='ignore', invalid='ignore'):
+      sv_mean = np.where(counts > 0, sums / counts, np.nan)
+   ds = xr.Dataset(
+      {'Sv_mean': (('frequency', 'time', 'range'), (10 * np.log10(sv_mean)).astype('float32'), {'units': 'dB'}),
+       'NASC': (('frequency', 'time', 'range'), (4 * np.pi * 1852 ** 2 * sv_mean * dz).astype('float32'), {'units': 'm2 nmi-2'}),
+       'count': (('frequency', 'time', 'range'), counts.astype('int32'))},
+      coords={'frequency': freqs,
+              'time': (np.array([tb for tb, cells in bins], dtype='int64') * interval_ns).view('datetime64[ns]'),
+              'range': ('range', (np.arange(nrange) + 0.5) * dz,
+                        {'units': 'm', 'long_name': 'range from the transducer (centre of cell)'})},
+      attrs={'interval_s': interval_ns / 1e9, 'range_m': dz})
+   encoding = {v: {'zlib': True} for v in ds.data_vars}
+   ds.to_netcdf(path + '.tmp', encoding=encoding)
+   os.replace(path + '.tmp', path)
+   print("Saved " + path)
+
+
+def integrate(basedir, cruisename, interval=60.0, dz=5.0, max_range=500.0, chunk=2000, rebuild=False):
+   ncsdir = os.path.join(basedir, cruisename, 'ek60_nc')
+   outdir = os.path.join(basedir, cruisename, 'integration')
+   os.makedirs(outdir, exist_ok=True)
+   Sv_files = sorted(glob(os.path.join(ncsdir, '*_Sv.nc')))
+   interval_ns = int(interval * 1e9)
+   nrange = int(np.ceil(max_range / dz))
+
+   ### work out which days need integrating again; other cells all change if the grid does
+   statefile = state_path(outdir)
+   state = load_state(statefile)
+   params = {'interval': interval, 'range': dz, 'max_range': max_range}
+   if rebuild or state.get('params') != params:
+      state = {}
+   files, dirty = plan(Sv_files, state, interval_ns)
+   if not state:
+      dirty = set(d for entry in files.values() for d in entry['days'])
+      dirty.update(os.path.basename(p).split('_')[0] for p in glob(os.path.join(outdir, 'D*_integration.nc')))
+   if not dirty:
+      print("Integration is up to date")
+      return
+
+   open_bins = {}   # time bin -> {frequency: (sums, counts)}
+   day_bins = []
+   written = set()
+
+   def write(bins):
+      day = day_of(bins[0][0], interval_ns)
+      if day in dirty:
+         write_day(os.path.join(outdir, day + '_integration.nc'), bins, interval_ns, dz, nrange)
+         written.add(day)
+
+   def flush(upto):
+      ### move every bin before `upto` out of open_bins, writing out each day to redo as it completes
+      for tb in sorted(b for b in open_bins if upto is None or b < upto):
+         if day_bins and day_of(tb, interval_ns) != day_of(day_bins[0][0], interval_ns):
+            write(day_bins)
+            del day_bins[:]
+         day_bins.append((tb, open_bins.pop(tb)))
+
+   ### only the files with pings in those days are read; cells of other days they reach into are dropped
+   for f in [f for f in Sv_files if dirty.intersection(files[os.path.basename(f)]['days'])]:
+      print("Integrating " + f)
+      with runlog.measure('integrate', f):
+         with xr.open_dataset(f) as ds:
+            t = ds.ping_time.values.astype('datetime64[ns]').view('int64')
+            if not len(t):
+               continue
+            ### nothing from here on can land in a cell that ended before this file's first ping
+            flush(t.min() // interval_ns)
+            ranges = sample_range(f, ds)
+            for frequency in ds.frequency.values:
+               r = ranges.sel(frequency=frequency)
+               if 'ping_time' in r.dims:
+                  r = r.isel(ping_time=0)
+               r = r.values
+               with np.errstate(invalid='ignore'):
+                  db = np.floor(r / dz)
+                  valid_r = (r >= 0) & (db < nrange)
+               db = np.where(valid_r, db, 0).astype('int64')
+               sv = ds.Sv.sel(frequency=frequency).transpose('ping_time', 'range_bin')
+               for i in range(0, len(t), chunk):
+                  block = sv.isel(ping_time=slice(i, i + chunk)).values
+                  tb = t[i:i + chunk] // interval_ns
+                  base = tb.min()
+                  nb = int(tb.max() - base) + 1
+                  idx = (tb - base)[:, None] * nrange + db[None, :]
+                  valid = valid_r[None, :] & np.isfinite(block)
+                  sums = np.bincount(idx[valid], weights=10 ** (block[valid] / 10), minlength=nb * nrange).reshape(nb, nrange)
+                  counts = np.bincount(idx[valid], minlength=nb * nrange).reshape(nb, nrange)
+                  for k in np.nonzero(counts.any(axis=1))[0]:
+                     cells = open_bins.setdefault(int(base + k), {})
+                     s, c = cells.get(frequency, (0, 0))
+                     cells[frequency] = (s + sums[k], c + counts[k])
+
+   flush(None)
+   if day_bins:
+      write(day_bins)
+
+   ### a day to redo that no longer has any pings (its files were removed) loses its file
+   for day in dirty - written:
+      path = os.path.join(outdir, day + '_integration.nc')
+      if os.path.exists(path):
+         os.remove(path)
+         print("Removed " + path)
+
+   ### cruise-wide product from the daily ones; they are small, so they are read one at a time and joined in memory
+   ### (no dask needed, unlike open_mfdataset)
+   day_files = sorted(glob(os.path.join(outdir, 'D*_integration.nc')))
+   cruisefile = os.path.join(outdir, cruisename + '_integration.nc')
+   if not day_files and os.path.exists(cruisefile):
+      os.remove(cruisefile)
+   if day_files:
+      days = [xr.load_dataset(path) for path in day_files]
+      ds = xr.concat(days, dim='time', data_vars='minimal', coords='minimal', join='outer')
+      ds.attrs = days[0].attrs
+      ds.to_netcdf(cruisefile + '.tmp', encoding={v: {'zlib': True} for v in ds.data_vars})
+      os.replace(cruisefile + '.tmp', cruisefile)
+      print("Saved " + cruisefile)
+
+   save_state({'params': params, 'files': files}, statefile)
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Echo integration of calibrated Sv files')
+   parser.add_argument('basedir')
+   parser.add_argument('cruisename')
+   parser.add_argument('--interval', type=float, default=60.0, help='time cell length in seconds (default: 60)')
+   parser.add_argument('--range', type=float, default=5.0, help='range cell height in metres (default: 5)')
+   parser.add_argument('--max-range', type=float, default=500.0, help='farthest cell edge in metres from the transducer (default: 500)')
+   parser.add_argument('--rebuild', action='store_true', help='integrate every day again')
+   args = parser.parse_args()
+   runlog.start(os.path.join(args.basedir, args.cruisename))
+   integrate(args.basedir, args.cruisename, args.interval, args.range, args.max_range, rebuild=args.rebuild)
+   runlog.finish()
+
+
+
+if __name__ == '__main__':
+    main()
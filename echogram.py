@@ -0,0 +1,95 @@
+"""
+Rasterized echogram renderer with bounded memory.
+
+Instead of a pcolormesh over every ping x range sample, Sv is binned straight onto the output pixel grid: pings are
+read out of core a block at a time (see lazy_sv.py), converted to the linear domain and summed into (time pixel,
+range pixel) cells, and the cell means (or maxima, with mode='max' to keep peaks) are drawn with imshow. Memory is
+set by the image size and max_memory_mb (which sizes the blocks), not by the number of pings, and the layout matches
+the old 3-panel 18/38/120 kHz PNGs (time on x, range_bin on y, increasing downwards). A chunk with fewer pings than
+pixels across (or fewer range bins than pixels down) is binned at one column per ping (row per bin) and stretched
+over the axes, as pcolormesh did.
+"""
+
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import matplotlib.dates as mdates
+from lazy_sv import DEFAULT_MEMORY_MB, scan, blocks
+
+FREQUENCIES = [18000, 38000, 120000]
+
+
+def bin_chunk(sv, t, t0, t1, nrange, nx, ny, sums, counts, peaks=None):
+   ### accumulate one (ping x range_bin) block of Sv in dB into the nx x ny pixel grid
+   span = max(t1 - t0, 1)
+   xi = np.clip((t - t0) * nx // span, 0, nx - 1)
+   yi = np.arange(sv.shape[1]) * ny // nrange
+   idx = (xi[:, None] * ny + yi[None, :]).ravel()
+   sv = sv.ravel()
+   valid = np.isfinite(sv)
+   idx, sv = idx[valid], sv[valid]
+   sums += np.bincount(idx, weights=10 ** (sv / 10), minlength=nx * ny)
+   counts += np.bincount(idx, minlength=nx * ny)
+   if peaks is not None:
+      np.maximum.at(peaks, idx, sv)
+
+
+def bin_frequency(Sv_files, frequency, t0, t1, nrange, nx, ny, mode='mean', max_memory_mb=DEFAULT_MEMORY_MB):
+   ### Returns an (ny, nx) image of Sv in dB, NaN where there were no samples
+   sums = np.zeros(nx * ny)
+   counts = np.zeros(nx * ny, dtype='int64')
+   peaks = np.full(nx * ny, -np.inf) if mode == 'max' else None
+   for t, sv in blocks(Sv_files, frequency, max_memory_mb, nrange):
+      bin_chunk(sv, t, t0, t1, nrange, nx, ny, sums, counts, peaks)
+
+   with np.errstate(divide='ignore', invalid='ignore'):
+      if mode == 'max':
+         img = np.where(counts > 0, peaks, np.nan)
+      else:
+         img = np.where(counts > 0, 10 * np.log10(sums / np.maximum(counts, 1)), np.nan)
+   return fill_columns(img.reshape(nx, ny)).T
+
+
+def fill_columns(img):
+   ### img: (nx, ny). With about one ping per column, jitter in the ping times puts two pings in one column now and
+   ### then and none in the next; fill such single empty columns from the column before (real gaps, two or more
+   ### columns wide, are left blank)
+   empty = np.isnan(img).all(axis=1)
+   single = np.nonzero(empty[1:-1] & ~empty[:-2] & ~empty[2:])[0] + 1
+   img[single] = img[single - 1]
+   return img
+
+
+def render_echogram(Sv_files, pngname, title, frequencies=FREQUENCIES, vmin=-100, vmax=-40, cmap='Spectral_r', mode='mean', dpi=120,
+                    max_memory_mb=DEFAULT_MEMORY_MB):
+   t0, t1, nrange, npings = scan(Sv_files)
+   fig = Figure(figsize=[11, 8.5])
+   FigureCanvasAgg(fig)
+   axes = [fig.add_subplot(len(frequencies), 1, k + 1) for k in range(len(frequencies))]
+   tlim = mdates.date2num(np.array([t0, t1]).view('datetime64[ns]'))
+
+   ### lay the figure out completely (colorbars included) before measuring the axes, so the image isn't resampled
+   ### smaller afterwards, which would drop columns and the peaks mode='max' keeps
+   images = []
+   for ax, frequency in zip(axes, frequencies):
+      im = ax.imshow(np.full((1, 1), np.nan), aspect='auto', extent=[tlim[0], tlim[1], nrange, 0], vmin=vmin, vmax=vmax, cmap=cmap,
+                     interpolation='nearest')
+      ax.xaxis_date()
+      ax.set_ylabel('range_bin')
+      ax.set_xlabel('ping_time')
+      ax.set_title(title + '  (frequency=' + str(frequency) + ')')
+      fig.colorbar(im, ax=ax, label='Sv')
+      images.append(im)
+   fig.tight_layout()
+
+   for ax, im, frequency in zip(axes, images, frequencies):
+      ### one image pixel per screen pixel, but no more columns than pings or rows than range bins (which would leave
+      ### empty stripes); imshow stretches a smaller image over the axes
+      bbox = ax.get_window_extent()
+      nx = max(min(int(bbox.width * dpi / fig.dpi), npings), 1)
+      ny = max(min(int(bbox.height * dpi / fig.dpi), nrange), 1)
+      im.set_data(bin_frequency(Sv_files, frequency, t0, t1, nrange, nx, ny, mode, max_memory_mb))
+   fig.savefig(pngname, dpi=dpi)
@@ -0,0 +1,34 @@
+"""
+Small helpers shared by the hake survey scripts.
+"""
+
+
+import os
+import re
+import logging
+from glob import glob
+
+
+def log_error(logpath, message):
+   ### Write the current exception to its own log file, without touching the root logger (which is shared by
+   ### everything else running in this process)
+   logger = logging.getLogger(os.path.basename(logpath))
+   handler = logging.FileHandler(logpath, mode='w')
+   logger.addHandler(handler)
+   logger.setLevel(logging.WARNING)
+   logger.propagate = False
+   try:
+      logger.exception(message)
+   finally:
+      logger.removeHandler(handler)
+      handler.close()
+
+
+def file_day(path):
+   ### 'DYYYYMMDD' out of a [cruise]-DYYYYMMDD-THHMMSS file name, or None
+   match = re.search(r'D\d{8}', os.path.basename(path))
+   return match.group(0) if match else None
+
+
+def cruise_days(ncsdir):
+   return sorted(set(filter(None, map(file_day, glob(os.path.join(ncsdir, '*[0-9].nc'))))))
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+"""
+Out-of-core reading of _Sv.nc files, in memory set by a ceiling rather than by how long the day is.
+
+open_lazy() opens a set of Sv files (e.g. one day) as a single dataset backed by dask arrays, chunked along
+ping_time with one frequency and every range bin per chunk, so nothing is read until a block is asked for. The
+chunk length comes from the memory ceiling: a block, and the handful of same-sized temporaries made while it is
+binned or reduced, must fit in max_memory_mb. blocks() then hands back one (ping_time, range_bin) block of one
+frequency at a time. Without dask installed the files are read one after the other in blocks of the same size.
+
+echogram.py bins its images from blocks(), and day_stats() reduces a day per frequency the same way: per
+frequency, the count, mean (in the linear domain), min and max of Sv and the mean profile over range_bin. These
+are fixed-size accumulators, so the memory day_stats() needs does not grow with the number of pings in the day
+(which is why there is no per-ping series; the echograms show that). Running this file writes them to
+[cruise]/Sv_stats/DYYYYMMDD_Sv_stats.nc.
+
+example: python lazy_sv.py /media/paulr/ncei_data/shimada/sh1707/ D20170720 --max-memory 512
+
+"""
+
+
+import os
+import argparse
+from glob import glob
+import numpy as np
+import xarray as xr
+import runlog
+
+DEFAULT_MEMORY_MB = 256
+### copies of a block alive at once while it is binned or reduced (dB, linear, mask, bin index, weights, ...)
+WORKING_COPIES = 6
+
+
+def ping_chunk(nrange, max_memory_mb=DEFAULT_MEMORY_MB):
+   ### pings per block so that WORKING_COPIES float64 blocks of nrange samples fit in max_memory_mb
+   return max(int(max_memory_mb * 2 ** 20 // (WORKING_COPIES * 8 * max(nrange, 1))), 1)
+
+
+def scan(Sv_files):
+   ### first and last ping time (ns), the largest number of range bins and the total number of pings over the files
+   t0, t1, nrange, npings = None, None, 0, 0
+   for f in Sv_files:
+      with xr.open_dataset(f) as ds:
+         t = ds.ping_time.values.astype('datetime64[ns]').view('int64')
+         if len(t):
+            t0 = t.min() if t0 is None else min(t0, t.min())
+            t1 = t.max() if t1 is None else max(t1, t.max())
+         nrange = max(nrange, ds.sizes['range_bin'])
+         npings += len(t)
+   return t0, t1, nrange, npings
+
+
+def open_lazy(Sv_files, max_memory_mb=DEFAULT_MEMORY_MB, nrange=None):
+   ### One dask-backed dataset over all the files
+   import dask    # raises ImportError without it, before xarray would fall back to reading everything eagerly
+   if nrange is None:
+      nrange = scan(Sv_files)[2]
+   chunks = {'ping_time': ping_chunk(nrange, max_memory_mb), 'frequency': 1, 'range_bin': -1}
+   return xr.open_mfdataset(Sv_files, combine='by_coords', chunks=chunks, data_vars='minimal', coords='minimal', compat='override')
+
+
+def blocks(Sv_files, frequency, max_memory_mb=DEFAULT_MEMORY_MB, nrange=None):
+   ### Yields (ping times in ns, Sv block in dB as (ping_time, range_bin)) for one frequency, one block at a time
+   if nrange is None:
+      nrange = scan(Sv_files)[2]
+   try:
+      ds = open_lazy(Sv_files, max_memory_mb, nrange)
+   except ImportError:
+      ds = None
+
+   if ds is not None:
+      with ds:
+         if frequency not in ds.frequency.values:
+            return
+         sv = ds.Sv.sel(frequency=frequency).transpose('ping_time', 'range_bin')
+         t = ds.ping_time.values.astype('datetime64[ns]').view('int64')
+         start = 0
+         for n in sv.chunks[0]:
+            yield t[start:start + n], sv[start:start + n].values
+            start += n
+      return
+
+   chunk = ping_chunk(nrange, max_memory_mb)
+   for f in Sv_files:
+      with xr.open_dataset(f) as ds:
+         if frequency not in ds.frequency.values:
+            continue
+         sv = ds.Sv.sel(frequency=frequency).transpose('ping_time', 'range_bin')
+         t = ds.ping_time.values.astype('datetime64[ns]').view('int64')
+         for i in range(0, len(t), chunk):
+            yield t[i:i + chunk], sv.isel(ping_time=slice(i, i + chunk)).values
+
+
+def day_stats(Sv_files, max_memory_mb=DEFAULT_MEMORY_MB):
+   ### Per-frequency statistics of Sv over the files, accumulated one block at a time. Returns an xarray Dataset.
+   nrange = scan(Sv_files)[2]
+   with xr.open_dataset(Sv_files[0]) as ds:
+      frequencies = ds.frequency.values.tolist()
+   for f in Sv_files[1:]:
+      with xr.open_dataset(f) as ds:
+         frequencies = sorted(set(frequencies) | set(ds.frequency.values.tolist()))
+
+   nf = len(frequencies)
+   count = np.zeros(nf, dtype='int64')
+   total = np.zeros(nf)
+   sv_min = np.full(nf, np.inf)
+   sv_max = np.full(nf, -np.inf)
+   profile_sum = np.zeros((nf, nrange))
+   profile_count = np.zeros((nf, nrange), dtype='int64')
+   for k, frequency in enumerate(frequencies):
+      for t, sv in blocks(Sv_files, frequency, max_memory_mb, nrange):
+         valid = np.isfinite(sv)
+         lin = np.where(valid, 10 ** (sv / 10), 0)
+         count[k] += valid.sum()
+         total[k] += lin.sum()
+         if valid.any():
+            sv_min[k] = min(sv_min[k], sv[valid].min())
+            sv_max[k] = max(sv_max[k], sv[valid].max())
+         profile_sum[k, :sv.shape[1]] += lin.sum(axis=0)
+         profile_count[k, :sv.shape[1]] += valid.sum(axis=0)
+
+   db = lambda lin: 10 * np.log10(lin)
+   with np.errstate(divide='ignore', invalid='ignore'):
+      return xr.Dataset(
+         {'count': ('frequency', count),
+          'Sv_mean': ('frequency', db(total / count), {'units': 'dB'}),
+          'Sv_min': ('frequency', np.where(count > 0, sv_min, np.nan), {'units': 'dB'}),
+          'Sv_max': ('frequency', np.where(count > 0, sv_max, np.nan), {'units': 'dB'}),
+          'Sv_profile': (('frequency', 'range_bin'), db(profile_sum / profile_count), {'units': 'dB'})},
+         coords={'frequency': frequencies, 'range_bin': np.arange(nrange)},
+         attrs={'files': len(Sv_files)})
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Statistics of a day of Sv, computed out of core')
+   parser.add_argument('cruisedir')
+   parser.add_argument('day', help='DYYYYMMDD')
+   parser.add_argument('--max-memory', type=int, default=DEFAULT_MEMORY_MB, metavar='MB', help='memory for the blocks of Sv being read (default: %d)' % DEFAULT_MEMORY_MB)
+   args = parser.parse_args()
+
+   Sv_files = sorted(glob(os.path.join(args.cruisedir, 'ek60_nc', '*' + args.day + '*_Sv.nc')))
+   if not Sv_files:
+      print("No Sv files for " + args.day)
+      return
+   runlog.start(args.cruisedir)
+   with runlog.measure('day_stats'):
+      stats = day_stats(Sv_files, args.max_memory)
+   outdir = os.path.join(args.cruisedir, 'Sv_stats')
+   os.makedirs(outdir, exist_ok=True)
+   path = os.path.join(outdir, args.day + '_Sv_stats.nc')
+   stats.to_netcdf(path + '.tmp')
+   os.replace(path + '.tmp', path)
+   for frequency in stats.frequency.values:
+      s = stats.sel(frequency=frequency)
+      print("%g Hz: %d samples, mean Sv %.1f dB (min %.1f, max %.1f)" % (frequency, s['count'], s['Sv_mean'], s['Sv_min'], s['Sv_max']))
+   print("Saved " + path)
+   runlog.finish()
+
+
+
+if __name__ == '__main__':
+    main()
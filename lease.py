@@ -0,0 +1,262 @@
+"""
+Lease files, for several hosts working on one cruise directory over a shared (e.g. NFS) mount without a broker.
+
+A lease is a small JSON file, [cruise]/.leases/[key].lease, naming the host, pid and a random token of its holder.
+It is created by writing a uniquely named file and hard-linking it into place, which is atomic on NFS (O_EXCL is
+not, on older clients). While held, a background thread touches the file every ttl/4 seconds. A lease is stale,
+and is reclaimed by the next process that wants it, when it hasn't been touched for ttl seconds (its holder hung,
+crashed or lost its host) or its holder was a process on this host that no longer exists. Staleness compares the
+file's mtime, set by the file server, with this host's clock, so the hosts' clocks need to agree to well within
+ttl (e.g. by NTP).
+
+   claim(cruisedir, key)  -- for a unit of work (a file to convert, calibrate or render): yields a false Lease at
+                             once if another process holds it, so the caller moves on to something else
+   hold(cruisedir, key)   -- for a store several hosts update (the conversion manifest, the summary index, the
+                             navigation store): waits until it is free
+
+A held lease can still be lost: a holder stalled for longer than ttl has its lease reclaimed, and a reclaimer that
+renamed a fresh lease aside cannot always put it back. The heartbeat then marks the Lease lost, and its check(),
+which callers make just before committing outputs, raises LeaseLost, so the work is dropped rather than written
+over another holder's. Leases are released the way stale ones are reclaimed, by renaming aside and checking the
+token, so a release never removes someone else's lease.
+
+Both do nothing (claim yields a true Lease) unless shared mode is on: enable() (the scripts' --shared flag), or
+HAKE_SHARED=1 in the environment. enable() sets HAKE_SHARED for child processes, so pool workers and the scripts
+run_cruise.py starts share too.
+
+Leases only stop two processes doing the same unit at once; each caller still rechecks, once it holds the lease,
+whether another host finished the unit in the meantime.
+"""
+
+
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+from contextlib import contextmanager
+
+ENV = 'HAKE_SHARED'
+LEASE_TTL = 300.0
+
+
+def enable():
+   os.environ[ENV] = '1'
+
+
+def enabled():
+   return os.environ.get(ENV, '') not in ('', '0')
+
+
+def lease_dir(cruisedir):
+   return os.path.join(cruisedir, '.leases')
+
+
+def lease_path(cruisedir, key):
+   return os.path.join(lease_dir(cruisedir), key.replace(os.sep, '_').replace(':', '_') + '.lease')
+
+
+def read(path):
+   ### The holder's {'host', 'pid', 'token', 'acquired', 'ttl'}, or None if there is no (readable) lease
+   try:
+      with open(path) as f:
+         return json.load(f)
+   except (OSError, ValueError):
+      return None
+
+
+def pid_alive(pid):
+   try:
+      os.kill(pid, 0)
+   except ProcessLookupError:
+      return False
+   except PermissionError:
+      pass
+   return True
+
+
+def is_stale(path, info, ttl=LEASE_TTL):
+   try:
+      age = time.time() - os.stat(path).st_mtime
+   except FileNotFoundError:
+      return False
+   if age > info.get('ttl', ttl):
+      return True
+   return info.get('host') == socket.gethostname() and not pid_alive(info.get('pid', 0))
+
+
+def try_create(path, ttl=LEASE_TTL):
+   ### Returns our token if we now hold the lease, else None
+   token = uuid.uuid4().hex
+   tmppath = '%s.%s-%d-%s' % (path, socket.gethostname(), os.getpid(), token)
+   with open(tmppath, 'w') as f:
+      json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'token': token, 'ttl': ttl,
+                 'acquired': time.strftime('%Y-%m-%dT%H:%M:%S')}, f)
+   try:
+      os.link(tmppath, path)
+      held = True
+   except FileExistsError:
+      held = False
+   except OSError:
+      ### over NFS a link can succeed and still report an error (a lost reply to a retried request)
+      held = os.stat(tmppath).st_nlink == 2
+   finally:
+      os.remove(tmppath)
+   return token if held else None
+
+
+def reclaim(path, info):
+   ### Break a stale lease. Renaming it aside is atomic, so only one of several reclaimers gets it; if what was
+   ### renamed turns out to be a fresh lease (taken since `info` was read), it is put back. Returns True if the stale
+   ### lease was broken here.
+   grave = '%s.stale-%s-%d-%s' % (path, socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+   try:
+      os.rename(path, grave)
+   except FileNotFoundError:
+      return False
+   taken = read(grave)
+   if taken is not None and taken.get('token') != info.get('token'):
+      put_back(grave, path)
+      return False
+   os.remove(grave)
+   print("Reclaimed stale lease %s from %s (pid %s)" % (os.path.basename(path), info.get('host'), info.get('pid')))
+   return True
+
+
+def put_back(grave, path):
+   ### Link a lease renamed aside by mistake back into place. If another process has created a lease there in the
+   ### meantime, the one renamed aside is lost: its holder finds out at its next renewal or check() and stops.
+   try:
+      os.link(grave, path)
+      ok = True
+   except FileExistsError:
+      ok = False
+   except OSError:
+      ok = os.stat(grave).st_nlink == 2
+   if not ok:
+      taken = read(grave) or {}
+      print("Lease %s of %s (pid %s) was lost to a race" % (os.path.basename(path), taken.get('host'), taken.get('pid')))
+   os.remove(grave)
+   return ok
+
+
+def acquire(path, ttl=LEASE_TTL):
+   ### One attempt, reclaiming a stale lease on the way. Returns our token, or None if someone else holds it.
+   token = try_create(path, ttl)
+   if token is None:
+      info = read(path)
+      if info is None or is_stale(path, info, ttl):
+         if info is not None:
+            reclaim(path, info)
+         token = try_create(path, ttl)
+   return token
+
+
+def release(path, token):
+   ### Rename the lease aside and remove it only if it is ours; reading it and then removing it could remove a lease
+   ### another process took in between
+   grave = '%s.release-%s-%d-%s' % (path, socket.gethostname(), os.getpid(), token)
+   try:
+      os.rename(path, grave)
+   except FileNotFoundError:
+      return
+   taken = read(grave)
+   if taken is not None and taken.get('token') != token:
+      put_back(grave, path)
+   else:
+      os.remove(grave)
+
+
+class LeaseLost(Exception):
+   pass
+
+
+class Lease:
+   ### What claim() and hold() yield. True while this process holds the lease (always, when shared mode is off).
+   ### A lease can be lost -- reclaimed as stale by another host after a long stall, or knocked out by a race between
+   ### reclaimers -- so call check() just before committing outputs: it raises LeaseLost if the lease is gone.
+
+   def __init__(self, path=None, token=None):
+      self.path, self.token = path, token
+      self.lost = threading.Event()
+
+   def __bool__(self):
+      return (self.path is None or self.token is not None) and not self.lost.is_set()
+
+   def mine(self):
+      info = read(self.path)
+      if info is None:
+         ### a reclaimer or releaser may have it renamed aside for a moment
+         time.sleep(1.0)
+         info = read(self.path)
+      return info is not None and info.get('token') == self.token
+
+   def check(self):
+      if self.path is None:
+         return
+      if not self.lost.is_set() and not self.mine():
+         self.lost.set()
+      if self.lost.is_set():
+         raise LeaseLost("Lost lease " + os.path.basename(self.path))
+
+
+def renew(lease, interval, stop):
+   ### Touch the lease every interval; if it is no longer ours, mark it lost so the holder's check() fails
+   while not stop.wait(interval):
+      if not lease.mine():
+         lease.lost.set()
+         print("Lost lease " + os.path.basename(lease.path))
+         return
+      try:
+         os.utime(lease.path)
+      except OSError as e:
+         print('An error occurred renewing ' + lease.path + ': ' + str(e))
+
+
+@contextmanager
+def held(path, token, ttl):
+   ### Keep the lease alive while the caller works, and let it go afterwards (unless it was lost meanwhile)
+   lease = Lease(path, token)
+   stop = threading.Event()
+   heartbeat = threading.Thread(target=renew, args=(lease, ttl / 4, stop), daemon=True)
+   heartbeat.start()
+   try:
+      yield lease
+   finally:
+      stop.set()
+      heartbeat.join()
+      if not lease.lost.is_set():
+         release(path, token)
+
+
+@contextmanager
+def claim(cruisedir, key, ttl=LEASE_TTL):
+   ### `with claim(cruisedir, key) as mine:` -- do the work only if mine, and mine.check() before committing it
+   if not enabled():
+      yield Lease()
+      return
+   path = lease_path(cruisedir, key)
+   os.makedirs(lease_dir(cruisedir), exist_ok=True)
+   token = acquire(path, ttl)
+   if token is None:
+      yield Lease(path)
+      return
+   with held(path, token, ttl) as lease:
+      yield lease
+
+
+@contextmanager
+def hold(cruisedir, key, ttl=LEASE_TTL, poll=1.0):
+   ### Wait for the lease, then hold it for the body of the with (`as held`: held.check() before committing)
+   if not enabled():
+      yield Lease()
+      return
+   path = lease_path(cruisedir, key)
+   os.makedirs(lease_dir(cruisedir), exist_ok=True)
+   token = acquire(path, ttl)
+   while token is None:
+      time.sleep(poll)
+      token = acquire(path, ttl)
+   with held(path, token, ttl) as lease:
+      yield lease
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+"""
+Cruise-wide navigation store shared by the ship track plotters, so tracks never re-open the .nc files.
+
+The store lives in [cruise]/nav/ as flat, append-only binary arrays (one record per GPS fix):
+   time.i8   -- int64 nanoseconds since 1970
+   lat.f8    -- float64 latitude
+   lon.f8    -- float64 longitude
+   fileid.i4 -- int32 id of the .nc file the fix came from
+and files.json, which maps each .nc file name to its id, the [start, stop) record range it occupies, and the
+size/mtime it had when read. files.json is written last (atomically), so records from an interrupted append are
+simply ignored and overwritten next time. A re-converted file is appended again under a new id, and a file that is
+no longer in ek60_nc (e.g. removed when its .raw was re-converted, see raw2netCDF.remove_outputs) is dropped from
+files.json; its records stay in the arrays, unused. In shared mode
+(see lease.py) updates from different hosts take turns.
+
+example: python navstore.py /media/paulr/ncei_data/shimada/sh1701/
+
+"""
+
+
+import os
+import sys
+import json
+from glob import glob
+import numpy as np
+import runlog
+import lease
+
+FIELDS = [('time', 'int64', 'time.i8'), ('lat', 'float64', 'lat.f8'), ('lon', 'float64', 'lon.f8'), ('fileid', 'int32', 'fileid.i4')]
+
+
+def navdir(cruisedir):
+   return os.path.join(cruisedir, 'nav')
+
+
+def load_files(cruisedir):
+   path = os.path.join(navdir(cruisedir), 'files.json')
+   if not os.path.exists(path):
+      return {'n': 0, 'next_id': 0, 'files': {}}
+   with open(path) as f:
+      return json.load(f)
+
+
+def save_files(cruisedir, files):
+   path = os.path.join(navdir(cruisedir), 'files.json')
+   with open(path + '.tmp', 'w') as f:
+      json.dump(files, f, indent=1, sort_keys=True)
+   os.replace(path + '.tmp', path)
+
+
+def read_platform(ncfile):
+   import xarray as xr
+   with xr.open_dataset(ncfile, group='Platform') as plat:
+      return (plat.location_time.values.astype('datetime64[ns]').view('int64'),
+              plat.latitude.values.astype('float64'), plat.longitude.values.astype('float64'))
+
+
+def update(cruisedir, ncfiles=None):
+   ### Append the fixes of any .nc file that is new or has changed since it was stored. Returns the number of files read.
+   ### one writer at a time, when hosts share the cruise (see lease.py)
+   with lease.hold(cruisedir, 'navstore') as held:
+      if ncfiles is None:
+         ncfiles = sorted(glob(os.path.join(cruisedir, 'ek60_nc', '*[0-9].nc')))
+      os.makedirs(navdir(cruisedir), exist_ok=True)
+      files = load_files(cruisedir)
+
+      ### forget files that have since been removed from ek60_nc
+      ncsdir = os.path.join(cruisedir, 'ek60_nc')
+      present = set(os.listdir(ncsdir)) if os.path.isdir(ncsdir) else set()
+      gone = [key for key in files['files'] if key not in present]
+      for key in gone:
+         del files['files'][key]
+
+      ### drop anything past the last committed record (left over from an interrupted append)
+      for name, dtype, fname in FIELDS:
+         path = os.path.join(navdir(cruisedir), fname)
+         with open(path, 'ab') as f:
+            f.truncate(files['n'] * np.dtype(dtype).itemsize)
+
+      nread = 0
+      handles = {name: open(os.path.join(navdir(cruisedir), fname), 'ab') for name, dtype, fname in FIELDS}
+      try:
+         for ncfile in ncfiles:
+            key = os.path.basename(ncfile)
+            st = os.stat(ncfile)
+            entry = files['files'].get(key)
+            if entry is not None and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+               continue
+            with runlog.measure('navigation', ncfile) as m:
+               try:
+                  t, lat, lon = read_platform(ncfile)
+               except Exception as e:
+                  print('An error occurred: ' + str(e))
+                  m['ok'], m['error'] = False, str(e)
+                  continue
+
+            ### stop appending if another host has taken the store over (see lease.py)
+            held.check()
+            fid = files['next_id']
+            handles['time'].write(t.tobytes())
+            handles['lat'].write(lat.tobytes())
+            handles['lon'].write(lon.tobytes())
+            handles['fileid'].write(np.full(len(t), fid, dtype='int32').tobytes())
+            files['files'][key] = {'id': fid, 'start': files['n'], 'stop': files['n'] + len(t), 'size': st.st_size, 'mtime': st.st_mtime}
+            files['n'] += len(t)
+            files['next_id'] += 1
+            nread += 1
+      finally:
+         for h in handles.values():
+            h.close()
+         ### leave files.json (and so its mtime) alone when nothing was added or dropped
+         if nread or gone:
+            held.check()
+            save_files(cruisedir, files)
+
+   return nread
+
+
+def open_store(cruisedir):
+   ### Memory-map the store. Returns (files, arrays) where arrays maps 'time'/'lat'/'lon'/'fileid' to np.memmap
+   files = load_files(cruisedir)
+   arrays = {}
+   for name, dtype, fname in FIELDS:
+      path = os.path.join(navdir(cruisedir), fname)
+      if files['n'] == 0:
+         arrays[name] = np.zeros(0, dtype=dtype)
+      else:
+         arrays[name] = np.memmap(path, dtype=dtype, mode='r', shape=(files['n'],))
+   return files, arrays
+
+
+def track(store, ncfiles):
+   ### Returns (lon, lat) arrays for the given .nc files, concatenated in the order given
+   files, arrays = store
+   lons, lats = [], []
+   for ncfile in ncfiles:
+      entry = files['files'].get(os.path.basename(ncfile))
+      if entry is None:
+         continue
+      lons.append(arrays['lon'][entry['start']:entry['stop']])
+      lats.append(arrays['lat'][entry['start']:entry['stop']])
+   if not lons:
+      return np.zeros(0), np.zeros(0)
+   return np.concatenate(lons), np.concatenate(lats)
+
+
+def main():
+   cruisedir = sys.argv[1]
+   runlog.start(cruisedir)
+   nread = update(cruisedir)
+   files, arrays = open_store(cruisedir)
+   print("Read " + str(nread) + " files; store holds " + str(files['n']) + " fixes from " + str(len(files['files'])) + " files")
+   runlog.finish()
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+"""
+Chunked, compressed layout for the converted .nc and calibrated _Sv.nc files, and a one-shot migration to it.
+
+Everything downstream reads these files along ping_time (a run of pings, all range bins, one frequency at a time),
+so in the 'chunked' layout every variable with a ping_time dimension is stored in chunks of PING_CHUNK pings x one
+frequency x every other dimension whole, and every numeric variable is compressed losslessly (zlib with the
+shuffle filter). The file is rewritten group by group (root, Beam, Environment, Platform, ...) with the same
+names, values and attributes, so readers need no changes; only the bytes on disk and the number of them read per
+slice go down. The .nc's mtime is kept, so calibrate_hake.py doesn't take a migrated file for a new one.
+
+raw2netCDF.py and calibrate_hake.py write this layout with --layout chunked. To migrate a cruise converted before
+(files already in the layout are skipped), printing the size and the time to read Sv/backscatter slices along
+ping_time before and after each file (both times are with the file in the page cache, so they measure chunk and
+decompression overhead rather than the disk):
+example: python nc_layout.py /media/paulr/ncei_data/shimada/ sh1707 --workers 4
+
+The summary index and navigation store key files on size, so the next survey_hake.py / navstore run re-reads the
+migrated files once.
+
+"""
+
+
+import os
+import time
+import argparse
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import xarray as xr
+import runlog
+
+PING_CHUNK = 1024
+COMPLEVEL = 4
+LAYOUT_ATTR = 'hake_layout'
+
+
+def layout_name(ping_chunk=PING_CHUNK):
+   return 'chunked ping_time=%d zlib=%d' % (ping_chunk, COMPLEVEL)
+
+
+def groups(path):
+   ### '' for the root, then every group's path, parents before children
+   import netCDF4
+   found = ['']
+   with netCDF4.Dataset(path) as nc:
+      stack = list(nc.groups.values())
+      while stack:
+         g = stack.pop(0)
+         found.append(g.path.lstrip('/'))
+         stack.extend(g.groups.values())
+   return found
+
+
+def encoding(ds, ping_chunk=PING_CHUNK):
+   enc = {}
+   for name, var in ds.variables.items():
+      if var.dtype.kind not in 'biuf' or var.ndim == 0:
+         continue
+      enc[name] = {'zlib': True, 'complevel': COMPLEVEL, 'shuffle': True}
+      if 'ping_time' in var.dims and all(var.sizes[d] > 0 for d in var.dims):
+         enc[name]['chunksizes'] = tuple(min(ping_chunk, var.sizes[d]) if d == 'ping_time' else 1 if d == 'frequency' else var.sizes[d]
+                                         for d in var.dims)
+   return enc
+
+
+def is_migrated(path, ping_chunk=PING_CHUNK):
+   import netCDF4
+   with netCDF4.Dataset(path) as nc:
+      return getattr(nc, LAYOUT_ATTR, None) == layout_name(ping_chunk)
+
+
+def rewrite(path, ping_chunk=PING_CHUNK):
+   ### Rewrite one .nc (all groups) in the chunked layout, in place. Returns (bytes before, bytes after).
+   st = os.stat(path)
+   tmpfile = path + '.tmp'
+   for k, group in enumerate(groups(path)):
+      with xr.open_dataset(path, group=group or None, decode_times=False, mask_and_scale=False) as ds:
+         ds = ds.load()
+      if not group:
+         ds.attrs[LAYOUT_ATTR] = layout_name(ping_chunk)
+      ds.to_netcdf(tmpfile, mode='w' if k == 0 else 'a', group=group or None, format='NETCDF4', encoding=encoding(ds, ping_chunk))
+   os.replace(tmpfile, path)
+   os.utime(path, (st.st_atime, st.st_mtime))
+   return st.st_size, os.path.getsize(path)
+
+
+def read_time(path, nslices=10, width=500):
+   ### Seconds to read nslices evenly spaced runs of `width` pings (all range bins) of each frequency of Sv
+   ### (for _Sv.nc) or Beam backscatter_r (for converted files)
+   t0 = time.perf_counter()
+   sv = path.endswith('_Sv.nc')
+   with xr.open_dataset(path, group=None if sv else 'Beam') as ds:
+      var = ds['Sv' if sv else 'backscatter_r']
+      n = var.sizes['ping_time']
+      for start in np.linspace(0, max(n - width, 0), nslices).astype(int):
+         for frequency in ds.frequency.values:
+            var.sel(frequency=frequency).isel(ping_time=slice(start, start + width)).values
+   return time.perf_counter() - t0
+
+
+def migrate_file(job):
+   ### Worker entry point: job is (path, ping_chunk). Returns (path, size before, size after, read before, read after),
+   ### or None if the file was already migrated or failed
+   path, ping_chunk = job
+   try:
+      if is_migrated(path, ping_chunk):
+         return None
+      with runlog.measure('migrate', path):
+         before = read_time(path)
+         size_before, size_after = rewrite(path, ping_chunk)
+         after = read_time(path)
+      return path, size_before, size_after, before, after
+   except Exception as e:
+      print('An error occurred migrating ' + path + ': ' + str(e))
+      if os.path.exists(path + '.tmp'):
+         os.remove(path + '.tmp')
+      return None
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Rewrite a cruise\'s .nc and _Sv.nc files in the chunked, compressed layout')
+   parser.add_argument('basedir')
+   parser.add_argument('cruisename')
+   parser.add_argument('--ping-chunk', type=int, default=PING_CHUNK, help='pings per chunk (default: %d)' % PING_CHUNK)
+   parser.add_argument('--workers', type=int, default=1, help='number of files to rewrite at a time (default: 1)')
+   args = parser.parse_args()
+
+   ncsdir = os.path.join(args.basedir, args.cruisename, 'ek60_nc')
+   runlog.start(os.path.join(args.basedir, args.cruisename))
+   jobs = [(f, args.ping_chunk) for f in sorted(glob(os.path.join(ncsdir, '*.nc')))]
+   if args.workers <= 1:
+      results = [migrate_file(job) for job in jobs]
+   else:
+      with ProcessPoolExecutor(max_workers=args.workers) as pool:
+         results = list(pool.map(migrate_file, jobs))
+
+   results = [r for r in results if r is not None]
+   for path, size_before, size_after, before, after in results:
+      print("%s: %.1f -> %.1f MB, slice reads %.2f -> %.2f s" % (os.path.basename(path), size_before / 2 ** 20, size_after / 2 ** 20, before, after))
+   if results:
+      totals = np.sum([r[1:] for r in results], axis=0)
+      print("Migrated %d of %d files: %.1f -> %.1f MB (%.0f%%), slice reads %.1f -> %.1f s" % (len(results), len(jobs),
+            totals[0] / 2 ** 20, totals[1] / 2 ** 20, 100 * totals[1] / max(totals[0], 1), totals[2], totals[3]))
+   else:
+      print("Nothing to migrate")
+   runlog.finish()
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+"""
+Command line tool for checking ping timing across an entire cruise.
+
+All ping times are concatenated (in file order) into one array and checked in a single vectorized pass for:
+   interval_change -- a jump of more than 100 ms between consecutive ping intervals within a file
+   dropout         -- an interval more than --dropout times the file's median interval
+   duplicate       -- two pings with the same time
+   overlap         -- a ping earlier than the one before it (within a file or across files)
+   gap             -- more than --gap seconds between the last ping of one file and the first of the next
+
+The events go to [cruise]/[cruise]_ping_timing.csv, and one summary plot per day goes to ping_interval/.
+Ping times are read from the cache survey_hake.py writes to ping_interval/ping_times/, falling back to the .nc
+file (and filling the cache) for anything not cached yet.
+
+example: python ping_report.py /media/paulr/ncei_data/shimada/ sh1707
+
+"""
+
+
+import os
+import csv
+import argparse
+from glob import glob
+import numpy as np
+import xarray as xr
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+
+INTERVAL_CHANGE = np.timedelta64(100, 'ms').astype('timedelta64[ns]').astype('int64')
+
+
+def cache_path(plotsdir, ncfile):
+   return os.path.join(plotsdir, 'ping_times', os.path.basename(ncfile).split('.')[0] + '.npy')
+
+
+def save_ping_times(plotsdir, ncfile, pings):
+   ### ping times are kept as int64 nanoseconds since 1970
+   os.makedirs(os.path.join(plotsdir, 'ping_times'), exist_ok=True)
+   np.save(cache_path(plotsdir, ncfile), pings.astype('datetime64[ns]').view('int64'))
+
+
+def load_ping_times(plotsdir, ncfile):
+   path = cache_path(plotsdir, ncfile)
+   if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(ncfile):
+      return np.load(path)
+   with xr.open_dataset(ncfile, group='Beam') as beam:
+      pings = beam.ping_time.values
+   save_ping_times(plotsdir, ncfile, pings)
+   return pings.astype('datetime64[ns]').view('int64')
+
+
+def find_events(t, fid, dropout=3.0, gap=60.0):
+   ### t: int64 ns ping times of every file concatenated in file order; fid: file number of each ping.
+   ### Returns a dict of event name -> indices into t (the ping that ends the offending interval).
+   d = np.diff(t)
+   same_file = fid[1:] == fid[:-1]
+
+   ### median interval per file, without a python loop: sort the within-file intervals by (file, interval)
+   ### and take the middle element of each file's run
+   d_in = d[same_file]
+   f_in = fid[1:][same_file]
+   nfiles = fid.max() + 1 if len(fid) else 0
+   counts = np.bincount(f_in, minlength=nfiles)
+   order = np.lexsort((d_in, f_in))
+   starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+   median = np.zeros(nfiles, dtype='int64')
+   has = counts > 0
+   median[has] = d_in[order][starts[has] + counts[has] // 2]
+
+   d2 = np.diff(d)
+   same_file2 = same_file[1:] & same_file[:-1]
+   events = {
+      'interval_change': np.where(same_file2 & (np.abs(d2) > INTERVAL_CHANGE))[0] + 2,
+      'dropout': np.where(same_file & (d > dropout * median[fid[1:]]) & (median[fid[1:]] > 0))[0] + 1,
+      'duplicate': np.where(d == 0)[0] + 1,
+      'overlap': np.where(d < 0)[0] + 1,
+      'gap': np.where(~same_file & (d > int(gap * 1e9)))[0] + 1,
+   }
+   return events, d, median
+
+
+def plot_day(day, t, d, events, pngname):
+   fig = Figure(figsize=[11, 4])
+   ax = fig.add_subplot(1, 1, 1)
+   times = t[1:].astype('datetime64[ns]')
+   ax.plot(times, d / 1e9, ',', color='k')
+   colors = {'interval_change': 'tab:blue', 'dropout': 'tab:orange', 'duplicate': 'tab:green', 'overlap': 'tab:red', 'gap': 'tab:purple'}
+   for kind, idx in events.items():
+      if len(idx):
+         ax.plot(t[idx].astype('datetime64[ns]'), d[idx - 1] / 1e9, 'o', color=colors[kind], label=kind + ' (' + str(len(idx)) + ')')
+   ax.set_yscale('symlog')
+   ax.set_ylabel('Ping Intervals (s)')
+   ax.set_title(day)
+   if ax.get_legend_handles_labels()[0]:
+      ax.legend(loc='upper right')
+   fig.tight_layout()
+   fig.savefig(pngname, dpi=120)
+
+
+def report(basedir, cruisename, dropout=3.0, gap=60.0):
+   ncsdir = os.path.join(basedir, cruisename, 'ek60_nc')
+   plotsdir = os.path.join(basedir, cruisename, 'ping_interval')
+   ncfiles = sorted(glob(os.path.join(ncsdir, '*[0-9].nc')))
+
+   ### Build the cruise-wide ping time array
+   per_file = []
+   for ncfile in ncfiles:
+      try:
+         per_file.append(load_ping_times(plotsdir, ncfile))
+      except Exception as e:
+         print('An error occurred: ' + str(e))
+         per_file.append(np.array([], dtype='int64'))
+
+   if not per_file or sum(len(p) for p in per_file) < 2:
+      print("No ping times found")
+      return
+
+   t = np.concatenate(per_file)
+   fid = np.repeat(np.arange(len(per_file)), [len(p) for p in per_file])
+   events, d, median = find_events(t, fid, dropout, gap)
+
+   ### One row per event
+   csvfile = os.path.join(basedir, cruisename, cruisename + '_ping_timing.csv')
+   rows = []
+   for kind, idx in events.items():
+      for k in idx:
+         rows.append([str(t[k].astype('datetime64[ns]')), kind, os.path.basename(ncfiles[fid[k]]), int(k - np.searchsorted(fid, fid[k])), d[k - 1] / 1e9])
+   rows.sort()
+   with open(csvfile, 'w', newline='') as csvfiletowrite:
+      csvwriter = csv.writer(csvfiletowrite, lineterminator='\n', delimiter=',')
+      csvwriter.writerow(['Ping_time', 'Event', 'File_name', 'Ping_index', 'Interval_s'])
+      csvwriter.writerows(rows)
+
+   for kind, idx in events.items():
+      print(kind + ": " + str(len(idx)))
+   print("Saved " + csvfile)
+
+   ### One plot per day
+   days = t.astype('datetime64[ns]').astype('datetime64[D]')
+   for day in np.unique(days):
+      sel = np.where(days == day)[0]
+      lo, hi = sel[0], sel[-1] + 1
+      day_events = {kind: idx[(idx > lo) & (idx < hi)] - lo for kind, idx in events.items()}
+      daystr = 'D' + str(day).replace('-', '')
+      plot_day(daystr, t[lo:hi], d[lo:hi - 1], day_events, os.path.join(plotsdir, daystr + '_ping_timing.png'))
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Cruise-wide ping timing report')
+   parser.add_argument('basedir')
+   parser.add_argument('cruisename')
+   parser.add_argument('--dropout', type=float, default=3.0, help='flag intervals longer than this many times the file median (default: 3)')
+   parser.add_argument('--gap', type=float, default=60.0, help='flag gaps between files longer than this many seconds (default: 60)')
+   args = parser.parse_args()
+   report(args.basedir, args.cruisename, args.dropout, args.gap)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -4,101 +4,40 @@
 10 day ship track plot
        
 e.g., python plot_hake_10days.py /media/paulr/ncei_data/shimada/sh1701/
+
+Each 10-day panel is rendered as its own job (see render_pool.py); --workers N draws N panels at a time, and with
+--shared other hosts plotting the same cruise take some of them (see lease.py).
 """
 
 
 import os
 import sys
-from datetime import datetime as dt
-from glob import glob
-import xarray as xr
-import csv
-import logging
-from echopype.model.ek60 import ModelEK60
-import matplotlib.pyplot as plt
-import matplotlib.figure as figure
-from topomaps import add_etopo2
-import cartopy.crs as ccrs
-import cartopy
-import cartopy.feature as cfeature
-from cartopy.mpl.gridliner import LATITUDE_FORMATTER, LONGITUDE_FORMATTER
-import gc
+import argparse
 import numpy as np
-
-
-allncs = sorted(glob(os.path.join(sys.argv[1], "ek60_nc/*[0-9].nc")))
-
-alldates = []
-
-for i in range(0, len(allncs)):
-    alldates.append(allncs[i].split('-')[-2])
-
-uniqueDates = sorted(set(alldates))
-
-
-dx = dy = 0.25 # Pad lat/lon extent by .25 degrees
-
-for i in range(0, len(uniqueDates), 10):
-   ### just someplace from which to start
-   extent = np.array([-124.74383666666667, -123.798, 43.99783333333333, 44.8765])
-   tenDates = uniqueDates[i:i+10]
-   print(tenDates)
-   for date in tenDates:
-      ### iterate over all the files in this date range to get the global max and min extent 
-      try:
-         nc_files = [j for j in allncs if date in j]
-         nc_plat = xr.open_mfdataset(nc_files, group='Platform', concat_dim='location_time')
-         extent_new = [nc_plat.longitude.values.min() - dx, nc_plat.longitude.values.max() + dx, nc_plat.latitude.values.min() - dy, nc_plat.latitude.values.max() + dy]
-         nc_plat.close()
-         print(extent_new)
-         for i in [0,2]:
-            if extent_new[i] <= extent[i]:
-               extent[i] = extent_new[i]
-         for i in [1,3]:
-            if extent_new[i] >= extent[i]:
-               extent[i] = extent_new[i]
-
-      except Exception as e:
-         print('An error occurred: ' + str(e))
-     
-   
-   ### constrain extent to West Coast lat/ons in case lat/long values are missing, improperly set, or otherwise suspect
-   if extent[0] <= -135:
-      extent[0] = -135    
-
-   if extent[1] >= -117:
-      extent[1] = -117   
-
-   if extent[2] <= 32:
-      extent[2] = 32    
-
-   if extent[3] >= 70:
-      extent[3] = 70 
-
-   # City locations
-   SanDiego = [32.7157, -117.1611]
-   SanMiguelIsland = [34.0376, -120.3724]
-   SanFrancisco = [37.7749, -122.4194]
-   CapeMendocino = [40.4401, -124.4095]
-   CapeBlanco = [42.8376, -124.5640]
-   YaquinaHead = [44.6737, -124.0774]
-   Astoria = [46.1879, -123.8313]
-   NeahBay = [48.3681, -124.6250]
-  
-
-   plt.figure(figsize=[11, 8.5])
-   ax = plt.axes(projection=ccrs.PlateCarree())
+import navstore
+import catalog
+import render_pool
+import runlog
+import lease
+
+
+def render_panel(pngname, cruisedir, tenDates, date_files, extent):
+   ### date_files: the .nc files of each of tenDates, in the same order
+   from matplotlib.figure import Figure
+   from matplotlib.backends.backend_agg import FigureCanvasAgg
+   from matplotlib.lines import Line2D
+   import cartopy.crs as ccrs
+   from basemaps import add_basemap, add_gridlines, add_landmarks
+   from decimate import decimate_track, pixel_tolerance
+
+   nav = navstore.open_store(cruisedir)
+
+   fig = Figure(figsize=[11, 8.5])
+   FigureCanvasAgg(fig)
+   ax = fig.add_subplot(projection=ccrs.PlateCarree())
    ax.set_extent(extent, crs=ccrs.PlateCarree())
-   ax.coastlines(resolution='50m')
-
-   add_etopo2(extent, ax)
-
-   gl = ax.gridlines(crs=ccrs.PlateCarree(), linewidth=1, color='black', alpha=0.2, linestyle='-', draw_labels=True)
-   gl.xlabels_top = False
-   gl.ylabels_right= False
-   gl.xlabel_style = {'rotation': 45}
-   gl.xformatter = LONGITUDE_FORMATTER
-   gl.yformatter = LATITUDE_FORMATTER
+   add_gridlines(ax)
+   nfix = nplot = 0
 
    ### different color every day
    color_list = [
@@ -114,61 +53,121 @@ for i in range(0, len(uniqueDates), 10):
          "#6A3D9A"
    ]
 
+   ### the days' tracks are read first, so the legend is known before the figure is laid out
+   tracks = []
    leglist = []
-   i =0
-  
-   for date in tenDates:
+   for date, nc_files in zip(tenDates, date_files):
       try:
-         nc_files = [i for i in allncs if date in i]
-         ncs = xr.open_mfdataset(nc_files, group='Platform', concat_dim='location_time')
-         ax.plot(ncs.longitude.values, ncs.latitude.values, linewidth=3, color=color_list[i])
+         tracks.append(navstore.track(nav, nc_files))
          leglist.append(date)
-         i = i+1
+
+      except Exception as e:
+         print('An error occurred: ' + str(e))
+
+   ### Lay the figure out first (legend, title, tight_layout), so that the background and the decimation tolerance
+   ### below are sized for the axes as they end up in the PNG
+   ax.legend([Line2D([], [], linewidth=3, color=color_list[i]) for i in range(len(tracks))], leglist,
+             bbox_to_anchor=(1.05, 1), loc='upper left')
+   ax.set_title(os.path.basename(pngname))
+   fig.tight_layout(pad=.25)
+   ax.apply_aspect()
+
+   ### The coastline/bathymetry background is rendered once per snapped extent and reused (see basemaps.py)
+   add_basemap(ax, extent, dpi=120)
+   ### tracks are decimated to half a pixel before plotting (see decimate.py)
+   tol = pixel_tolerance(fig, ax, extent, 120)
+
+   for i, (lon, lat) in enumerate(tracks):
+      nfix += len(lon)
+      lon, lat = decimate_track(lon, lat, tol)
+      nplot += len(lon)
+      ax.plot(lon, lat, linewidth=3, color=color_list[i])
+
+   add_landmarks(ax, extent, dx=0.1)
+
+   print("Saving " + pngname + " (" + str(nplot) + " of " + str(nfix) + " track vertices plotted)")
+   ### saved as laid out (no bbox_inches='tight'), so the axes keep the size the background was rendered at
+   fig.savefig(pngname, dpi=120)
+
+
+def panel_jobs(cruisedir, cat):
+   ### Render jobs (see render_pool.py), one per 10 days of the cruise
+   from basemaps import snap_extent
+
+   fileDates = catalog.day_of(cat)
+   uniqueDates = sorted(set(fileDates))
+
+   dx = dy = 0.25 # Pad lat/lon extent by .25 degrees
+
+   jobs = []
+   for i in range(0, len(uniqueDates), 10):
+      ### just someplace from which to start
+      extent = np.array([-124.74383666666667, -123.798, 43.99783333333333, 44.8765])
+      tenDates = uniqueDates[i:i+10]
+      print(tenDates)
+      ### global max and min extent of all the files in this date range
+      try:
+         extent_new = catalog.extent(cat, np.isin(fileDates, tenDates), dx, dy)
+         print(extent_new)
+         if extent_new is None:
+            print("No navigation fixes for " + tenDates[0] + "-" + tenDates[-1] + "; skipping its ship track")
+            continue
+         for k in [0,2]:
+            if extent_new[k] <= extent[k]:
+               extent[k] = extent_new[k]
+         for k in [1,3]:
+            if extent_new[k] >= extent[k]:
+               extent[k] = extent_new[k]
 
       except Exception as e:
          print('An error occurred: ' + str(e))
      
-   ### add locations of interest/landmarks if they are nearby      
-   if (extent[2] <= SanDiego[0] <= extent[3]) and (extent[0] <= SanDiego[1] <= extent[1]):
-      tt_SanDiego = ax.plot(SanDiego[1], SanDiego[0], marker='o', color='k')
-      tt_SanDiego = ax.text(x=SanDiego[1] + 0.1, y=SanDiego[0], s='San Diego', fontsize=18)
-
-   if (extent[2] <= SanMiguelIsland[0] <= extent[3]) and (extent[0] <= SanMiguelIsland[1] <= extent[1]):
-      tt_SanMiguelIsland = ax.plot(SanMiguelIsland[1], SanMiguelIsland[0], marker='o', color='k')
-      tt_SanMiguelIsland = ax.text(x=SanMiguelIsland[1] + 0.1, y=SanMiguelIsland[0], s='San Miguel Island', fontsize=18)
-
-   if (extent[2] <= SanFrancisco[0] <= extent[3]) and (extent[0] <= SanFrancisco[1] <= extent[1]):
-      tt_SanFrancisco = ax.plot(SanFrancisco[1], SanFrancisco[0], marker='o', color='k')
-      tt_SanFrancisco = ax.text(x=SanFrancisco[1] + 0.1, y=SanFrancisco[0], s='San Francisco', fontsize=18)
-
-   if (extent[2] <= CapeMendocino[0] <= extent[3]) and (extent[0] <= CapeMendocino[1] <= extent[1]):
-      tt_CapeMendocino = ax.plot(CapeMendocino[1], CapeMendocino[0], marker='o', color='k')
-      tt_CapeMendocino = ax.text(x=CapeMendocino[1] + 0.1, y=CapeMendocino[0], s='Cape Mendocino', fontsize=18)
-
-   if (extent[2] <= CapeBlanco[0] <= extent[3]) and (extent[0] <= CapeBlanco[1] <= extent[1]):
-      tt_CapeBlanco = ax.plot(CapeBlanco[1], CapeBlanco[0], marker='o', color='k')
-      tt_CapeBlanco = ax.text(x=CapeBlanco[1] + 0.1, y=CapeBlanco[0], s='Cape Blanco', fontsize=18)
-
-   if (extent[2] <= YaquinaHead[0] <= extent[3]) and (extent[0] <= YaquinaHead[1] <= extent[1]):
-      tt_YaquinaHead = ax.plot(YaquinaHead[1], YaquinaHead[0], marker='o', color='k')
-      tt_YaquinaHead = ax.text(x=YaquinaHead[1] + 0.1, y=YaquinaHead[0], s='Yaquina Head', fontsize=18)
-
-   if (extent[2] <= Astoria[0] <= extent[3]) and (extent[0] <= Astoria[1] <= extent[1]):
-      tt_Astoria = ax.plot(Astoria[1], Astoria[0], marker='o', color='k')
-      tt_Astoria = ax.text(x=Astoria[1] + 0.1, y=Astoria[0], s='Columbia River', fontsize=18)
-
-   if (extent[2] <= NeahBay[0] <= extent[3]) and (extent[0] <= NeahBay[1] <= extent[1]):
-       tt_NeahBay = ax.plot(NeahBay[1], NeahBay[0], marker='o', color='k')
-       tt_NeahBay = ax.text(x=NeahBay[1] + 0.1, y=NeahBay[0], s='Neah Bay', fontsize=18)
-
-
-   ax.legend(leglist, bbox_to_anchor=(1.05, 1), loc='upper left')
-   pngname = os.path.join(sys.argv[1], 'ship_track_10day/') + tenDates[0] + "-" + tenDates[-1] + '_shiptrack.png'
-   print("Saving " + pngname)
-   plt.title(os.path.basename(pngname))
-   plt.tight_layout(pad=.25)
-   plt.savefig(pngname, dpi=120, bbox_inches='tight', pad_inches=.25)
-   plt.clf() 
-   plt.close()
-   gc.collect()
+   
+      ### constrain extent to West Coast lat/ons in case lat/long values are missing, improperly set, or otherwise suspect
+      if extent[0] <= -135:
+         extent[0] = -135    
+
+      if extent[1] >= -117:
+         extent[1] = -117   
+
+      if extent[2] <= 32:
+         extent[2] = 32    
+
+      if extent[3] >= 70:
+         extent[3] = 70 
+
+      extent = snap_extent(extent)
+
+      date_files = [catalog.files(cat, cruisedir, fileDates == date) for date in tenDates]
+      pngname = os.path.join(cruisedir, 'ship_track_10day/') + tenDates[0] + "-" + tenDates[-1] + '_shiptrack.png'
+      jobs.append((render_panel, (pngname, cruisedir, tenDates, date_files, extent)))
+   return jobs
+
+
+def main():
+   parser = argparse.ArgumentParser(description='10 day ship track plots for a whole cruise')
+   parser.add_argument('cruisedir')
+   parser.add_argument('--workers', type=int, default=1, help='number of rendering processes (default: 1)')
+   parser.add_argument('--max-memory', type=int, default=0, metavar='MB', help='cap on each rendering process\'s address space, not its RSS; allow a few times what a figure needs (default: none)')
+   parser.add_argument('--shared', action='store_true', help='cooperate with other hosts plotting the same cruise (see lease.py)')
+   args = parser.parse_args()
+   if args.shared:
+      lease.enable()
+
+   runlog.start(args.cruisedir)
+
+   ### Navigation comes from the cruise-wide store (see navstore.py); only files not stored yet are opened.
+   ### Files and extents come from the catalog (see catalog.py); days are the DYYYYMMDD in the file names, as for the daily plots.
+   with runlog.measure('navigation'):
+      navstore.update(args.cruisedir)
+      cat = catalog.load(args.cruisedir)
+   with runlog.measure('plot'):
+      failed = render_pool.run(panel_jobs(args.cruisedir, cat), args.workers, args.max_memory)
+   runlog.finish()
+   if failed:
+      sys.exit(1)
+
+
 
+if __name__ == '__main__':
+    main()
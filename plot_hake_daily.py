@@ -10,19 +10,24 @@ NOTE: THIS SCRIPT ASSUMES THE FOLLOWING SUBDIRECTORIES (see raw2netCDF.py):
                        /ship_track_01day/
                        /ship_track_10day/
 
-example usage: python plot_hake_daily.py [/path/to/data/basedir] D[YearMonthDay] 
+example usage: python plot_hake_daily.py [/path/to/data/basedir] D[YearMonthDay] [D[YearMonthDay] ...]
 example usage: python plot_hake_daily.py /media/paulr/ncei_data/shimada/sh1701/ D20170720
+example usage: python plot_hake_daily.py /media/paulr/ncei_data/shimada/sh1701/ D20170720 D20170721 D20170722
+example usage: python plot_hake_daily.py /media/paulr/ncei_data/shimada/sh1701/ all
 
-To generate a list of unique days in BASH:
-   $ cd /media/paulr/ncei_data/shimada/sh1701/ek60_nc/
-   $ days=(`ls | awk -F"-" '{print $2}' | sort | uniq`)
-   $ cd ~/Programming/echopype
+Any number of days can be given, or "all" for every day found in ek60_nc/. Doing many days in one process (rather
+than one process per day in a loop) pays for importing echopype/xarray/matplotlib/cartopy, reading the navigation
+store and loading the catalog only once. The heavy imports are deferred until there is something to plot, and the
+startup, import, navigation and plotting times go to the run log (see runlog.py), summarized at the end.
 
-Then just wrap this in a loop:
-   $ for day in ${days[*]}; do
-   $   python plot_hake_daily.py /media/paulr/ncei_data/shimada/sh1701/ ${day}   
-   $ done
+Each echogram and ship track PNG is an independent render job on its own Agg figure (see render_pool.py), so with
+--workers N they are drawn N at a time, across all the days given. --max-memory caps each rendering process, and
+Sv is read out of core in blocks sized to fit under it (see lazy_sv.py), so a long day needs no more memory than a
+short one.
 
+Use --only echogram or --only tracks to make just one kind of plot, and --echogram-mode max to draw the strongest
+sample in each echogram pixel rather than the mean. With --shared, several hosts can plot the same
+cruise at once and split the figures (and any calibration) between them (see lease.py).
 
 This script will automagically determine if there are more than 10 files for a day and create a plot per 10 files, or all if fewer.
                
@@ -31,72 +36,173 @@ This script will automagically determine if there are more than 10 files for a d
 
 import os
 import sys
-from datetime import datetime as dt
+import time
+import argparse
 from glob import glob
-import xarray as xr
-import csv
-import logging
-from echopype.model.ek60 import ModelEK60
-import matplotlib.pyplot as plt
-import matplotlib.figure as figure
-from topomaps import add_etopo2
-import cartopy.crs as ccrs
-import cartopy
-import cartopy.feature as cfeature
-from cartopy.mpl.gridliner import LATITUDE_FORMATTER, LONGITUDE_FORMATTER
-import gc
+from hake_utils import cruise_days
+import render_pool
+import runlog
+import lease
 
-def main():
-   basedir = sys.argv[1]
+T_START = time.perf_counter()
+
+
+def load_plotting(only=None):
+   ### Import the plotting stack up front (it is cached for the rest of the process)
+   if only != 'tracks':
+      import calibrate_hake, echogram
+   if only != 'echogram':
+      import matplotlib.figure, cartopy.crs, basemaps, navstore, catalog, decimate
+
+
+def stem(f):
+   return os.path.basename(f).split('.')[0].split('_Sv')[0]
+
+
+def wanted(chunk, changed):
+   ### with changed given (a collection of .nc files), only the 10-file plots containing one of them are redrawn
+   if changed is None:
+      return True
+   changed = set(stem(c) for c in changed)
+   return any(stem(f) in changed for f in chunk)
+
+
+def drop_stale(pngname, pattern):
+   ### a plot whose chunk has since grown was saved under its old last file; remove it once the new one is written
+   for old in glob(pattern):
+      if old != pngname:
+         os.remove(old)
+
+
+def render_echogram_chunk(pngname, Sv_chunk, title, max_memory_mb, mode='mean'):
+   from echogram import render_echogram
+   ### Sv is binned onto the output pixels a block of pings at a time, then drawn as an image (see echogram.py)
+   render_echogram(Sv_chunk, pngname, title, mode=mode, max_memory_mb=max_memory_mb)
+   drop_stale(pngname, os.path.join(os.path.dirname(pngname), stem(Sv_chunk[0]) + '-*-echo.png'))
+
+
+def echogram_jobs(basedir, files_date, changed=None, workers=1, max_memory_mb=0, mode='mean'):
+   ### Render jobs (see render_pool.py) for the day's echograms. Sv is read in blocks sized to a quarter of
+   ### max_memory_mb, leaving the rest for the figure and libraries (see lazy_sv.py). Each pixel shows the mean Sv
+   ### of the samples in it, or with mode='max' the largest, so thin strong targets survive.
+   from calibrate_hake import calibrate_files
+   from lazy_sv import DEFAULT_MEMORY_MB
    path_to_files = os.path.join(basedir, 'ek60_nc')
-   files_date = sys.argv[2]
 
    ###### Echograms
    ### best to use calibrated files
    nc_files = sorted(glob(os.path.join(path_to_files, '*' + files_date + '*[0-9].nc')))
-   for nc_file in nc_files:
-      if os.path.exists(nc_file.split('.')[0] + '_Sv.nc'):
-         print("Calibration already completed for" + nc_file)
-      else:
-         nc = ModelEK60(nc_file)
-         nc.calibrate(save=True)
+   ### (see calibrate_hake.py, which can also do the whole cruise up front, in parallel)
+   calibrate_files(nc_files, os.path.join(basedir, 'ek60_convert_error'), workers)
  
    Sv_files = sorted(glob(os.path.join(path_to_files, '*' + files_date + '*Sv.nc')))
-   print("Plotting echograms...")
 
    ### plots will be concatenations of 10 files at most; each has 3 frequencies
+   jobs = []
    for i in range(0, len(Sv_files), 10):
       Sv_chunk = Sv_files[i:i+10]
+      if not wanted(Sv_chunk, changed):
+         continue
       lastfile = os.path.basename(Sv_chunk[-1]).split('-')[2].split('_')[0]
       pngname = os.path.join(basedir, 'echogram', os.path.basename(Sv_chunk[0]).split('_')[0] + '-' + lastfile + '-echo.png')
-      Sv = xr.open_mfdataset(Sv_files[i:i+10], combine='by_coords')
-      plt.figure(figsize=[11, 8.5])
-      plt.subplot(3, 1, 1)
-      Sv.Sv.sel(frequency=18000).plot(vmax=-40, vmin=-100, cmap='Spectral_r', x='ping_time')
-      plt.gca().invert_yaxis()
-      plt.title(files_date + '  (frequency=18000)')
-      plt.subplot(3, 1, 2)
-      Sv.Sv.sel(frequency=38000).plot(vmax=-40, vmin=-100, cmap='Spectral_r', x='ping_time')
-      plt.gca().invert_yaxis()
-      plt.title(files_date + '  (frequency=38000)')
-      plt.subplot(3, 1, 3)
-      Sv.Sv.sel(frequency=120000).plot(vmax=-40, vmin=-100, cmap='Spectral_r', x='ping_time')
-      plt.gca().invert_yaxis()
-      plt.title(files_date + '  (frequency=120000)')
-      plt.tight_layout() 
-      plt.savefig(pngname, dpi=120)
-      plt.clf()
-      plt.close()
-      gc.collect()
+      jobs.append((render_echogram_chunk, (pngname, Sv_chunk, files_date, max_memory_mb // 4 or DEFAULT_MEMORY_MB, mode)))
+   return jobs
+
+
+def update_nav(basedir, days):
+   ### Bring the navigation store up to date for the given days, then load the catalog once for all of them
+   import navstore
+   import catalog
+   nc_files = sorted(set(f for day in days for f in glob(os.path.join(basedir, 'ek60_nc', '*' + day + '*[0-9].nc'))))
+   navstore.update(basedir, nc_files)
+   return catalog.load(basedir)
+
+
+def render_track_chunk(pngname, basedir, ncs_chunk, extent):
+   from matplotlib.figure import Figure
+   from matplotlib.backends.backend_agg import FigureCanvasAgg
+   from matplotlib.lines import Line2D
+   import cartopy.crs as ccrs
+   import navstore
+   from basemaps import add_basemap, add_gridlines, add_landmarks
+   from decimate import decimate_track, pixel_tolerance
+
+   ### the store is memory-mapped, so opening it in each job is cheap
+   nav = navstore.open_store(basedir)
+   fig = Figure(figsize=[8.5, 11])
+   FigureCanvasAgg(fig)
+
+   ### Use PlateCarree projection (see https://scitools.org.uk/cartopy/docs/latest/crs/projections.html for details)
+   ax = fig.add_subplot(projection=ccrs.PlateCarree())
+   ax.set_extent(extent, crs=ccrs.PlateCarree())
+   add_gridlines(ax)
+   nfix = nplot = 0
  
+   color_list = [
+      "#A6CEE3",
+      "#1F78B4",
+      "#B2DF8A",
+      "#33A02C",
+      "#FB9A99",
+      "#E31A1C",
+      "#FDBF6F",
+      "#FF7F00",
+      "#CAB2D6",
+      "#6A3D9A"
+   ]
+
+   leglist = [os.path.basename(nc) for nc in ncs_chunk]
+
+   ### Lay the figure out first (legend, title, tight_layout), so that the background and the decimation tolerance
+   ### below are sized for the axes as they end up in the PNG
+   ax.legend([Line2D([], [], linewidth=3, color=color_list[j]) for j in range(len(ncs_chunk))], leglist,
+             bbox_to_anchor=(.22, -.2), loc='upper left')
+   ax.set_title(os.path.basename(pngname))
+   fig.tight_layout(pad=.25)
+   ax.apply_aspect()
+
+   ### The coastline/bathymetry background is rendered once per snapped extent and reused (see basemaps.py)
+   add_basemap(ax, extent, dpi=120)
+   ### tracks are decimated to half a pixel before plotting (see decimate.py)
+   tol = pixel_tolerance(fig, ax, extent, 120)
+
+   ### plot the tracks
+   for j in range(0, len(ncs_chunk)):
+      lon, lat = navstore.track(nav, [ncs_chunk[j]])
+      nfix += len(lon)
+      lon, lat = decimate_track(lon, lat, tol)
+      nplot += len(lon)
+      ax.plot(lon, lat, linewidth=3, color=color_list[j])
+
+   add_landmarks(ax, extent, dx=0.03)
+
+   print("Saving " + pngname + " (" + str(nplot) + " of " + str(nfix) + " track vertices plotted)")
+   ### saved as laid out (no bbox_inches='tight'), so the axes keep the size the background was rendered at
+   fig.savefig(pngname, dpi=120)
+   drop_stale(pngname, os.path.join(os.path.dirname(pngname), stem(ncs_chunk[0]) + '-*_shiptrack.png'))
+
+
+def track_jobs(basedir, files_date, cat, changed=None):
+   ### Render jobs (see render_pool.py) for the day's ship tracks
+   import numpy as np
+   import catalog
+   from basemaps import snap_extent
 
    ##### Ship tracks
-   print("Plotting ship tracks for " + files_date)
-   for i in range(0, len(nc_files), 10):
-      nc_plat = xr.open_mfdataset(nc_files, group='Platform', concat_dim='location_time')
-      dx = dy = 0.25 # Pad each lat/long extent by .25 degrees
-      extent = [nc_plat.longitude.values.min() - dx, nc_plat.longitude.values.max() + dx, nc_plat.latitude.values.min() - dy, nc_plat.latitude.values.max() + dy]
-      nc_plat.close() 
+   ### Navigation comes from the cruise-wide store (see navstore.py), and the day's files and each chunk's extent
+   ### from the catalog (see catalog.py); update_nav() brings both up to date.
+   day_idx = np.where(catalog.day_mask(cat, files_date))[0]
+   track_files = catalog.files(cat, basedir, day_idx)
+   jobs = []
+   for i in range(0, len(track_files), 10):
+      if not wanted(track_files[i:i+10], changed):
+         continue
+      chunk = np.zeros(len(cat['name']), dtype=bool)
+      chunk[day_idx[i:i+10]] = True
+      extent = catalog.extent(cat, chunk, dx=0.25, dy=0.25) # Pad each lat/long extent by .25 degrees
+      if extent is None:
+         print("No navigation fixes in " + os.path.basename(track_files[i]) + " to " + os.path.basename(track_files[i:i+10][-1]) + "; skipping their ship track")
+         continue
       ### constrain extent to West Coast lat/lons in case lat/long values are missing, improperly set, or otherwise suspect
       if extent[0] <= -135:
          extent[0] = -135    
@@ -110,97 +216,62 @@ def main():
       if extent[3] >= 70:
          extent[3] = 70 
 
-      # City locations
-      SanDiego = [32.7157, -117.1611]
-      SanMiguelIsland = [34.0376, -120.3724]
-      SanFrancisco = [37.7749, -122.4194]
-      CapeMendocino = [40.4401, -124.4095]
-      CapeBlanco = [42.8376, -124.5640]
-      YaquinaHead = [44.6737, -124.0774]
-      Astoria = [46.1879, -123.8313]
-      NeahBay = [48.3681, -124.6250]
-      
-      plt.figure(figsize=[8.5, 11], tight_layout=True)
-
-      ### Use PlateCarree projection (see https://scitools.org.uk/cartopy/docs/latest/crs/projections.html for details)
-      ax = plt.axes(projection=ccrs.PlateCarree())
-      ax.set_extent(extent, crs=ccrs.PlateCarree())
-      ax.coastlines(resolution='50m')
-      #ax.add_feature(cartopy.feature.OCEAN)
-      add_etopo2(extent, ax)
-
-      gl = ax.gridlines(crs=ccrs.PlateCarree(), linewidth=1, color='black', alpha=0.2, linestyle='-', draw_labels=True)
-      gl.xlabels_top = False
-      gl.ylabels_right= False
-      gl.xlabel_style = {'rotation': 45}
-      gl.xformatter = LONGITUDE_FORMATTER
-      gl.yformatter = LATITUDE_FORMATTER
- 
-      color_list = [
-         "#A6CEE3",
-         "#1F78B4",
-         "#B2DF8A",
-         "#33A02C",
-         "#FB9A99",
-         "#E31A1C",
-         "#FDBF6F",
-         "#FF7F00",
-         "#CAB2D6",
-         "#6A3D9A"
-      ]
-
-      ncs_chunk = nc_files[i:i+10]
-      leglist = []
-      
-      ### plot the track and populate the legend
-      for i in range(0, len(ncs_chunk)):
-         ncs = xr.open_dataset(ncs_chunk[i], group='Platform')
-         ax.plot(ncs.longitude.values, ncs.latitude.values, linewidth=3, color=color_list[i])
-         leglist.append(os.path.basename(ncs_chunk[i]))
-
-      ### add locations of interest/landmarks if they are nearby
-      if (extent[2] <= SanDiego[0] <= extent[3]) and (extent[0] <= SanDiego[1] <= extent[1]):
-         tt_SanDiego = ax.plot(SanDiego[1], SanDiego[0], marker='o', color='k')
-         tt_SanDiego = ax.text(x=SanDiego[1] + 0.03, y=SanDiego[0], s='San Diego', fontsize=18)
-
-      if (extent[2] <= SanMiguelIsland[0] <= extent[3]) and (extent[0] <= SanMiguelIsland[1] <= extent[1]):
-         tt_SanMiguelIsland = ax.plot(SanMiguelIsland[1], SanMiguelIsland[0], marker='o', color='k')
-         tt_SanMiguelIsland = ax.text(x=SanMiguelIsland[1] + 0.03, y=SanMiguelIsland[0], s='San Miguel Island', fontsize=18)
-
-      if (extent[2] <= SanFrancisco[0] <= extent[3]) and (extent[0] <= SanFrancisco[1] <= extent[1]):
-         tt_SanFrancisco = ax.plot(SanFrancisco[1], SanFrancisco[0], marker='o', color='k')
-         tt_SanFrancisco = ax.text(x=SanFrancisco[1] + 0.03, y=SanFrancisco[0], s='San Francisco', fontsize=18)
-
-      if (extent[2] <= CapeMendocino[0] <= extent[3]) and (extent[0] <= CapeMendocino[1] <= extent[1]):
-         tt_CapeMendocino = ax.plot(CapeMendocino[1], CapeMendocino[0], marker='o', color='k')
-         tt_CapeMendocino = ax.text(x=CapeMendocino[1] + 0.03, y=CapeMendocino[0], s='Cape Mendocino', fontsize=18)
-
-      if (extent[2] <= CapeBlanco[0] <= extent[3]) and (extent[0] <= CapeBlanco[1] <= extent[1]):
-         tt_CapeBlanco = ax.plot(CapeBlanco[1], CapeBlanco[0], marker='o', color='k')
-         tt_CapeBlanco = ax.text(x=CapeBlanco[1] + 0.03, y=CapeBlanco[0], s='Cape Blanco', fontsize=18)
-
-      if (extent[2] <= YaquinaHead[0] <= extent[3]) and (extent[0] <= YaquinaHead[1] <= extent[1]):
-         tt_YaquinaHead = ax.plot(YaquinaHead[1], YaquinaHead[0], marker='o', color='k')
-         tt_YaquinaHead = ax.text(x=YaquinaHead[1] + 0.03, y=YaquinaHead[0], s='Yaquina Head', fontsize=18)
-
-      if (extent[2] <= Astoria[0] <= extent[3]) and (extent[0] <= Astoria[1] <= extent[1]):
-         tt_Astoria = ax.plot(Astoria[1], Astoria[0], marker='o', color='k')
-         tt_Astoria = ax.text(x=Astoria[1] + 0.03, y=Astoria[0], s='Columbia River', fontsize=18)
-
-      if (extent[2] <= NeahBay[0] <= extent[3]) and (extent[0] <= NeahBay[1] <= extent[1]):
-          tt_NeahBay = ax.plot(NeahBay[1], NeahBay[0], marker='o', color='k')
-          tt_NeahBay = ax.text(x=NeahBay[1] + 0.03, y=NeahBay[0], s='Neah Bay', fontsize=18)
-      
-      ax.legend(leglist, bbox_to_anchor=(.22, -.2), loc='upper left')
+      extent = snap_extent(extent)
+
+      ncs_chunk = track_files[i:i+10]
       lastfile = os.path.basename(ncs_chunk[-1]).split('-')[2].split('.')[0]
-      pngname = os.path.join(basedir, 'ship_track_01day', os.path.basename(ncs_chunk[i]).split('.')[0] + '-' + lastfile + '_shiptrack.png')
-      plt.title(os.path.basename(pngname))
-      plt.tight_layout(pad=.25)
-      print("Saving " + pngname)
-      plt.savefig(pngname, dpi=120, bbox_inches='tight', pad_inches=.25)
-      plt.clf() 
-      plt.close()
-      gc.collect()
+      pngname = os.path.join(basedir, 'ship_track_01day', os.path.basename(ncs_chunk[0]).split('.')[0] + '-' + lastfile + '_shiptrack.png')
+      jobs.append((render_track_chunk, (pngname, basedir, ncs_chunk, extent)))
+   return jobs
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Daily echograms and ship tracks')
+   parser.add_argument('basedir', help='cruise directory')
+   parser.add_argument('days', nargs='+', help='DYYYYMMDD (any number of them), or "all" for every day in ek60_nc')
+   parser.add_argument('--only', choices=['echogram', 'tracks'], help='make just the echograms or just the ship tracks')
+   parser.add_argument('--workers', type=int, default=1, help='number of rendering (and calibration) processes (default: 1)')
+   parser.add_argument('--max-memory', type=int, default=0, metavar='MB', help='cap on each rendering process\'s address space (not RSS, see render_pool.py); Sv is read in blocks of a quarter of it (default: no cap, 256 MB blocks)')
+   parser.add_argument('--echogram-mode', choices=['mean', 'max'], default='mean', help='what each echogram pixel shows of the samples in it (default: mean)')
+   parser.add_argument('--shared', action='store_true', help='cooperate with other hosts plotting the same cruise (see lease.py)')
+   args = parser.parse_args()
+   if args.shared:
+      lease.enable()
+   runlog.start(args.basedir)
+   runlog.record('startup', wall_s=time.perf_counter() - T_START)
+
+   failed = 0
+   try:
+      if 'all' in args.days:
+         days = cruise_days(os.path.join(args.basedir, 'ek60_nc'))
+      else:
+         days = sorted(set(args.days))
+      if not days:
+         print("No days to plot in " + os.path.join(args.basedir, 'ek60_nc'))
+         return
+
+      with runlog.measure('imports'):
+         load_plotting(args.only)
+      if args.only != 'echogram':
+         with runlog.measure('navigation'):
+            cat = update_nav(args.basedir, days)
+
+      ### every figure of every day goes into one list of jobs, rendered together by the pool
+      with runlog.measure('plot'):
+         jobs = []
+         for day in days:
+            if args.only != 'tracks':
+               jobs += echogram_jobs(args.basedir, day, workers=args.workers, max_memory_mb=args.max_memory, mode=args.echogram_mode)
+            if args.only != 'echogram':
+               jobs += track_jobs(args.basedir, day, cat)
+         failed = render_pool.run(jobs, args.workers, args.max_memory)
+
+      print("Plotted %d day(s)" % len(days))
+   finally:
+      runlog.finish()
+   if failed:
+      sys.exit(1)
+
 
 if __name__ == '__main__':
     main()
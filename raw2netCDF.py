@@ -6,22 +6,174 @@ NOTE: .raw files must be in a folder called 'ek60_raw', just below the cruise di
 
 example: python raw2netCDF.py /media/paulr/ncei_data/shimada/ sh1707
 
+Progress is kept in [cruise]/[cruise]_convert_manifest.json (see conversion_manifest.py), so a rerun only converts
+new or changed .raw files. To see what is left without converting anything:
+example: python raw2netCDF.py /media/paulr/ncei_data/shimada/ sh1707 --status
+
+To spread the conversions over several processes (one .raw file per process at a time):
+example: python raw2netCDF.py /media/paulr/ncei_data/shimada/ sh1707 --workers 8
+
+With --layout chunked the .nc files are written chunked along ping_time and compressed (see nc_layout.py).
+
+Several hosts can convert the same cruise at once over a shared mount with --shared (see lease.py): each .raw file
+is leased by the host converting it, and the manifest is rechecked under the lease and updated one entry at a time,
+so no file is converted twice and no host overwrites another's manifest entries.
+example: python raw2netCDF.py /mnt/ncei_data/shimada/ sh1707 --workers 8 --shared    (on each host)
+
 """
 
 
 import os
-import sys
-from datetime import datetime as dt
-import xarray as xr
-import csv
-import logging
+import argparse
 from glob import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import echopype
+import runlog
+import lease
+from hake_utils import log_error
+import nc_layout
+from conversion_manifest import manifest_path, load_manifest, save_manifest, sha1sum, scan_raw, is_current, make_entry
+
+
+def convert_file(rfile, ncsdir, errsdir, layout='default', held=None):
+   ### Convert a single .raw file and move its output(s) to ncsdir. Returns (list of .nc files created, success).
+   ### With layout='chunked' the outputs are rewritten chunked along ping_time and compressed (see nc_layout.py).
+   ### Only files named after this .raw file are ever moved, so concurrent workers never race on each other's outputs.
+   ### If `held` (the file's lease, in shared mode) has been lost by the time the outputs are ready, they are
+   ### deleted instead of moved and LeaseLost is raised.
+   rawdir = os.path.dirname(rfile)
+   filebase = os.path.splitext(os.path.basename(rfile))[0]
+   with runlog.measure('convert', rfile) as m:
+      try:
+         tmp = echopype.convert.ConvertEK60(rfile)
+         tmp.raw2nc()
+         del tmp
+         ### the above may output multiple files in the case of parameter changes
+         ncs_created = sorted(glob(os.path.join(rawdir, filebase + '*.nc')))
+         if held is not None:
+            try:
+               held.check()
+            except lease.LeaseLost:
+               for nc in ncs_created:
+                  os.remove(nc)
+               raise
+         ### move .nc(s) from ek60_raw to ek60_nc; os.replace is atomic on the same filesystem
+         ncs_moved = []
+         for nc in ncs_created:
+            if layout == 'chunked':
+               nc_layout.rewrite(nc)
+            dest = os.path.join(ncsdir, os.path.basename(nc))
+            os.replace(nc, dest)
+            ncs_moved.append(dest)
+
+         ### a successful (re)conversion supersedes any earlier failure
+         errlog = os.path.join(errsdir, filebase + '-error-log.txt')
+         if os.path.exists(errlog):
+            os.remove(errlog)
+
+         return ncs_moved, True
+
+      except lease.LeaseLost as e:
+         m['ok'], m['error'] = False, str(e)
+         raise
+      except Exception as e:
+         print('An error occurred: ' + str(e))
+         m['ok'], m['error'] = False, str(e)
+         log_error(os.path.join(errsdir, filebase + '-error-log.txt'), rfile + "  Conversion Error")
+         return [], False
+
+
+def remove_outputs(ncsdir, entry):
+   ### clear out anything a previous conversion of a changed file left behind: its .nc files, their calibrated _Sv.nc
+   ### and the daily echograms and ship tracks that start with them (which are redrawn from the new files)
+   cruisedir = os.path.dirname(os.path.normpath(ncsdir))
+   for old in (entry or {}).get('outputs', []):
+      stem = old.split('.')[0]
+      stale = [os.path.join(ncsdir, old), os.path.join(ncsdir, stem + '_Sv.nc')]
+      stale += glob(os.path.join(cruisedir, 'echogram', stem + '-*-echo.png'))
+      stale += glob(os.path.join(cruisedir, 'ship_track_01day', stem + '-*_shiptrack.png'))
+      for path in stale:
+         if os.path.exists(path):
+            os.remove(path)
+
+
+def update_manifest(manifest_file, name, entry):
+   ### Read, update and write back one entry under the manifest's lease, so hosts sharing the cruise keep each other's entries
+   with lease.hold(os.path.dirname(manifest_file), 'manifest') as held:
+      manifest = load_manifest(manifest_file)
+      manifest[name] = entry
+      held.check()
+      save_manifest(manifest, manifest_file)
+
+
+def convert_claimed(job):
+   ### Worker entry point for --shared: job is ((name, path, size, mtime, sha1), ncsdir, errsdir, layout, manifest_file,
+   ### planned entry, echopype version). Converts the file if this process gets its lease and its manifest entry is
+   ### still the one planned against (otherwise another host has dealt with it since), and records the result before
+   ### letting the lease go. Returns True if the file was converted here; if the lease is lost on the way, nothing is
+   ### committed and the file is left to the host that took it.
+   (name, path, size, mtime, sha1), ncsdir, errsdir, layout, manifest_file, planned, version = job
+   with lease.claim(os.path.dirname(manifest_file), 'convert-' + name) as mine:
+      if not mine:
+         print(path + " is being converted by another host")
+         return False
+      entry = load_manifest(manifest_file).get(name)
+      if entry != planned:
+         print(path + " was converted by another host")
+         return False
+      try:
+         remove_outputs(ncsdir, entry)
+         outputs, ok = convert_file(path, ncsdir, errsdir, layout, held=mine)
+         mine.check()
+         update_manifest(manifest_file, name, make_entry(path, size, mtime, sha1, outputs, version, 'converted' if ok else 'error'))
+      except lease.LeaseLost as e:
+         print(str(e) + "; not committing " + path)
+         return False
+      return True
+
+
+def plan_conversions(manifest, raws, ncs_present, use_hash=False, retry_errors=False):
+   ### Compare ek60_raw against the manifest. Returns a list of (name, path, size, mtime, sha1) still to convert;
+   ### files converted before the manifest existed are adopted into it as they are.
+   todo = []
+   for name in sorted(raws):
+      path, size, mtime = raws[name]
+      stem = os.path.splitext(name)[0]
+      sha1 = sha1sum(path) if use_hash else None
+      entry = manifest.get(name)
+      if entry is None and stem + '.nc' in ncs_present:
+         outputs = sorted(n for n in ncs_present if n.startswith(stem) and not n.endswith('_Sv.nc'))
+         manifest[name] = make_entry(path, size, mtime, sha1, outputs, 'unknown', 'converted')
+         continue
+
+      if is_current(entry, size, mtime, sha1):
+         if entry['status'] == 'converted' and all(o in ncs_present for o in entry['outputs']):
+            continue
+         if entry['status'] == 'error' and not retry_errors:
+            continue
+
+      todo.append((name, path, size, mtime, sha1))
+
+   return todo
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Convert EK60 .raw files to netCDF')
+   parser.add_argument('basedir')
+   parser.add_argument('cruisename')
+   parser.add_argument('--workers', type=int, default=1, help='number of conversion processes (default: 1)')
+   parser.add_argument('--hash', action='store_true', help='also fingerprint each .raw file by its sha1 (reads every file)')
+   parser.add_argument('--retry-errors', action='store_true', help='retry files that failed before, even if unchanged')
+   parser.add_argument('--status', action='store_true', help='report what is left to convert, then exit')
+   parser.add_argument('--layout', choices=['default', 'chunked'], default='default', help='chunked: chunk along ping_time and compress the outputs (see nc_layout.py)')
+   parser.add_argument('--shared', action='store_true', help='cooperate with other hosts converting the same cruise (see lease.py)')
+   args = parser.parse_args()
+   if args.shared:
+      lease.enable()
 
-def main():  
    ### Organize files
-   basedir = sys.argv[1]
-   cruisename = sys.argv[2]
+   basedir = args.basedir
+   cruisename = args.cruisename
 
    dirs = ['echogram', 'ek60_convert_error', 'ek60_nc', 'ping_interval', 'ship_track_01day', 'ship_track_10day']
    for subdir in dirs:
@@ -30,32 +182,65 @@ def main():
       except OSError as error:
          print(error)
 
-   rawfiles = sorted(glob(os.path.join(basedir, cruisename, 'ek60_raw', '*raw')))
+   rawdir = os.path.join(basedir, cruisename, 'ek60_raw')
    ncsdir = os.path.join(basedir, cruisename, 'ek60_nc')
-   ### Iterate over all the .RAW files and convert them.
-   for rfile in rawfiles:
-      try:
-         if not os.path.exists(os.path.join(ncsdir, os.path.basename(rfile).split('.')[0] + '.nc')):
-            tmp = echopype.convert.ConvertEK60(rfile)
-            tmp.raw2nc()
-            ### the above may output multiple files in the case of parameter changes
-            ncs_created = glob(rfile.split('.')[0]+ '*.nc')
-            ### move .nc(s) from ek60_raw to ek60_nc
-            for nc in ncs_created:
-               os.rename(os.path.join(os.path.dirname(rfile), nc), os.path.join(ncsdir, nc))
-
-            del tmp
-         else:
-            print(rfile + " has been converted already. Skipping...")       
+   errsdir = os.path.join(basedir, cruisename, 'ek60_convert_error')
+   runlog.start(os.path.join(basedir, cruisename))
 
-      except Exception as e:
-         for handler in logging.root.handlers[:]:
-            logging.root.removeHandler(handler)
+   ### Work out what still needs converting before handing anything to the workers
+   manifest_file = manifest_path(basedir, cruisename)
+   with lease.hold(os.path.join(basedir, cruisename), 'manifest') as held:
+      manifest = load_manifest(manifest_file)
+      raws = scan_raw(rawdir)
+      ncs_present = set(os.listdir(ncsdir))
+      todo = plan_conversions(manifest, raws, ncs_present, use_hash=args.hash, retry_errors=args.retry_errors)
+      held.check()
+      save_manifest(manifest, manifest_file)
 
-         logfilename = os.path.basename(rfile).split('.')[0] + '-error-log.txt'
-         logging.basicConfig(filename = os.path.join(basedir, cruisename, 'ek60_convert_error', logfilename), filemode='w', level=logging.WARNING)
-         print('An error occurred: ' + str(e))
-         logging.exception(rfile + "  Conversion Error")  
+   n_errors = sum(1 for name in raws if manifest.get(name, {}).get('status') == 'error')
+   print(str(len(raws)) + " .raw files, " + str(len(todo)) + " to convert, " + str(n_errors) + " previously failed")
+   if args.status:
+      for item in todo:
+         print(item[1])
+      return
+
+   version = getattr(echopype, '__version__', 'unknown')
+   if args.shared:
+      jobs = [(item, ncsdir, errsdir, args.layout, manifest_file, manifest.get(item[0]), version) for item in todo]
+      if args.workers <= 1:
+         n = sum(convert_claimed(job) for job in jobs)
+      else:
+         with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            n = sum(pool.map(convert_claimed, jobs))
+      print("Converted " + str(n) + " of " + str(len(todo)) + " files on this host")
+      runlog.finish()
+      return
+
+   for name, path, size, mtime, sha1 in todo:
+      remove_outputs(ncsdir, manifest.get(name))
+
+   def record(item, result):
+      name, path, size, mtime, sha1 = item
+      outputs, ok = result
+      manifest[name] = make_entry(path, size, mtime, sha1, outputs, version, 'converted' if ok else 'error')
+
+   ### Iterate over all the .RAW files and convert them. The manifest is saved as we go so a crash loses little.
+   if args.workers <= 1:
+      for n, item in enumerate(todo):
+         record(item, convert_file(item[1], ncsdir, errsdir, args.layout))
+         if n % 50 == 49:
+            save_manifest(manifest, manifest_file)
+   else:
+      with ProcessPoolExecutor(max_workers=args.workers) as pool:
+         futures = {pool.submit(convert_file, item[1], ncsdir, errsdir, args.layout): item for item in todo}
+         for n, future in enumerate(as_completed(futures)):
+            print("Finished " + futures[future][1])
+            record(futures[future], future.result())
+            if n % 50 == 49:
+               save_manifest(manifest, manifest_file)
+
+   save_manifest(manifest, manifest_file)
+   runlog.finish()
 
 
 
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+"""
+Command line tool for indexing EK60 .raw files without converting them, for quick-look tracks, file time ranges
+and parameter changes minutes after a file lands.
+
+A .raw file is a sequence of datagrams, each framed as
+   int32 length | 4-char type | uint32 lowDateTime, uint32 highDateTime (NT time) | body | int32 length
+The file is memory-mapped and only the framing is walked; of the bodies, only these are decoded:
+   CON0 -- the configuration header: channel ids, frequencies, gains and beam angles
+   RAW0 -- the 72-byte sample header of each ping (channel, frequency, power, pulse length, sample interval,
+           sample count); the samples after it are skipped
+   NME0 -- NMEA sentences, for GGA fixes (RMC or GLL if the file has no GGA)
+Per file, the index (datagram offsets and types, pings, fixes, channel config) is saved to
+[cruise]/raw_index/[file].npz along with the size/mtime of the .raw it came from, so reruns only index new files.
+
+example: python raw_index.py /media/paulr/ncei_data/shimada/sh1707/
+example: python raw_index.py /media/paulr/ncei_data/shimada/sh1707/ --track sh1707_quicklook.png
+
+"""
+
+
+import os
+import mmap
+import struct
+import argparse
+from glob import glob
+import numpy as np
+import runlog
+
+### 100 ns ticks between 1601-01-01 (NT time) and 1970-01-01
+NT_EPOCH = 116444736000000000
+CONFIG_HEADER = struct.Struct('<128s128s128s30s98sl')
+CONFIG_CHANNEL = struct.Struct('<128slfff')
+CONFIG_CHANNEL_SIZE = 320
+SAMPLE_HEADER = struct.Struct('<hh12fhh2f2l')
+
+
+def index_dir(cruisedir):
+   return os.path.join(cruisedir, 'raw_index')
+
+
+def index_path(cruisedir, rawfile):
+   return os.path.join(index_dir(cruisedir), os.path.splitext(os.path.basename(rawfile))[0] + '.npz')
+
+
+def nt_to_ns(low, high):
+   return ((high << 32 | low) - NT_EPOCH) * 100
+
+
+def nmea_degrees(value, hemisphere):
+   ### ddmm.mmmm / dddmm.mmmm to signed decimal degrees
+   if not value:
+      return np.nan
+   point = value.index('.') if '.' in value else len(value)
+   degrees = float(value[:point - 2]) + float(value[point - 2:]) / 60
+   return -degrees if hemisphere in ('S', 'W') else degrees
+
+
+def parse_nmea(sentence):
+   ### Returns (sentence type, lat, lon) for GGA/RMC/GLL sentences, or None
+   fields = sentence.split('*')[0].strip().split(',')
+   kind = fields[0][-3:]
+   try:
+      if kind == 'GGA':
+         return kind, nmea_degrees(fields[2], fields[3]), nmea_degrees(fields[4], fields[5])
+      if kind == 'RMC':
+         return kind, nmea_degrees(fields[3], fields[4]), nmea_degrees(fields[5], fields[6])
+      if kind == 'GLL':
+         return kind, nmea_degrees(fields[1], fields[2]), nmea_degrees(fields[3], fields[4])
+   except (IndexError, ValueError):
+      pass
+   return None
+
+
+def index_file(rawfile):
+   ### Walk the datagrams of one .raw file. Returns the index as a dict of numpy arrays.
+   offsets, types, times = [], [], []
+   pings = []
+   fixes = {}
+   channels = []
+   with open(rawfile, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+      pos, size = 0, len(buf)
+      while pos + 16 <= size:
+         length, = struct.unpack_from('<l', buf, pos)
+         if length < 12 or pos + 8 + length > size:
+            break    # truncated (e.g. still being written): index what is complete
+         kind = buf[pos + 4:pos + 8].decode('ascii', 'replace')
+         t = nt_to_ns(*struct.unpack_from('<LL', buf, pos + 8))
+         body = pos + 16
+         offsets.append(pos)
+         types.append(kind)
+         times.append(t)
+
+         if kind == 'RAW0':
+            h = SAMPLE_HEADER.unpack_from(buf, body)
+            pings.append((t, h[0], h[3], h[4], h[5], h[7], h[19]))
+         elif kind == 'NME0':
+            fix = parse_nmea(buf[body:pos + 4 + length].decode('ascii', 'replace'))
+            if fix is not None:
+               fixes.setdefault(fix[0], []).append((t, fix[1], fix[2]))
+         elif kind == 'CON0':
+            ntransceivers = CONFIG_HEADER.unpack_from(buf, body)[-1]
+            for k in range(ntransceivers):
+               c = CONFIG_CHANNEL.unpack_from(buf, body + CONFIG_HEADER.size + k * CONFIG_CHANNEL_SIZE)
+               channels.append((c[0].split(b'\0')[0].decode('ascii', 'replace').strip(), c[2], c[3], c[4]))
+         pos += 8 + length
+
+   ### one sentence type only, so fixes from GGA and RMC don't interleave
+   kind = next((k for k in ['GGA', 'RMC', 'GLL'] if k in fixes), None)
+   fix = np.array(fixes.get(kind, []), dtype='float64').reshape(-1, 3)
+   fix_time = np.array([t for t, lat, lon in fixes.get(kind, [])], dtype='int64')
+   ping = np.array(pings, dtype='float64').reshape(-1, 7)
+   st = os.stat(rawfile)
+   return {'size': np.int64(st.st_size), 'mtime': np.float64(st.st_mtime),
+           'offset': np.array(offsets, dtype='int64'), 'type': np.array(types, dtype='U4'), 'time': np.array(times, dtype='int64'),
+           'ping_time': np.array([p[0] for p in pings], dtype='int64'),
+           'channel': ping[:, 1].astype('int16'), 'frequency': ping[:, 2], 'transmit_power': ping[:, 3],
+           'pulse_length': ping[:, 4], 'sample_interval': ping[:, 5], 'count': ping[:, 6].astype('int32'),
+           'fix_time': fix_time, 'lat': fix[:, 1], 'lon': fix[:, 2],
+           'channel_id': np.array([c[0] for c in channels], dtype='U'), 'config_frequency': np.array([c[1] for c in channels]),
+           'gain': np.array([c[2] for c in channels]), 'equivalent_beam_angle': np.array([c[3] for c in channels])}
+
+
+def is_current(cruisedir, rawfile):
+   path = index_path(cruisedir, rawfile)
+   if not os.path.exists(path):
+      return False
+   st = os.stat(rawfile)
+   with np.load(path) as idx:
+      return idx['size'] == st.st_size and idx['mtime'] == st.st_mtime
+
+
+def load(cruisedir, rawfile):
+   with np.load(index_path(cruisedir, rawfile)) as idx:
+      return dict(idx)
+
+
+def update(cruisedir, rawfiles=None):
+   ### Index any .raw file that is new or has changed. Returns the number of files indexed.
+   if rawfiles is None:
+      rawfiles = sorted(glob(os.path.join(cruisedir, 'ek60_raw', '*raw')))
+   os.makedirs(index_dir(cruisedir), exist_ok=True)
+   n = 0
+   for rawfile in rawfiles:
+      if is_current(cruisedir, rawfile):
+         continue
+      with runlog.measure('raw_index', rawfile) as m:
+         try:
+            idx = index_file(rawfile)
+         except Exception as e:
+            print('An error occurred indexing ' + rawfile + ': ' + str(e))
+            m['ok'], m['error'] = False, str(e)
+            continue
+         path = index_path(cruisedir, rawfile)
+         with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **idx)
+         os.replace(path + '.tmp', path)
+         n += 1
+   return n
+
+
+def parameter_changes(idx):
+   ### [(time ns, channel, field, old, new)] wherever a channel's transmit power, pulse length or sample interval changes
+   changes = []
+   for channel in np.unique(idx['channel']):
+      sel = np.nonzero(idx['channel'] == channel)[0]
+      for field in ['transmit_power', 'pulse_length', 'sample_interval']:
+         values = idx[field][sel]
+         for k in np.nonzero(np.diff(values) != 0)[0]:
+            changes.append((int(idx['ping_time'][sel[k + 1]]), int(channel), field, float(values[k]), float(values[k + 1])))
+   return sorted(changes)
+
+
+def report(rawfile, idx):
+   ### Print a file's time range, ping and fix counts, channels and any parameter changes
+   if not len(idx['ping_time']):
+      print(os.path.basename(rawfile) + ": no pings")
+      return
+   print("%s: %s to %s, %d pings, %d fixes, channels %s" % (os.path.basename(rawfile),
+         idx['ping_time'].min().astype('datetime64[ns]'), idx['ping_time'].max().astype('datetime64[ns]'),
+         len(idx['ping_time']), len(idx['fix_time']), ' '.join(str(int(f)) for f in idx['config_frequency'])))
+   for t, channel, field, old, new in parameter_changes(idx):
+      print("   %s channel %d %s changed from %g to %g" % (np.datetime64(t, 'ns'), channel, field, old, new))
+
+
+def plot_track(idxs, pngname):
+   ### Quick-look track of all the indexed fixes, on the cached basemap
+   import matplotlib
+   matplotlib.use('Agg')
+   import matplotlib.pyplot as plt
+   import cartopy.crs as ccrs
+   from basemaps import snap_extent, add_basemap, add_gridlines, add_landmarks
+   from decimate import decimate_track, pixel_tolerance
+
+   lon = np.concatenate([idx['lon'] for idx in idxs] + [np.zeros(0)])
+   lat = np.concatenate([idx['lat'] for idx in idxs] + [np.zeros(0)])
+   if not np.isfinite(lon).any():
+      print("No positions to plot")
+      return
+   extent = snap_extent([max(np.nanmin(lon) - 0.25, -135), min(np.nanmax(lon) + 0.25, -117),
+                         max(np.nanmin(lat) - 0.25, 25), min(np.nanmax(lat) + 0.25, 70)])
+   fig = plt.figure(figsize=[8.5, 11])
+   ax = plt.axes(projection=ccrs.PlateCarree())
+   add_basemap(ax, extent, dpi=120)
+   add_gridlines(ax)
+   lon, lat = decimate_track(lon, lat, pixel_tolerance(fig, ax, extent, 120))
+   ax.plot(lon, lat, linewidth=3, color='#E31A1C')
+   add_landmarks(ax, extent, dx=0.03)
+   plt.title(os.path.basename(pngname))
+   print("Saving " + pngname)
+   plt.savefig(pngname, dpi=120, bbox_inches='tight', pad_inches=.25)
+   plt.close(fig)
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Index .raw files (times, positions, channel config) without converting them')
+   parser.add_argument('cruisedir')
+   parser.add_argument('--track', metavar='PNG', help='also plot a quick-look track of every indexed file')
+   args = parser.parse_args()
+
+   runlog.start(args.cruisedir)
+   rawfiles = sorted(glob(os.path.join(args.cruisedir, 'ek60_raw', '*raw')))
+   n = update(args.cruisedir, rawfiles)
+   print("Indexed " + str(n) + " of " + str(len(rawfiles)) + " .raw files")
+
+   idxs = []
+   for rawfile in rawfiles:
+      if not os.path.exists(index_path(args.cruisedir, rawfile)):
+         continue
+      idx = load(args.cruisedir, rawfile)
+      idxs.append(idx)
+      report(rawfile, idx)
+
+   if args.track:
+      plot_track(idxs, args.track)
+   runlog.finish()
+
+
+
+if __name__ == '__main__':
+    main()
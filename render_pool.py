@@ -0,0 +1,132 @@
+"""
+Process pool for rendering figures.
+
+A render job is (function, args): a module-level function that draws one figure on its own Agg Figure and saves
+it to args[0], the PNG name, so jobs share no matplotlib state and can run in any process. plot_hake_daily.py
+(each echogram and track chunk) and plot_hake_10days.py (each 10-day panel) build their lists of jobs and hand
+them to run(), which spreads them over `workers` processes. Workers are replaced every TASKS_PER_CHILD jobs so
+memory fragmented by one figure is returned to the system. Every job is a record in the run log (see runlog.py),
+under the name of its function.
+
+Each worker can be given a memory cap in MB (Unix only): a figure that would go over it fails with MemoryError, is
+reported, and the rest carry on. The cap is RLIMIT_AS, which limits virtual address space, not resident memory.
+numpy/BLAS thread pools and malloc arenas reserve far more address space than they touch, so a cap near a
+figure's actual footprint fails small jobs for no reason. Set it at a few times the resident memory a figure
+needs (a worker that has imported the plotting stack already maps several hundred MB).
+
+A worker that dies outright (killed by the OOM killer, or aborting in C) breaks the whole pool, and every job
+still in it fails with it. Those jobs are rerun each in a process of its own, `workers` at a time, so only the job
+that killed its worker is reported failed.
+
+In shared mode (see lease.py) each PNG is leased by the process rendering it, so hosts plotting the same cruise
+split the figures between them; a figure another host is drawing, or has redrawn since run() started, is skipped.
+The PNGs are expected in a subdirectory of the cruise directory (echogram/, ship_track_01day/, ...).
+"""
+
+
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import runlog
+import lease
+
+TASKS_PER_CHILD = 20
+
+
+def init_worker(max_memory_mb):
+   import matplotlib
+   matplotlib.use('Agg')
+   if max_memory_mb:
+      try:
+         import resource
+      except ImportError:
+         print("No per-worker memory cap on this platform")
+         return
+      cap = int(max_memory_mb) * 1024 * 1024
+      resource.setrlimit(resource.RLIMIT_AS, (cap, cap))
+
+
+def render(job, since=None):
+   ### Run one job; returns (name, seconds, error message or None), with seconds None if the job was skipped because
+   ### another process holds its PNG or the PNG was written after `since` (a time.time())
+   function, args = job
+   name = os.path.basename(args[0])
+   with lease.claim(os.path.dirname(os.path.dirname(os.path.abspath(args[0]))), 'render-' + name) as mine:
+      if not mine or (since is not None and os.path.exists(args[0]) and os.path.getmtime(args[0]) >= since):
+         return name, None, None
+      t0 = time.perf_counter()
+      with runlog.measure(function.__name__, args[0]) as m:
+         try:
+            function(*args)
+            ### the PNG is already written; report it if another process took the lease meanwhile
+            mine.check()
+         except Exception as e:
+            m['ok'], m['error'] = False, type(e).__name__ + ': ' + str(e)
+      return name, time.perf_counter() - t0, m['error']
+
+
+def failure(job, e):
+   function, args = job
+   runlog.record(function.__name__, args[0], ok=False, error=type(e).__name__ + ': ' + str(e))
+   return os.path.basename(args[0]), 0.0, type(e).__name__ + ': ' + str(e)
+
+
+def isolated(job, since=None, max_memory_mb=0):
+   ### Run one job in a process of its own, so that if the process dies it takes nothing else with it
+   with ProcessPoolExecutor(max_workers=1, initializer=init_worker, initargs=(max_memory_mb,)) as pool:
+      try:
+         return pool.submit(render, job, since).result()
+      except Exception as e:
+         return failure(job, e)
+
+
+def collect(futures, since=None, workers=1, max_memory_mb=0):
+   ### results of the pool's jobs as they finish. The jobs a dead worker took down with the pool are rerun in
+   ### isolation, so the one that killed it fails alone.
+   unfinished = []
+   for future in as_completed(futures):
+      try:
+         yield future.result()
+      except BrokenProcessPool:
+         unfinished.append(futures[future])
+      except Exception as e:
+         yield failure(futures[future], e)
+   if unfinished:
+      print("A rendering process died; rerunning %d unfinished job(s) one per process" % len(unfinished))
+      with ThreadPoolExecutor(max_workers=workers) as threads:
+         yield from threads.map(lambda job: isolated(job, since, max_memory_mb), unfinished)
+
+
+def run(jobs, workers=1, max_memory_mb=0):
+   ### Render every job, serially in this process if workers <= 1. Returns the number that failed.
+   jobs = list(jobs)
+   failed = skipped = 0
+   t0 = time.perf_counter()
+   ### in shared mode, a PNG newer than this was drawn by another host after these jobs were planned
+   since = time.time() if lease.enabled() else None
+   if workers <= 1:
+      init_worker(0)
+      results = (render(job, since) for job in jobs)
+   else:
+      pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(max_memory_mb,),
+                                 **({'max_tasks_per_child': TASKS_PER_CHILD} if sys.version_info >= (3, 11) else {}))
+      results = collect({pool.submit(render, job, since): job for job in jobs}, since, workers, max_memory_mb)
+   try:
+      for name, seconds, error in results:
+         if seconds is None:
+            skipped += 1
+            print("Skipped " + name + " (rendered by another host)")
+         elif error is None:
+            print("Rendered %s in %.1f s" % (name, seconds))
+         else:
+            failed += 1
+            print("Failed to render " + name + ": " + error)
+   finally:
+      if workers > 1:
+         pool.shutdown()
+   if jobs:
+      print("Rendered %d of %d figures in %.1f s with %d worker(s)%s" % (len(jobs) - failed - skipped, len(jobs), time.perf_counter() - t0,
+            max(workers, 1), ", %d left to other hosts" % skipped if skipped else ""))
+   return failed
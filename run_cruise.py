@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+"""
+Command line tool for running the whole cruise workflow as one dependency-aware pipeline.
+
+The README workflow is modelled as a task graph:
+
+   convert --+--> summarize --> catalog --+--> tracks (the days out of date)
+             |                            +--> tracks10
+             +--> calibrate --> echogram (the days out of date)
+
+Each task runs its script in a subprocess (output goes to [cruise]/.pipeline/[task].log). When a task succeeds
+it leaves a stamp file, [cruise]/.pipeline/[task].done, listing the size and mtime of every input it read. A task
+is only rerun when its stamp is missing, when its inputs differ from the ones listed (a file added, removed or
+rewritten -- files copied with rsync -a or cp -p keep older mtimes, so it isn't enough to look for newer ones), or
+when the stamp of a task it depends on is newer (except for the daily plots, see below). A task that crashed never got its stamp, so rerunning after a
+crash picks up where it left off. If a task fails, the
+tasks that depend on it are skipped and everything else carries on.
+
+The daily plots are kept up to date day by day (each day has its own stamp, e.g. echogram_D20170720.done), but
+all the days out of date go to one plot_hake_daily.py run, which pays for its imports and startup only once. A
+day's stamp is checked against that day's own inputs only (its .nc files, and its _Sv.nc files for the echograms,
+which calibration rewrites when it redoes them), not against the stamp of calibrate or catalog: those are renewed
+whenever any file of the cruise changes, and would otherwise have every day replotted.
+
+Up to --jobs tasks run at once; --workers is passed on to the stages that have their own process pools
+(conversion, summary, calibration).
+
+The pipeline's run log (see runlog.py) takes in every task's scripts as well as a record per task (wall time, CPU
+time and peak RSS of its process tree), and its summary of the slowest stages and files is printed at the end.
+
+With --shared, run_cruise.py can run on several hosts against the same cruise directory (e.g. over NFS) at once.
+Every script it starts then leases each file it converts, calibrates or plots, and takes turns on the stores
+they all update (see lease.py), so the hosts split the work instead of repeating it. Task logs are named
+[task]-[host].log so they don't overwrite each other.
+example: python run_cruise.py /mnt/ncei_data/shimada/ sh1707 --workers 8 --shared    (on each host)
+
+example: python run_cruise.py /media/paulr/ncei_data/shimada/ sh1707 --workers 8 --jobs 4
+
+"""
+
+
+import os
+import sys
+import json
+import time
+import argparse
+import socket
+import subprocess
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import runlog
+import lease
+from hake_utils import cruise_days
+from calibrate_hake import PING_CHUNK
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def stampdir(cruisedir):
+   return os.path.join(cruisedir, '.pipeline')
+
+
+def stamp_path(cruisedir, name):
+   return os.path.join(stampdir(cruisedir), name.replace(':', '_') + '.done')
+
+
+def task(name, cmd, inputs, deps=()):
+   ### inputs is a function returning the paths the task reads, evaluated when the task is about to run
+   return {'name': name, 'cmd': [sys.executable, os.path.join(HERE, cmd[0])] + list(cmd[1:]), 'inputs': inputs, 'deps': list(deps)}
+
+
+def batch_task(name, cmd, parts, options=(), deps=()):
+   ### One run of cmd over whichever parts are out of date: parts is [(part, inputs)], each part with a stamp of its
+   ### own ([name]:[part]), and the command is cmd + the stale parts + options
+   t = task(name, cmd, None, deps)
+   t.update({'parts': parts, 'options': list(options)})
+   return t
+
+
+def signature(paths):
+   ### {path: [size, mtime]} of the inputs that exist
+   sig = {}
+   for p in paths:
+      try:
+         st = os.stat(p)
+      except OSError:
+         continue
+      sig[p] = [st.st_size, st.st_mtime]
+   return sig
+
+
+def is_stale(cruisedir, t, sig):
+   ### sig: signature() of the task's inputs now
+   stamp = stamp_path(cruisedir, t['name'])
+   try:
+      with open(stamp) as f:
+         if json.load(f)['inputs'] != sig:
+            return True
+   except (OSError, ValueError, KeyError, TypeError):
+      return True
+   done = os.path.getmtime(stamp)
+   return any(os.path.exists(p) and os.path.getmtime(p) > done for p in [stamp_path(cruisedir, d) for d in t['deps']])
+
+
+def log_path(cruisedir, name):
+   return os.path.join(stampdir(cruisedir), name.replace(':', '_') + ('-' + socket.gethostname() if lease.enabled() else '') + '.log')
+
+
+def stale_runs(cruisedir, t):
+   ### (command, {stamp name: input signature}) to bring the task up to date, or None if it is
+   if 'parts' not in t:
+      sig = signature(t['inputs']())
+      return (t['cmd'], {t['name']: sig}) if is_stale(cruisedir, t, sig) else None
+   stamps = {}
+   for part, inputs in t['parts']:
+      sig = signature(inputs())
+      ### a part goes by its own inputs only (see above)
+      if is_stale(cruisedir, {'name': t['name'] + ':' + part, 'deps': []}, sig):
+         stamps[t['name'] + ':' + part] = sig
+   if not stamps:
+      return None
+   return t['cmd'] + [name.split(':', 1)[1] for name in stamps] + t['options'], stamps
+
+
+def run_task(cruisedir, t, cmd, stamps):
+   ### Returns True on success, and leaves the stamps behind, each listing its inputs as they were when it started
+   t0 = time.perf_counter()
+   with open(log_path(cruisedir, t['name']), 'w') as log:
+      p = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+      ### wait4 rather than wait, for the CPU time and peak RSS of the task's processes
+      pid, status, usage = os.wait4(p.pid, 0)
+      status = p.returncode = os.waitstatus_to_exitcode(status)
+   runlog.record('task:' + t['name'], None, ok=status == 0, error=None if status == 0 else 'exit status ' + str(status),
+                 wall_s=time.perf_counter() - t0, cpu_s=usage.ru_utime + usage.ru_stime, peak_rss_mb=runlog.maxrss_mb(usage.ru_maxrss))
+   if status == 0:
+      for name, sig in stamps.items():
+         stamp = stamp_path(cruisedir, name)
+         with open(stamp + '.tmp', 'w') as f:
+            json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'inputs': sig}, f)
+         os.replace(stamp + '.tmp', stamp)
+   return status == 0
+
+
+def run_graph(cruisedir, tasks, jobs=1, state=None):
+   ### Run every stale task once its dependencies have finished; state holds the outcome of tasks already run.
+   ### Returns state updated with {name: 'ok'|'up to date'|'failed'|'skipped'}
+   tasks = {t['name']: t for t in tasks}
+   state = dict(state or {})
+   running = {}
+   with ThreadPoolExecutor(max_workers=jobs) as pool:
+      while not all(name in state for name in tasks):
+         for name, t in tasks.items():
+            if name in state or name in running.values():
+               continue
+            if any(state.get(d) in ('failed', 'skipped') for d in t['deps']):
+               state[name] = 'skipped'
+               print("Skipping " + name + " (a dependency failed)")
+            elif all(state.get(d) in ('ok', 'up to date') for d in t['deps']) and len(running) < jobs:
+               todo = stale_runs(cruisedir, t)
+               if todo is None:
+                  state[name] = 'up to date'
+               else:
+                  print("Running " + name + ('' if 'parts' not in t else ' (' + ' '.join(n.split(':', 1)[1] for n in todo[1]) + ')'))
+                  running[pool.submit(run_task, cruisedir, t, *todo)] = name
+
+         if not running:
+            continue
+         finished, _ = wait(running, return_when=FIRST_COMPLETED)
+         for future in finished:
+            name = running.pop(future)
+            state[name] = 'ok' if future.result() else 'failed'
+            print("Finished " + name + ": " + state[name])
+   return state
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Run the whole cruise workflow, rebuilding only what is out of date')
+   parser.add_argument('basedir')
+   parser.add_argument('cruisename')
+   parser.add_argument('--workers', type=int, default=1, help='processes for conversion, summary and calibration (default: 1)')
+   parser.add_argument('--jobs', type=int, default=None, help='tasks to run at once (default: --workers)')
+   parser.add_argument('--ping-chunk', type=int, default=PING_CHUNK, help='pings per calibration chunk (default: %d)' % PING_CHUNK)
+   parser.add_argument('--layout', choices=['default', 'chunked'], default='default', help='layout of the .nc and _Sv.nc files (see nc_layout.py)')
+   parser.add_argument('--shared', action='store_true', help='cooperate with other hosts running the same cruise (see lease.py)')
+   args = parser.parse_args()
+   if args.shared:
+      lease.enable()
+   jobs = args.jobs or args.workers
+
+   basedir, cruisename = args.basedir, args.cruisename
+   cruisedir = os.path.join(basedir, cruisename)
+   rawdir = os.path.join(cruisedir, 'ek60_raw')
+   ncsdir = os.path.join(cruisedir, 'ek60_nc')
+   errsdir = os.path.join(cruisedir, 'ek60_convert_error')
+   os.makedirs(stampdir(cruisedir), exist_ok=True)
+   runlog.start(cruisedir)
+   workers = ['--workers', str(args.workers)]
+   layout = ['--layout', args.layout]
+
+   ### Conversion first, on its own: the rest of the graph depends on which days it produces
+   convert = task('convert', ['raw2netCDF.py', basedir, cruisename] + workers + layout, lambda: glob(os.path.join(rawdir, '*raw')))
+   state = run_graph(cruisedir, [convert], jobs)
+   if state['convert'] == 'failed':
+      print("Conversion failed; see " + log_path(cruisedir, 'convert'))
+      runlog.finish()
+      sys.exit(1)
+
+   ncs = lambda pattern='': glob(os.path.join(ncsdir, '*' + pattern + '*[0-9].nc'))
+   tasks = [
+      task('summarize', ['survey_hake.py', basedir, cruisename] + workers, lambda: ncs() + glob(os.path.join(errsdir, '*-error-log.txt')), ['convert']),
+      task('calibrate', ['calibrate_hake.py', basedir, cruisename, '--ping-chunk', str(args.ping_chunk)] + workers + layout, ncs, ['convert']),
+      task('catalog', ['catalog.py', cruisedir], ncs, ['summarize']),
+      task('tracks10', ['plot_hake_10days.py', cruisedir] + workers, ncs, ['catalog']),
+   ]
+   days = cruise_days(ncsdir)
+   tasks.append(batch_task('echogram', ['plot_hake_daily.py', cruisedir],
+                           [(day, lambda day=day: ncs(day) + glob(os.path.join(ncsdir, '*' + day + '*_Sv.nc'))) for day in days],
+                           ['--only', 'echogram'] + workers, ['calibrate']))
+   tasks.append(batch_task('tracks', ['plot_hake_daily.py', cruisedir], [(day, lambda day=day: ncs(day)) for day in days],
+                           ['--only', 'tracks'] + workers, ['catalog']))
+
+   state = run_graph(cruisedir, tasks, jobs, state)
+   for outcome in ['ok', 'up to date', 'failed', 'skipped']:
+      names = [name for name in state if state[name] == outcome]
+      if names:
+         print(outcome + ": " + str(len(names)) + ("" if outcome in ('ok', 'up to date') else "  " + " ".join(names)))
+   runlog.finish()
+   if any(v == 'failed' for v in state.values()):
+      sys.exit(1)
+
+
+
+if __name__ == '__main__':
+    main()
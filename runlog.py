@@ -0,0 +1,173 @@
+"""
+Structured run log: per-file and per-stage timings and resource use, as JSON lines.
+
+Each script calls start() at the top of main(), wraps its units of work in `with measure(stage, file) as m:` and
+calls finish() at the end. Every unit adds one line to the log:
+   {"time": ..., "run": ..., "host": ..., "pid": ..., "script": ..., "stage": ..., "file": ... or null,
+    "ok": ..., "error": ..., "wall_s": ..., "cpu_s": ..., "read_bytes": ..., "write_bytes": ..., "peak_rss_mb": ...}
+cpu_s, read_bytes and write_bytes are what this process used during the unit (bytes through read/write calls, from
+/proc/self/io, so null off Linux, and including any child processes reaped meanwhile), and peak_rss_mb is the
+process's peak so far. A unit that handles its own errors
+marks itself failed with m['ok'] = False and m['error'] = ...; an exception escaping measure() is recorded and
+re-raised.
+
+The log is [cruise]/runlogs/[script]-[YYYYMMDDTHHMMSS]-[host]-[pid].jsonl. Its path is handed to child processes in
+$HAKE_RUN_LOG, so pool workers, and the scripts run_cruise.py starts, all write to the one log; each line goes out
+in a single append, so concurrent writers don't interleave. Only the process that started the log prints the
+summary (the slowest stages and files) at finish(). If $HAKE_PROMETHEUS_TEXTFILE is set, finish() also writes the
+per-stage totals there in the Prometheus text format (e.g. for node_exporter's textfile collector).
+"""
+
+
+import os
+import sys
+import json
+import time
+import socket
+from contextlib import contextmanager
+
+ENV = 'HAKE_RUN_LOG'
+PROMETHEUS_ENV = 'HAKE_PROMETHEUS_TEXTFILE'
+_run = {'path': None, 'script': None, 'owner': False}
+
+
+def script_name():
+   return _run['script'] or os.path.splitext(os.path.basename(sys.argv[0]))[0]
+
+
+def start(cruisedir, script=None):
+   ### Open (or, in a child of a logged run, join) the run log. Returns its path.
+   _run['script'] = script or script_name()
+   if os.environ.get(ENV):
+      _run['path'] = os.environ[ENV]
+      return _run['path']
+   logdir = os.path.join(cruisedir, 'runlogs')
+   os.makedirs(logdir, exist_ok=True)
+   _run['path'] = os.path.join(logdir, '%s-%s-%s-%d.jsonl' % (_run['script'], time.strftime('%Y%m%dT%H%M%S'), socket.gethostname(), os.getpid()))
+   _run['owner'] = True
+   os.environ[ENV] = _run['path']
+   return _run['path']
+
+
+def io_counters():
+   ### (bytes read, bytes written) by this process so far, or (None, None) where /proc/self/io isn't available
+   try:
+      with open('/proc/self/io') as f:
+         counters = dict(line.split(':') for line in f if ':' in line)
+      return int(counters['rchar']), int(counters['wchar'])
+   except (OSError, KeyError, ValueError):
+      return None, None
+
+
+def maxrss_mb(ru_maxrss):
+   ### ru_maxrss is in kB on Linux, bytes on macOS
+   return ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+
+def peak_rss_mb():
+   try:
+      import resource
+   except ImportError:
+      return None
+   return maxrss_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def record(stage, file=None, **fields):
+   ### Append one record; does nothing outside a logged run
+   path = _run['path'] or os.environ.get(ENV)
+   if not path:
+      return
+   rec = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'run': os.path.basename(path).rsplit('.', 1)[0], 'host': socket.gethostname(),
+          'pid': os.getpid(), 'script': script_name(), 'stage': stage, 'file': file}
+   rec.update(fields)
+   fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+   try:
+      os.write(fd, (json.dumps(rec, default=str) + '\n').encode())
+   finally:
+      os.close(fd)
+
+
+@contextmanager
+def measure(stage, file=None):
+   m = {'ok': True, 'error': None}
+   t0, c0 = time.perf_counter(), time.process_time()
+   r0, w0 = io_counters()
+   try:
+      yield m
+   except BaseException as e:
+      m['ok'], m['error'] = False, type(e).__name__ + ': ' + str(e)
+      raise
+   finally:
+      r1, w1 = io_counters()
+      record(stage, file, ok=m['ok'], error=m['error'], wall_s=time.perf_counter() - t0, cpu_s=time.process_time() - c0,
+             read_bytes=None if r0 is None else r1 - r0, write_bytes=None if w0 is None else w1 - w0, peak_rss_mb=peak_rss_mb())
+
+
+def load(path):
+   records = []
+   with open(path) as f:
+      for line in f:
+         try:
+            records.append(json.loads(line))
+         except ValueError:
+            pass
+   return records
+
+
+def stage_totals(records):
+   ### {(script, stage): {'n', 'failed', 'wall_s', 'cpu_s', 'read_bytes', 'write_bytes', 'peak_rss_mb'}}
+   totals = {}
+   for r in records:
+      t = totals.setdefault((r['script'], r['stage']), {'n': 0, 'failed': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'read_bytes': 0, 'write_bytes': 0, 'peak_rss_mb': 0.0})
+      t['n'] += 1
+      t['failed'] += not r.get('ok', True)
+      for key in ['wall_s', 'cpu_s', 'read_bytes', 'write_bytes']:
+         t[key] += r.get(key) or 0
+      t['peak_rss_mb'] = max(t['peak_rss_mb'], r.get('peak_rss_mb') or 0)
+   return totals
+
+
+def summary(path, top=10):
+   records = load(path)
+   totals = stage_totals(records)
+   print("Run log: " + path)
+   print("%-16s %-22s %6s %6s %10s %10s %10s %10s %9s" % ('script', 'stage', 'units', 'failed', 'wall s', 'cpu s', 'read MB', 'write MB', 'peak MB'))
+   for (script, stage), t in sorted(totals.items(), key=lambda item: -item[1]['wall_s']):
+      print("%-16s %-22s %6d %6d %10.1f %10.1f %10.1f %10.1f %9.0f" % (script, stage, t['n'], t['failed'], t['wall_s'], t['cpu_s'],
+            t['read_bytes'] / 2 ** 20, t['write_bytes'] / 2 ** 20, t['peak_rss_mb']))
+   slowest = sorted((r for r in records if r.get('file')), key=lambda r: -(r.get('wall_s') or 0))[:top]
+   if slowest:
+      print("Slowest files:")
+      for r in slowest:
+         print("   %8.1f s  %-22s %s%s" % (r['wall_s'], r['stage'], r['file'], '' if r.get('ok', True) else '  (failed)'))
+
+
+def write_prometheus(path, records):
+   ### per-stage totals of this run, for node_exporter's textfile collector
+   metrics = [('hake_stage_wall_seconds', 'wall_s', 'Wall time spent in the stage during the last run'),
+              ('hake_stage_cpu_seconds', 'cpu_s', 'CPU time spent in the stage during the last run'),
+              ('hake_stage_read_bytes', 'read_bytes', 'Bytes read by the stage during the last run'),
+              ('hake_stage_write_bytes', 'write_bytes', 'Bytes written by the stage during the last run'),
+              ('hake_stage_units', 'n', 'Files (or other units) processed by the stage during the last run'),
+              ('hake_stage_failures', 'failed', 'Units that failed in the stage during the last run'),
+              ('hake_stage_peak_rss_megabytes', 'peak_rss_mb', 'Largest peak RSS of a process in the stage during the last run')]
+   totals = stage_totals(records)
+   lines = []
+   for name, key, help in metrics:
+      lines += ['# HELP ' + name + ' ' + help, '# TYPE ' + name + ' gauge']
+      for (script, stage), t in sorted(totals.items()):
+         lines.append('%s{script="%s",stage="%s"} %s' % (name, script, stage, t[key]))
+   lines += ['# HELP hake_run_finished_timestamp_seconds When the last run finished', '# TYPE hake_run_finished_timestamp_seconds gauge',
+             'hake_run_finished_timestamp_seconds{script="%s"} %f' % (script_name(), time.time())]
+   with open(path + '.tmp', 'w') as f:
+      f.write('\n'.join(lines) + '\n')
+   os.replace(path + '.tmp', path)
+
+
+def finish(top=10):
+   ### Summarize the run, if this process started it
+   if not _run['owner'] or not os.path.exists(_run['path']):
+      return
+   summary(_run['path'], top)
+   if os.environ.get(PROMETHEUS_ENV):
+      write_prometheus(os.environ[PROMETHEUS_ENV], load(_run['path']))
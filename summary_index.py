@@ -0,0 +1,87 @@
+"""
+Keyed index behind [cruise]_summary.csv.
+
+The index lives at [cruise]/[cruise]_summary_index.json and holds one entry per file timestamp
+(e.g. "sh1707-D20170720-T123456"):
+   {"source": path of the .nc (or error log) the row came from, "size": ..., "mtime": ...,
+    "row": [File_name, Start_ping_time, End_ping_time, Pinging_interval, Sonar_freq, ...]}
+
+survey_hake.py upserts rows only for sources that are new or whose size/mtime changed, then regenerates the
+.csv from the index, so reruns never duplicate rows. Array-valued fields are kept as plain lists so they can also
+be exported to a columnar file (Parquet or Feather) for filtering by time, frequency or transmit settings.
+"""
+
+
+import os
+import csv
+import json
+import sys
+import numpy as np
+
+HEADER = ['File_name','Start_ping_time', 'End_ping_time', 'Pinging_interval', 'Sonar_freq', 'Sample_Interval', 'Transmit_duration', 'Transmit_power', 'Sound_speed', 'Absorption']
+
+
+def index_path(basedir, cruisename):
+   return os.path.join(basedir, cruisename, cruisename + '_summary_index.json')
+
+
+def load_index(path):
+   if not os.path.exists(path):
+      return {}
+   with open(path) as f:
+      return json.load(f)
+
+
+def save_index(index, path):
+   tmppath = path + '.tmp'
+   with open(tmppath, 'w') as f:
+      json.dump(index, f, sort_keys=True)
+   os.replace(tmppath, path)
+
+
+def is_current(entry, source, size, mtime):
+   return entry is not None and entry['source'] == source and entry['size'] == size and entry['mtime'] == mtime
+
+
+def upsert(index, timestamp, source, size, mtime, row):
+   index[timestamp] = {'source': source, 'size': size, 'mtime': mtime, 'row': row}
+
+
+def fmt(value):
+   ### numpy's default repr wraps long arrays over several lines, which puts newlines inside a csv field
+   if isinstance(value, list):
+      return np.array2string(np.asarray(value), max_line_width=sys.maxsize, threshold=sys.maxsize)
+   return value
+
+
+def export_csv(index, csvfile):
+   ### rewrite the whole .csv, sorted by timestamp; written to a temporary file first so readers never see half of it
+   tmpfile = csvfile + '.tmp'
+   with open(tmpfile, 'w', newline='') as csvfiletowrite:
+      csvwriter = csv.writer(csvfiletowrite, lineterminator='\n', delimiter=',')
+      csvwriter.writerow(HEADER)
+      csvwriter.writerows([fmt(v) for v in index[timestamp]['row']] for timestamp in sorted(index))
+   os.replace(tmpfile, csvfile)
+
+
+def to_dataframe(index):
+   import pandas as pd
+   rows = [index[timestamp]['row'] for timestamp in sorted(index)]
+   df = pd.DataFrame(rows, columns=HEADER, index=pd.Index(sorted(index), name='Timestamp'))
+   ### error rows carry 'NA'; turn those into proper missing values so the columns get real types
+   ### (not df.replace('NA', None), which pads the previous row's values into them on older pandas)
+   df = df.mask(df == 'NA')
+   for col in ['Start_ping_time', 'End_ping_time']:
+      df[col] = pd.to_datetime(df[col])
+   return df
+
+
+def export_columnar(index, path):
+   ### .parquet or .feather, chosen by extension (needs pyarrow)
+   df = to_dataframe(index)
+   if path.endswith('.parquet'):
+      df.to_parquet(path)
+   elif path.endswith('.feather'):
+      df.reset_index().to_feather(path)
+   else:
+      raise ValueError('Unknown columnar format for ' + path + ' (use .parquet or .feather)')
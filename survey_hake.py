@@ -1,104 +1,170 @@
 #!/usr/bin/env python3
 
 """
-Command line tool for setting up directory structure, converting .RAW files to netCDF .nc, plotting ping intervals, and generating  a .csvfile of Hake survey data.
+Command line tool for setting up directory structure, converting .RAW files to netCDF .nc, checking ping intervals (see ping_report.py), and generating  a .csvfile of Hake survey data.
 
 example: python survey_hake.py /media/paulr/ncei_data/shimada/ sh1707
 
+Each .nc file is opened once (Beam and Environment groups are read from the same handle) and files are spread over
+--workers processes. Rows are kept in a keyed index (see summary_index.py), so a rerun only summarizes new or changed
+files and the .csv never collects duplicates. The summary can also be exported to Parquet/Feather:
+example: python survey_hake.py /media/paulr/ncei_data/shimada/ sh1707 --workers 8 --export sh1707_summary.parquet
+
 """
 
 
 import os
-import sys
-from datetime import datetime as dt
+import argparse
 import xarray as xr
-import matplotlib.pyplot as plt
-import csv
-import logging
-from glob import glob
+import netCDF4
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import echopype
+import runlog
+import lease
+from hake_utils import log_error
+from ping_report import save_ping_times, report
+from summary_index import index_path, load_index, save_index, is_current, upsert, export_csv, export_columnar
+
+
+def read_groups(ncfile, groups):
+   ### Open the file once and hand back each requested group as an xarray Dataset
+   nc = netCDF4.Dataset(ncfile)
+   try:
+      return {g: xr.open_dataset(xr.backends.NetCDF4DataStore(nc.groups[g])).load() for g in groups}
+   finally:
+      nc.close()
+
+
+def extract_file(ncfile, plotsdir=None):
+   ### Pull one summary row out of a converted file (and optionally cache its ping times for ping_report.py)
+   groups = read_groups(ncfile, ['Beam', 'Environment'])
+   ncfile_beam = groups['Beam']
+   ncfile_env = groups['Environment']
+   pings = ncfile_beam.ping_time.values
+   start_ping_time = pings.min()
+   end_ping_time = pings.max()
+   if plotsdir is not None:
+      save_ping_times(plotsdir, ncfile, pings)
+
+   ### If there are any significant 2nd order differences record their indicies
+   pings_2nd = np.diff(np.diff(pings))
+   pinging_interval = np.where(pings_2nd > np.timedelta64(100,'ms'))[0] + 2
+   return [ncfile, str(start_ping_time), str(end_ping_time), pinging_interval.tolist(), ncfile_beam.frequency.values.tolist(),
+           ncfile_beam.sample_interval.values.tolist(), ncfile_beam.transmit_duration_nominal.values.tolist(),
+           ncfile_beam.transmit_power.values.tolist(), ncfile_env.sound_speed_indicative.values.tolist(),
+           ncfile_env.absorption_indicative.values.tolist()]
+
+
+def summarize(job):
+   ### Worker entry point: job is (timestamp, source, errsdir, plotsdir), where source is the .nc file or the
+   ### conversion error log for that timestamp. Returns (timestamp, csv row), with row None on error.
+   timestamp, source, errsdir, plotsdir = job
+   with runlog.measure('summarize', source) as m:
+      try:
+         print("Working on " + source)
+         if source.endswith('.nc'):
+            return timestamp, extract_file(source, plotsdir)
+         else:
+            return timestamp, [source, 'NA', 'NA', 'NA', 'NA', 'NA', 'NA', 'NA', 'NA', 'NA']
+
+      except Exception as e:
+         print('An error occurred: ' + str(e))
+         m['ok'], m['error'] = False, str(e)
+         log_error(os.path.join(errsdir, timestamp + 'survey-error-log.txt'), str(e))
+
+   return timestamp, None
+
+
+def scan_sources(ncsdir, errsdir):
+   ### One pass over ek60_nc and ek60_convert_error; returns {timestamp: (source, size, mtime)}.
+   ### A converted .nc wins over an error log for the same timestamp.
+   sources = {}
+   with os.scandir(errsdir) as entries:
+      for entry in entries:
+         if entry.name.endswith('-error-log.txt') and not entry.name.endswith('survey-error-log.txt'):
+            st = entry.stat()
+            sources[entry.name.split('-error')[0]] = (entry.path, st.st_size, st.st_mtime)
+   with os.scandir(ncsdir) as entries:
+      for entry in entries:
+         if entry.name.endswith('.nc') and entry.name[-4:-3].isdigit():
+            st = entry.stat()
+            sources[entry.name.split('.')[0]] = (entry.path, st.st_size, st.st_mtime)
+   return sources
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Build the per-file summary .csv for a cruise')
+   parser.add_argument('basedir')
+   parser.add_argument('cruisename')
+   parser.add_argument('--workers', type=int, default=1, help='number of extraction processes (default: 1)')
+   parser.add_argument('--no-report', action='store_true', help='skip the cruise-wide ping timing report (see ping_report.py)')
+   parser.add_argument('--rebuild', action='store_true', help='ignore the existing index and summarize every file again')
+   parser.add_argument('--export', action='append', default=[], metavar='PATH', help='also write the summary to a .parquet or .feather file (repeatable)')
+   parser.add_argument('--shared', action='store_true', help='take turns with other hosts working on the same cruise (see lease.py)')
+   args = parser.parse_args()
+   if args.shared:
+      lease.enable()
 
-def main():  
    ### Organize files
-   basedir = sys.argv[1]
-   cruisename = sys.argv[2]
-  
+   basedir = args.basedir
+   cruisename = args.cruisename
+
    ncsdir = os.path.join(basedir, cruisename, 'ek60_nc')
    errsdir = os.path.join(basedir, cruisename, 'ek60_convert_error')
    plotsdir = os.path.join(basedir, cruisename, 'ping_interval')
-
-   ### Check if a data survey .csv file exists in the folder already, and, if not, create one.
    csvfile = os.path.join(basedir, cruisename, cruisename + '_summary.csv')
-   if os.path.exists(csvfile) == False:
-      with open(csvfile, 'w', newline='') as csvfiletowrite:
-         csvwriter = csv.writer(csvfiletowrite, lineterminator='\n', delimiter=',')
-         csvwriter.writerow(['File_name','Start_ping_time', 'End_ping_time', 'Pinging_interval', 'Sonar_freq', 'Sample_Interval', 'Transmit_duration', 'Transmit_power', 'Sound_speed', 'Absorption'])
-
-   
-   ### Iterate over all the nc files (AND error files), extract info for the survey (or generate 'NA' on error), write to csv, and log any errors along the way
-   ncfiles = sorted(glob(os.path.join(ncsdir, '*[0-9].nc')))
-   errFiles = sorted(glob(os.path.join(errsdir, '*')))
-   ### Let's get the list of all timestamps on which to sort
-   ncefiles = [ncfiles, errFiles]
-   ncefiles_flat = [item for sublist in ncefiles for item in sublist]
-   timestamps = []
-   for ncefile in ncefiles_flat:
-      timestamps.append(os.path.basename(ncefile).split('.')[0].split('-error')[0])
-
-   timestamps_sorted = sorted(timestamps)
-   for timestamp in timestamps_sorted:
-      try:
-         if os.path.exists(os.path.join(ncsdir, timestamp + '.nc')):
-            ncfile = os.path.join(ncsdir, timestamp + '.nc')
-            print("Working on " + ncfile)
-            filebase = os.path.basename(ncfile).split('.')[0]
-            ncfile_beam = xr.open_dataset(ncfile, group = 'Beam')
-            start_ping_time = ncfile_beam.ping_time.min().values
-            end_ping_time = ncfile_beam.ping_time.max().values
-            ### calc and plot ping intervals. 
-            pings = ncfile_beam.ping_time.values
-            ### First, let's just look at the intervals for any anomalies
-            ping_ints = np.diff(pings)
-            plt.plot(ping_ints)
-            plt.ylabel('Ping Intervals (s)')
-            plt.xlabel('Ping Interval Index')
-            plt.title(ncfile)
-            plt.savefig(os.path.join(plotsdir, (filebase + '_ping_diffs.png')), dpi=120)
-            plt.close()
-            ### If there are any significant 2nd order differences record their indicies
-            pings_2nd = np.diff(np.diff(pings))
-            pinging_interval = np.where(pings_2nd > np.timedelta64(100,'ms'))[0] + 2
-            sonar_freq = ncfile_beam.frequency.values
-            sample_interval = ncfile_beam.sample_interval.values
-            transmit_duration = ncfile_beam.transmit_duration_nominal.values
-            transmit_power = ncfile_beam.transmit_power.values
-            ncfile_env = xr.open_dataset(ncfile, group = 'Environment')
-            sound_speed = ncfile_env.sound_speed_indicative.values
-            absorption = ncfile_env.absorption_indicative.values
-      
-            #TODO csvwriter puts carriage returns in the pinging_interval array. Suppress it!
-            with open(csvfile, 'a', newline='') as csvfiletowrite:
-               csvwriter = csv.writer(csvfiletowrite, lineterminator='\n', delimiter=',')
-               csvwriter.writerow([os.path.join(ncsdir, timestamp + '.nc'), start_ping_time, end_ping_time, pinging_interval, sonar_freq, sample_interval, transmit_duration, transmit_power, sound_speed, absorption])
- 
-         elif os.path.exists(os.path.join(errsdir, timestamp + '-error-log.txt')):
-            print("Working on " + errsdir, timestamp + '-error-log.txt')
-            with open(csvfile, 'a', newline='') as csvfiletowrite:
-               csvwriter = csv.writer(csvfiletowrite, lineterminator='\n', delimiter=',')
-               csvwriter.writerow([os.path.join(errsdir, timestamp + '-error-log.txt'), 'NA', 'NA', 'NA', 'NA', 'NA', 'NA', 'NA', 'NA', 'NA'])
-          
-         
-      except Exception as e:
-         for handler in logging.root.handlers[:]:
-            logging.root.removeHandler(handler)
-         
-         logfilename = timestamp + 'survey-error-log.txt'
-         logging.basicConfig(filename = os.path.join(basedir, cruisename, 'ek60_convert_error', logfilename), filemode='w', level=logging.WARNING)
-         print('An error occurred: ' + str(e))
-         logging.exception(str(e))
-      
+   indexfile = index_path(basedir, cruisename)
+   runlog.start(os.path.join(basedir, cruisename))
+
+   ### The summary index is rebuilt by one host at a time when hosts share the cruise (see lease.py); a host that
+   ### waited finds the files summarized by the other already current
+   with lease.hold(os.path.join(basedir, cruisename), 'summary') as held:
+      ### Scan the nc files (AND error files) and work out which timestamps are new or changed since the last run
+      with runlog.measure('scan'):
+         index = {} if args.rebuild else load_index(indexfile)
+         sources = scan_sources(ncsdir, errsdir)
+         for timestamp in set(index) - set(sources):
+            del index[timestamp]
+
+         jobs = []
+         for timestamp in sorted(sources):
+            source, size, mtime = sources[timestamp]
+            if not is_current(index.get(timestamp), source, size, mtime):
+               jobs.append((timestamp, source, errsdir, plotsdir))
+
+      ### extract info for the survey (or generate 'NA' on error), and log any errors along the way
+      with runlog.measure('extract'):
+         if args.workers <= 1:
+            results = [summarize(job) for job in jobs]
+         else:
+            with ProcessPoolExecutor(max_workers=args.workers) as pool:
+               results = list(pool.map(summarize, jobs, chunksize=8))
+
+      for timestamp, row in results:
+         if row is None:
+            index.pop(timestamp, None)
+         else:
+            source, size, mtime = sources[timestamp]
+            upsert(index, timestamp, source, size, mtime, row)
+
+      ### Save the index and regenerate the .csv (and any columnar exports) from it
+      with runlog.measure('write'):
+         held.check()
+         save_index(index, indexfile)
+         export_csv(index, csvfile)
+         for path in args.export:
+            try:
+               export_columnar(index, path)
+            except ImportError as e:
+               print('Could not write ' + path + ': ' + str(e))
+
+      ### One vectorized pass over the ping times of the whole cruise, instead of a plot per file
+      if not args.no_report:
+         with runlog.measure('ping_report'):
+            report(basedir, cruisename)
 
+   print("Summarized %d of %d files" % (len(jobs), len(sources)))
+   runlog.finish()
 
 
 
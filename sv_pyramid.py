@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+"""
+Command line tool for building a cruise-wide, multi-resolution Sv pyramid from the *_Sv.nc files.
+
+The pyramid is a Zarr store at [cruise]/[cruise]_Sv_pyramid.zarr with one group per frequency and one sub-group
+per level:
+   18000/0/Sv         -- (ping_time, range_bin) Sv in dB, every ping of the cruise at full resolution
+   18000/0/ping_time  -- int64 ns
+   18000/1/...        -- pairs of pings and pairs of range bins averaged (in the linear domain), i.e. 2x coarser
+   ...
+Arrays are chunked along ping_time and compressed, and the metadata is consolidated, so a window of any length can
+be read from whichever level has about as many pings as there are pixels to fill (see read_window).
+
+Files are streamed a chunk of pings at a time, so memory does not grow with the cruise. The size and mtime of each
+file added, and the length of every level after it, are kept in the root attributes. A rerun appends the Sv files
+added since the last run; if a file already in the pyramid has changed (recalibrated under the same name) or gone,
+or a new file sorts before some already in it, the levels are cut back to where they stood before that file and
+everything from there on is added again. A file with more range bins than the pyramid widens every level (the
+extra bins of earlier pings read as NaN). A run that dies partway through a file leaves the pyramid as it was after
+the last file it finished, and the next run carries on from there.
+
+Needs zarr 2 (zarr.open_group and consolidate_metadata as they are there).
+
+example: python sv_pyramid.py /media/paulr/ncei_data/shimada/ sh1707
+
+"""
+
+
+import os
+import argparse
+from glob import glob
+import numpy as np
+import xarray as xr
+import zarr
+import runlog
+
+PING_CHUNK = 4096
+
+
+def pyramid_path(basedir, cruisename):
+   return os.path.join(basedir, cruisename, cruisename + '_Sv_pyramid.zarr')
+
+
+def pair_mean(x, axis):
+   ### mean of consecutive pairs along axis, ignoring NaN (an odd last element is averaged on its own)
+   if x.shape[axis] % 2:
+      pad = [(0, 0)] * x.ndim
+      pad[axis] = (0, 1)
+      x = np.pad(x, pad, constant_values=np.nan)
+   shape = list(x.shape)
+   shape[axis:axis + 1] = [shape[axis] // 2, 2]
+   x = x.reshape(shape)
+   valid = np.isfinite(x)
+   counts = valid.sum(axis=axis + 1)
+   sums = np.where(valid, x, 0).sum(axis=axis + 1)
+   with np.errstate(invalid='ignore', divide='ignore'):
+      return np.where(counts > 0, sums / counts, np.nan)
+
+
+def to_db(lin):
+   with np.errstate(divide='ignore', invalid='ignore'):
+      return (10 * np.log10(lin)).astype('float32')
+
+
+class Level:
+   ### arrays for one level of one frequency, plus the (at most one) ping still waiting for a partner
+   def __init__(self, group, nrange, length=None):
+      if 'Sv' in group:
+         self.Sv, self.ping_time = group['Sv'], group['ping_time']
+      else:
+         self.Sv = group.create_dataset('Sv', shape=(0, nrange), chunks=(PING_CHUNK, nrange), dtype='f4', fill_value=np.nan)
+         self.ping_time = group.create_dataset('ping_time', shape=(0,), chunks=(PING_CHUNK,), dtype='i8')
+      ### drop whatever was written after the file the pyramid is being rebuilt from, or that a run that crashed
+      ### wrote after the last file it finished (see build); and widen the level if the files have more range bins
+      if length is None:
+         length = min(self.Sv.shape[0], self.ping_time.shape[0])
+      if self.Sv.shape != (length, max(nrange, self.Sv.shape[1])) or self.ping_time.shape[0] != length:
+         self.Sv.resize(length, max(nrange, self.Sv.shape[1]))
+         self.ping_time.resize(length)
+      self.pending_Sv = np.zeros((0, self.Sv.shape[1]))
+      self.pending_time = np.zeros(0, dtype='int64')
+
+   def __len__(self):
+      return self.ping_time.shape[0]
+
+   def append(self, lin, t):
+      self.Sv.append(to_db(lin), axis=0)
+      self.ping_time.append(t)
+
+   def take_pending(self, lin, t):
+      return np.concatenate([self.pending_Sv, lin]), np.concatenate([self.pending_time, t])
+
+   def set_pending(self, lin, t):
+      self.pending_Sv, self.pending_time = lin, t
+
+
+def push(levels, k, lin, t):
+   ### write linear-domain rows to level k, and pass their pairwise means on to level k+1
+   levels[k].append(lin, t)
+   if k + 1 == len(levels) or not len(t):
+      return
+   lin, t = levels[k].take_pending(lin, t)
+   n2 = len(t) // 2 * 2
+   levels[k].set_pending(lin[n2:], t[n2:])
+   if n2:
+      coarse = pair_mean(pair_mean(lin[:n2], axis=0), axis=1)
+      tc = t[:n2:2] + (t[1:n2:2] - t[:n2:2]) // 2
+      push(levels, k + 1, coarse, tc)
+
+
+def open_levels(root, frequency, nrange, nlevels, lengths=None):
+   ### lengths: the number of pings in each level when the last file was finished, if known
+   group = root.require_group(str(int(frequency)))
+   levels = []
+   for k in range(nlevels):
+      levels.append(Level(group.require_group(str(k)), nrange, None if lengths is None else lengths[k]))
+      nrange = (nrange + 1) // 2
+   ### rows are paired in order, so a level with an odd number of rows left its last one waiting for a partner
+   for k in range(nlevels - 1):
+      if len(levels[k]) % 2:
+         levels[k].set_pending(10 ** (levels[k].Sv[-1:].astype('f8') / 10), levels[k].ping_time[-1:])
+   return levels
+
+
+def plan(done, Sv_files):
+   ### done: {name: {'size', 'mtime', 'lengths'}} from the root attributes. Returns (names kept as they are, files to
+   ### add): everything from the first file that is new, changed or gone onwards is added (again).
+   current = {}
+   for f in Sv_files:
+      st = os.stat(f)
+      current[os.path.basename(f)] = (f, st.st_size, st.st_mtime)
+   order = sorted(set(done) | set(current))
+   for i, name in enumerate(order):
+      entry = done.get(name)
+      if name not in current or entry is None or (entry['size'], entry['mtime']) != current[name][1:]:
+         return order[:i], [current[n] for n in order[i:] if n in current]
+   return order, []
+
+
+def build(basedir, cruisename, nlevels=8, rebuild=False, chunk=PING_CHUNK):
+   ncsdir = os.path.join(basedir, cruisename, 'ek60_nc')
+   Sv_files = sorted(glob(os.path.join(ncsdir, '*_Sv.nc')))
+   path = pyramid_path(basedir, cruisename)
+   root = zarr.open_group(path, mode='w' if rebuild else 'a')
+   done = root.attrs.get('files', {})
+   if isinstance(done, list):
+      print(path + " does not record file sizes and times; building it again")
+      root = zarr.open_group(path, mode='w')
+      done = {}
+   kept, todo = plan(done, Sv_files)
+   if not todo and len(kept) == len(done):
+      print("Pyramid is up to date")
+      return
+
+   ### every level needs a fixed number of range bins, so pad to the longest file, widening the levels if need be
+   nrange = root.attrs.get('nrange', 0)
+   for f, size, mtime in todo:
+      with xr.open_dataset(f) as ds:
+         nrange = max(nrange, ds.sizes['range_bin'])
+   root.attrs['nlevels'] = root.attrs.get('nlevels', nlevels)
+
+   ### Each finished file is committed by one write of the root attributes: the files in the pyramid, each with the
+   ### length of every level after it. Anything written past the lengths after the last file kept (by a run that
+   ### died partway through a file, or before a file that has changed since) is cut off as the levels are opened,
+   ### so the files from there on are added from the start rather than appended twice.
+   nlevels = root.attrs['nlevels']
+   done = {name: done[name] for name in kept}
+   committed = done[kept[-1]]['lengths'] if kept else {}
+   if len(kept) < len(root.attrs.get('files', {})):
+      print("Adding again from " + os.path.basename(todo[0][0]) if todo else "Dropping removed files from the pyramid")
+   frequencies = {}
+   for group in root.group_keys():
+      frequencies[group] = open_levels(root, group, nrange, nlevels, committed.get(group, [0] * nlevels))
+   root.attrs.update({'nrange': nrange, 'files': done})
+
+   for f, size, mtime in todo:
+      print("Adding " + f)
+      with runlog.measure('pyramid', f):
+         with xr.open_dataset(f) as ds:
+            t = ds.ping_time.values.astype('datetime64[ns]').view('int64')
+            for frequency in ds.frequency.values:
+               if str(int(frequency)) not in frequencies:
+                  frequencies[str(int(frequency))] = open_levels(root, frequency, nrange, nlevels, [0] * nlevels)
+               levels = frequencies[str(int(frequency))]
+               sv = ds.Sv.sel(frequency=frequency).transpose('ping_time', 'range_bin')
+               for i in range(0, len(t), chunk):
+                  block = sv.isel(ping_time=slice(i, i + chunk)).values
+                  lin = np.full((block.shape[0], nrange), np.nan)
+                  lin[:, :block.shape[1]] = 10 ** (block / 10)
+                  push(levels, 0, lin, t[i:i + chunk])
+      done[os.path.basename(f)] = {'size': size, 'mtime': mtime,
+                                   'lengths': {group: [len(level) for level in levels] for group, levels in frequencies.items()}}
+      root.attrs['files'] = done
+
+   zarr.consolidate_metadata(path)
+
+
+def read_window(path, frequency, start, end, max_pings=2000):
+   ### Sv (ping_time, range_bin) between start and end, from the finest level with at most max_pings pings there
+   root = zarr.open_consolidated(path)
+   group = root[str(int(frequency))]
+   t0 = np.datetime64(start, 'ns').view('int64')
+   t1 = np.datetime64(end, 'ns').view('int64')
+   for k in range(root.attrs['nlevels']):
+      t = group[str(k)]['ping_time'][:]
+      i0, i1 = np.searchsorted(t, [t0, t1])
+      if i1 - i0 <= max_pings or k == root.attrs['nlevels'] - 1:
+         Sv = group[str(k)]['Sv'][i0:i1]
+         return xr.DataArray(Sv, dims=['ping_time', 'range_bin'], coords={'ping_time': t[i0:i1].view('datetime64[ns]')},
+                             name='Sv', attrs={'level': k})
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Build a multi-resolution Sv pyramid for a cruise')
+   parser.add_argument('basedir')
+   parser.add_argument('cruisename')
+   parser.add_argument('--levels', type=int, default=8, help='number of levels, each 2x coarser than the last (default: 8)')
+   parser.add_argument('--rebuild', action='store_true', help='start the pyramid over from scratch')
+   args = parser.parse_args()
+   runlog.start(os.path.join(args.basedir, args.cruisename))
+   build(args.basedir, args.cruisename, args.levels, args.rebuild)
+   runlog.finish()
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+"""
+Command line tool for generating a synthetic cruise of converted EK60 files, for benchmarking without real data.
+
+Files are written to [cruise]/ek60_nc/ as [cruise]-DYYYYMMDD-THHMMSS.nc in the layout the rest of the scripts
+read from raw2nc(): a root group plus Environment, Platform, Sonar, Provenance and Beam groups, with backscatter_r
+(frequency x ping_time x range_bin) at 18, 38 and 120 kHz. The data are shaped like a survey rather than random:
+   - files back to back through each day, with a short dropout in some files and deliberate gaps between others
+   - a GPS track working north along the West Coast in transects, one fix per ping
+   - noise, a scattering layer that migrates with the time of day, and a seabed echo
+   - a change of pulse length and sample interval part way through the cruise (as if the settings were changed
+     at sea, which is what makes raw2nc() start a new file)
+The rest of the directory structure (see raw2netCDF.py) is created alongside, empty.
+
+example: python synthetic_ek60.py /tmp/bench/ synth --days 3 --files-per-day 10 --pings 2000 --range-bins 1000
+
+"""
+
+
+import os
+import argparse
+import numpy as np
+import xarray as xr
+
+FREQUENCIES = [18000.0, 38000.0, 120000.0]
+START = np.datetime64('2017-07-20T00:00:00', 'ns')
+
+
+def track(t, ndays):
+   ### lat/lon at times t (ns): northward from Point Conception over the cruise, zigzagging offshore and back
+   frac = (t - START).astype('float64') / (ndays * 86400e9)
+   lat = 34.5 + 13.5 * frac
+   lon = -124.0 - 0.5 * np.abs(np.sin(frac * ndays * 4 * np.pi)) + 1.5 * frac
+   return lat, lon
+
+
+def backscatter(rng, t, nrange, sample_range, frequency):
+   ### (ping_time, range_bin) float32 power in dB: noise + a migrating layer + the seabed
+   hours = (t - t.astype('datetime64[D]')).astype('float64') / 3600e9
+   r = np.arange(nrange) * sample_range
+   rmax = nrange * sample_range
+   layer = rmax * (0.45 - 0.25 * np.cos(hours * 2 * np.pi / 24))     # shallower at night
+   bottom = rmax * (0.8 + 0.05 * np.sin(hours / 3))
+   power = rng.normal(-150 + 20 * np.log10(np.maximum(r, 1)), 3, size=(len(t), nrange)).astype('float32')
+   power += (40 * np.exp(-((r[None, :] - layer[:, None]) / (rmax / 25)) ** 2)).astype('float32')
+   power[np.abs(r[None, :] - bottom[:, None]) < 5 * sample_range] = -20 - 10 * np.log10(frequency / 18000)
+   return power
+
+
+def write_file(path, rng, t, ndays, nrange, pulse_length, sample_interval):
+   sound_speed = 1480.0
+   nf = len(FREQUENCIES)
+   lat, lon = track(t, ndays)
+   root = xr.Dataset(attrs={'Conventions': 'CF-1.7, SONAR-netCDF4, ACDD-1.3', 'keywords': 'EK60',
+                            'sonar_convention_name': 'SONAR-netCDF4', 'summary': 'synthetic', 'title': os.path.basename(path)})
+   env = xr.Dataset({'absorption_indicative': ('frequency', [0.0027, 0.0098, 0.0268]),
+                     'sound_speed_indicative': ('frequency', [sound_speed] * nf)},
+                    coords={'frequency': FREQUENCIES})
+   platform = xr.Dataset({'latitude': ('location_time', lat), 'longitude': ('location_time', lon)},
+                         coords={'location_time': t}, attrs={'platform_name': 'Shimada', 'platform_type': 'Research vessel'})
+   sonar = xr.Dataset(attrs={'sonar_manufacturer': 'Simrad', 'sonar_model': 'EK60', 'sonar_software_version': '2.4.3'})
+   provenance = xr.Dataset(attrs={'conversion_software_name': 'synthetic_ek60.py', 'src_filenames': os.path.basename(path)})
+   beam = xr.Dataset(
+      {'backscatter_r': (('frequency', 'ping_time', 'range_bin'),
+                         np.stack([backscatter(rng, t, nrange, sample_interval * sound_speed / 2, f) for f in FREQUENCIES])),
+       'channel_id': ('frequency', ['GPT %3d kHz 00907205' % (f / 1000) for f in FREQUENCIES]),
+       'equivalent_beam_angle': ('frequency', [-17.3, -20.6, -20.9]),
+       'gain_correction': ('frequency', [22.95, 26.5, 26.5]),
+       'sa_correction': ('frequency', [-0.7, -0.49, -0.38]),
+       'beamwidth_receive_major': ('frequency', [10.7, 7.1, 7.0]),
+       'beamwidth_receive_minor': ('frequency', [10.7, 7.1, 7.0]),
+       'sample_interval': ('frequency', [sample_interval] * nf),
+       'transmit_duration_nominal': ('frequency', [pulse_length] * nf),
+       'transmit_power': ('frequency', [2000.0, 2000.0, 250.0])},
+      coords={'frequency': FREQUENCIES, 'ping_time': t, 'range_bin': np.arange(nrange)},
+      attrs={'beam_mode': 'vertical', 'conversion_equation_t': 'type_3'})
+
+   tmpfile = path + '.tmp'
+   root.to_netcdf(tmpfile, mode='w')
+   for group, ds in [('Environment', env), ('Platform', platform), ('Sonar', sonar), ('Provenance', provenance), ('Beam', beam)]:
+      ds.to_netcdf(tmpfile, mode='a', group=group)
+   os.replace(tmpfile, path)
+
+
+def make_cruise(basedir, cruisename, days=1, files_per_day=4, pings=1000, nrange=500, seed=0):
+   ### Returns the list of files written
+   cruisedir = os.path.join(basedir, cruisename)
+   for subdir in ['ek60_raw', 'echogram', 'ek60_convert_error', 'ek60_nc', 'ping_interval', 'ship_track_01day', 'ship_track_10day']:
+      os.makedirs(os.path.join(cruisedir, subdir), exist_ok=True)
+   rng = np.random.default_rng(seed)
+   interval = np.timedelta64(86400 * 10 ** 9 // (files_per_day * pings), 'ns')
+   files = []
+   nfiles = days * files_per_day
+   for k in range(nfiles):
+      t = START + (k * pings + np.arange(pings)) * interval
+      if k % 7 == 3:
+         ### a dropout: five pings missing half way through the file
+         t = np.delete(t, np.arange(pings // 2, pings // 2 + 5))
+      if k % 5 == 4:
+         ### a gap before this file: it starts a fifth of the way in
+         t = t[pings // 5:]
+      changed = k >= nfiles // 2
+      path = os.path.join(cruisedir, 'ek60_nc', cruisename + '-D' + str(t[0].astype('datetime64[D]')).replace('-', '') + '-T' +
+                          str(t[0].astype('datetime64[s]'))[11:].replace(':', '') + '.nc')
+      write_file(path, rng, t, days, nrange, 0.000512 if changed else 0.001024, 0.000128 if changed else 0.000256)
+      files.append(path)
+   return files
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Write a synthetic cruise of converted EK60 files')
+   parser.add_argument('basedir')
+   parser.add_argument('cruisename')
+   parser.add_argument('--days', type=int, default=1)
+   parser.add_argument('--files-per-day', type=int, default=4)
+   parser.add_argument('--pings', type=int, default=1000, help='pings per file (default: 1000)')
+   parser.add_argument('--range-bins', type=int, default=500, help='samples per ping (default: 500)')
+   parser.add_argument('--seed', type=int, default=0)
+   args = parser.parse_args()
+   files = make_cruise(args.basedir, args.cruisename, args.days, args.files_per_day, args.pings, args.range_bins, args.seed)
+   print("Wrote %d files, %.1f MB" % (len(files), sum(os.path.getsize(f) for f in files) / 2 ** 20))
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+The chunked calibration gives the same Sv as echopype's ModelEK60.calibrate(), and cleans up after a failed write.
+
+run with: python -m pytest -q
+"""
+
+
+import os
+import numpy as np
+import pytest
+
+xr = pytest.importorskip('xarray')
+pytest.importorskip('netCDF4')
+ek60 = pytest.importorskip('echopype.model.ek60')
+import synthetic_ek60
+import calibrate_hake
+
+
+@pytest.mark.parametrize('ping_chunk', [64, 1000])
+def test_chunked_matches_model_ek60(tmp_path, ping_chunk):
+   ### one 250-ping file from each half of a synthetic cruise (the settings change half way), so chunks of 64 pings
+   ### include a short last one
+   files = synthetic_ek60.make_cruise(str(tmp_path), 'synth', days=1, files_per_day=2, pings=250, nrange=120, seed=1)
+   for nc_file in files:
+      model = ek60.ModelEK60(nc_file)
+      model.calibrate(save=False)
+      expected = model.Sv['Sv'] if hasattr(model.Sv, 'data_vars') else model.Sv
+
+      calibrate_hake.calibrate_chunked(nc_file, ping_chunk)
+      assert os.path.exists(calibrate_hake.sv_path(nc_file))
+      with xr.open_dataset(calibrate_hake.sv_path(nc_file)) as ds:
+         Sv = ds.Sv.transpose('frequency', 'ping_time', 'range_bin')
+         np.testing.assert_array_equal(ds.ping_time.values, expected.ping_time.values)
+         np.testing.assert_allclose(Sv.values, expected.transpose('frequency', 'ping_time', 'range_bin').values, rtol=1e-6, atol=1e-6)
+         np.testing.assert_allclose(ds['range'].values, model.range.transpose('frequency', 'range_bin').values)
+
+
+def test_failed_write_leaves_no_temporary_file(tmp_path):
+   nc_file = synthetic_ek60.make_cruise(str(tmp_path), 'synth', days=1, files_per_day=1, pings=50, nrange=20)[0]
+
+   class Failing:
+      ### stands in for a lease check that fails after the Sv has been written
+      def check(self):
+         raise OSError('No space left on device')
+
+   with pytest.raises(OSError):
+      calibrate_hake.calibrate_chunked(nc_file, 16, held=Failing())
+   assert os.listdir(os.path.dirname(nc_file)) == [os.path.basename(nc_file)]
@@ -0,0 +1,37 @@
+"""
+Track decimation keeps the shape of the track.
+
+run with: python -m pytest -q
+"""
+
+
+import numpy as np
+from decimate import douglas_peucker, decimate_track
+
+
+def test_out_and_back_keeps_turnaround():
+   ### 0 -> 10 and back to 5 along one line: the far end is off the segment between the end points, not off the line
+   x = np.r_[np.arange(0, 11), np.arange(9, 4, -1)].astype('float64')
+   y = np.zeros(len(x))
+   lon, lat = decimate_track(x, y, 0.1)
+   assert list(lon) == [0, 10, 5]
+   assert list(lat) == [0, 0, 0]
+
+
+def test_loop_back_to_start_keeps_far_point():
+   x = np.array([0.0, 1, 2, 3, 2, 1, 0])
+   y = np.zeros(len(x))
+   assert list(douglas_peucker(x, y, 0.1)) == [0, 3, 6]
+
+
+def test_straight_track_reduced_to_ends():
+   x = np.linspace(0, 1, 1000)
+   lon, lat = decimate_track(x, 2 * x, 1e-3)
+   assert list(lon) == [0, 1] and list(lat) == [0, 2]
+
+
+def test_nan_fixes_kept_as_breaks():
+   x = np.array([0.0, 1, 2, np.nan, 3, 4, 5])
+   lon, lat = decimate_track(x, np.zeros(len(x)), 0.1)
+   assert np.isnan(lon).sum() == 1
+   np.testing.assert_array_equal(lon[np.isfinite(lon)], [0, 2, 3, 5])
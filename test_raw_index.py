@@ -0,0 +1,69 @@
+"""
+Round trip of a hand-packed .raw file through raw_index.index_file().
+
+run with: python -m pytest -q
+"""
+
+
+import struct
+import numpy as np
+import raw_index
+
+
+def datagram(kind, t_ns, body):
+   nt = t_ns // 100 + raw_index.NT_EPOCH
+   payload = kind.encode('ascii') + struct.pack('<LL', nt & 0xFFFFFFFF, nt >> 32) + body
+   return struct.pack('<l', len(payload)) + payload + struct.pack('<l', len(payload))
+
+
+def config(channel_id, frequency, gain, beam_angle):
+   header = struct.pack('<128s128s128s30s98sl', b'survey', b'transect', b'ER60', b'2.4.3', b'', 1)
+   channel = struct.pack('<128slfff', channel_id.encode('ascii'), 1, frequency, gain, beam_angle)
+   return header + channel.ljust(raw_index.CONFIG_CHANNEL_SIZE, b'\0')
+
+
+def sample(channel, frequency, power, pulse_length, sample_interval, count):
+   ### channel, mode, transducer depth, frequency, transmit power, pulse length, bandwidth, sample interval, sound
+   ### velocity, absorption, heave, roll, pitch, temperature, trawl upper depth/opening valid, trawl upper
+   ### depth/opening, offset, count -- then count power samples
+   header = struct.pack('<hh12fhh2f2l', channel, 3, 5.0, frequency, power, pulse_length, 2425.0, sample_interval,
+                        1470.0, 0.01, 0.0, 0.0, 0.0, 10.0, 0, 0, 0.0, 0.0, 0, count)
+   assert len(header) == 72
+   return header + np.arange(count, dtype='<i2').tobytes()
+
+
+def test_index_file_round_trip(tmp_path):
+   t0 = np.datetime64('2017-07-20T01:02:03', 'ns').view('int64')
+   rawfile = tmp_path / 'sh1701-D20170720-T010203.raw'
+   rawfile.write_bytes(datagram('CON0', t0, config('GPT  38 kHz 009072033fa5 1 ES38B', 38000.0, 26.5, -20.7)) +
+                       datagram('NME0', t0 + 10 ** 9, b'$GPGGA,010204,4430.00,N,12415.00,W,1,08,0.9,5.0,M,,,,*47\r\n') +
+                       datagram('RAW0', t0 + 2 * 10 ** 9, sample(1, 38000.0, 2000.0, 0.001024, 0.000256, 1000)) +
+                       datagram('RAW0', t0 + 3 * 10 ** 9, sample(1, 38000.0, 1000.0, 0.001024, 0.000256, 1200)))
+
+   idx = raw_index.index_file(str(rawfile))
+
+   assert list(idx['type']) == ['CON0', 'NME0', 'RAW0', 'RAW0']
+   assert list(idx['ping_time']) == [t0 + 2 * 10 ** 9, t0 + 3 * 10 ** 9]
+   assert list(idx['channel']) == [1, 1]
+   assert list(idx['count']) == [1000, 1200]
+   np.testing.assert_allclose(idx['frequency'], [38000.0, 38000.0])
+   np.testing.assert_allclose(idx['transmit_power'], [2000.0, 1000.0])
+   np.testing.assert_allclose(idx['pulse_length'], [0.001024, 0.001024])
+   np.testing.assert_allclose(idx['sample_interval'], [0.000256, 0.000256])
+   np.testing.assert_allclose(idx['lat'], [44.5])
+   np.testing.assert_allclose(idx['lon'], [-124.25])
+   assert list(idx['channel_id']) == ['GPT  38 kHz 009072033fa5 1 ES38B']
+   np.testing.assert_allclose(idx['gain'], [26.5])
+   assert raw_index.parameter_changes(idx) == [(t0 + 3 * 10 ** 9, 1, 'transmit_power', 2000.0, 1000.0)]
+
+
+def test_index_file_stops_at_truncated_datagram(tmp_path):
+   t0 = np.datetime64('2017-07-20T01:02:03', 'ns').view('int64')
+   whole = datagram('RAW0', t0, sample(2, 120000.0, 250.0, 0.001024, 0.000256, 500))
+   rawfile = tmp_path / 'sh1701-D20170720-T010203.raw'
+   rawfile.write_bytes(whole + whole[:-100])
+
+   idx = raw_index.index_file(str(rawfile))
+
+   assert list(idx['count']) == [500]
+   assert list(idx['channel']) == [2]
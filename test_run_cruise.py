@@ -0,0 +1,44 @@
+"""
+The pipeline driver reruns only the daily plots whose own inputs changed.
+
+run with: python -m pytest -q
+"""
+
+
+import os
+import time
+import run_cruise
+
+
+def touch(path, mtime):
+   with open(path, 'w') as f:
+      f.write(path)
+   os.utime(path, (mtime, mtime))
+
+
+def test_only_the_changed_day_is_stale(tmp_path):
+   cruisedir = str(tmp_path / 'sh1701')
+   ncsdir = os.path.join(cruisedir, 'ek60_nc')
+   os.makedirs(ncsdir)
+   os.makedirs(run_cruise.stampdir(cruisedir))
+   days = ['D20170720', 'D20170721']
+   t0 = time.time() - 1000
+   for day in days:
+      touch(os.path.join(ncsdir, 'sh1701-' + day + '-T000000.nc'), t0)
+      touch(os.path.join(ncsdir, 'sh1701-' + day + '-T000000_Sv.nc'), t0)
+   inputs = lambda day: [os.path.join(ncsdir, name) for name in sorted(os.listdir(ncsdir)) if day in name]
+   t = run_cruise.batch_task('echogram', ['plot_hake_daily.py', cruisedir], [(day, lambda day=day: inputs(day)) for day in days],
+                             ['--only', 'echogram'], ['calibrate'])
+
+   ### every day plotted once
+   cmd, stamps = run_cruise.stale_runs(cruisedir, t)
+   assert sorted(stamps) == ['echogram:' + day for day in days]
+   assert run_cruise.run_task(cruisedir, dict(t, cmd=['true']), ['true'], stamps)
+   assert run_cruise.stale_runs(cruisedir, t) is None
+
+   ### one day recalibrated: calibrate's stamp is renewed, but only that day is replotted
+   touch(os.path.join(ncsdir, 'sh1701-D20170721-T000000_Sv.nc'), t0 + 10)
+   touch(run_cruise.stamp_path(cruisedir, 'calibrate'), time.time() + 10)
+   cmd, stamps = run_cruise.stale_runs(cruisedir, t)
+   assert list(stamps) == ['echogram:D20170721']
+   assert cmd[-3:] == ['D20170721', '--only', 'echogram']
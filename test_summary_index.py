@@ -0,0 +1,28 @@
+"""
+The columnar export of the summary index keeps error rows as missing values.
+
+run with: python -m pytest -q
+"""
+
+
+import pytest
+
+pd = pytest.importorskip('pandas')
+from summary_index import upsert, to_dataframe
+
+
+def row(name, start, end):
+   return [name, start, end, [1.0, 1.0], [38000.0, 120000.0], [0.000256, 0.000256], [0.001024, 0.001024],
+           [2000.0, 250.0], 1480.0, [0.0098, 0.0268]]
+
+
+def test_error_row_exports_as_missing():
+   index = {}
+   upsert(index, 'sh1701-D20170720-T010000', 'a.nc', 1, 1.0, row('a.nc', '2017-07-20T01:00:00', '2017-07-20T01:59:59'))
+   upsert(index, 'sh1701-D20170720-T020000', 'b-error-log.txt', 1, 1.0, ['b-error-log.txt'] + ['NA'] * 9)
+   upsert(index, 'sh1701-D20170720-T030000', 'c.nc', 1, 1.0, row('c.nc', '2017-07-20T03:00:00', '2017-07-20T03:59:59'))
+   df = to_dataframe(index)
+   error = df.loc['sh1701-D20170720-T020000']
+   assert error['File_name'] == 'b-error-log.txt'
+   assert error.drop('File_name').isna().all()
+   assert df.loc['sh1701-D20170720-T030000', 'Start_ping_time'] == pd.Timestamp('2017-07-20T03:00:00')
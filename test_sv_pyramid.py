@@ -0,0 +1,139 @@
+"""
+Building the Sv pyramid from several files, incrementally, after files change or arrive out of order, and after a
+run that died partway through a file.
+
+run with: python -m pytest -q
+"""
+
+
+import os
+import numpy as np
+import pytest
+
+xr = pytest.importorskip('xarray')
+zarr = pytest.importorskip('zarr')
+pytest.importorskip('netCDF4')
+import sv_pyramid
+
+NLEVELS = 3
+
+
+def write_Sv(ncsdir, stem, start, npings, nrange, seed):
+   ### a small _Sv.nc laid out like calibrate_hake.py's: Sv on (frequency, ping_time, range_bin)
+   rng = np.random.default_rng(seed)
+   Sv = rng.uniform(-90, -40, (2, npings, nrange))
+   Sv[:, ::5, -1] = np.nan
+   ping_time = np.datetime64(start, 'ns') + np.arange(npings) * np.timedelta64(1, 's')
+   ds = xr.Dataset({'Sv': (('frequency', 'ping_time', 'range_bin'), Sv)},
+                   coords={'frequency': [38000.0, 120000.0], 'ping_time': ping_time, 'range_bin': np.arange(nrange)})
+   ds.to_netcdf(os.path.join(ncsdir, stem + '_Sv.nc'))
+
+
+def make_cruise(basedir, files, nrange=9, seeds=None):
+   ncsdir = os.path.join(basedir, 'sh1701', 'ek60_nc')
+   os.makedirs(ncsdir, exist_ok=True)
+   for k, (stem, start, npings) in enumerate(files):
+      write_Sv(ncsdir, stem, start, npings, nrange if np.ndim(nrange) == 0 else nrange[k], k if seeds is None else seeds[k])
+   return basedir
+
+
+def levels(basedir):
+   root = zarr.open_group(sv_pyramid.pyramid_path(basedir, 'sh1701'), mode='r')
+   return {(f, k): (root[f][str(k)]['ping_time'][:], root[f][str(k)]['Sv'][:]) for f in ['38000', '120000'] for k in range(NLEVELS)}
+
+
+def assert_same(a, b):
+   assert a.keys() == b.keys()
+   for key in a:
+      np.testing.assert_array_equal(a[key][0], b[key][0])
+      np.testing.assert_allclose(a[key][1], b[key][1], rtol=1e-5)
+
+
+FILES = [('sh1701-D20170720-T010000', '2017-07-20T01:00:00', 7),
+         ('sh1701-D20170720-T020000', '2017-07-20T02:00:00', 5),
+         ('sh1701-D20170720-T030000', '2017-07-20T03:00:00', 6)]
+
+
+@pytest.fixture
+def whole(tmp_path):
+   ### the pyramid built from all the files in one run
+   basedir = make_cruise(str(tmp_path / 'whole'), FILES)
+   sv_pyramid.build(basedir, 'sh1701', NLEVELS, chunk=2)
+   return levels(basedir)
+
+
+def test_build_in_one_run(whole):
+   t, Sv = whole[('38000', 0)]
+   assert len(t) == 18 and Sv.shape == (18, 9)
+   assert len(whole[('38000', 1)][0]) == 9
+   assert len(whole[('38000', 2)][0]) == 4
+   assert whole[('120000', 2)][1].shape == (4, 3)
+
+
+def test_rerun_adds_only_new_files(tmp_path, whole):
+   basedir = make_cruise(str(tmp_path / 'steps'), FILES[:2])
+   sv_pyramid.build(basedir, 'sh1701', NLEVELS, chunk=2)
+   sv_pyramid.build(basedir, 'sh1701', NLEVELS, chunk=2)
+   assert len(levels(basedir)[('38000', 0)][0]) == 12
+
+   make_cruise(basedir, FILES)
+   sv_pyramid.build(basedir, 'sh1701', NLEVELS, chunk=2)
+   sv_pyramid.build(basedir, 'sh1701', NLEVELS, chunk=2)
+   assert_same(levels(basedir), whole)
+
+
+def test_rerun_after_crash_partway_through_a_file(tmp_path, monkeypatch, whole):
+   basedir = make_cruise(str(tmp_path / 'crash'), FILES)
+   push = sv_pyramid.push
+
+   def dying_push(levels, k, lin, t):
+      ### the second file's second chunk never arrives
+      if t[0] == np.datetime64('2017-07-20T02:00:02', 'ns').view('int64'):
+         raise RuntimeError('killed')
+      push(levels, k, lin, t)
+
+   monkeypatch.setattr(sv_pyramid, 'push', dying_push)
+   with pytest.raises(RuntimeError):
+      sv_pyramid.build(basedir, 'sh1701', NLEVELS, chunk=2)
+   monkeypatch.setattr(sv_pyramid, 'push', push)
+
+   root = zarr.open_group(sv_pyramid.pyramid_path(basedir, 'sh1701'), mode='r')
+   assert list(root.attrs['files']) == ['sh1701-D20170720-T010000_Sv.nc']
+   assert root['38000']['0']['ping_time'].shape[0] > 7
+
+   sv_pyramid.build(basedir, 'sh1701', NLEVELS, chunk=2)
+   assert_same(levels(basedir), whole)
+
+
+def test_rerun_adds_a_file_that_sorts_before_others(tmp_path, whole):
+   basedir = make_cruise(str(tmp_path / 'late'), FILES[::2], seeds=[0, 2])
+   sv_pyramid.build(basedir, 'sh1701', NLEVELS, chunk=2)
+   write_Sv(os.path.join(basedir, 'sh1701', 'ek60_nc'), FILES[1][0], FILES[1][1], FILES[1][2], 9, 1)
+   sv_pyramid.build(basedir, 'sh1701', NLEVELS, chunk=2)
+   assert_same(levels(basedir), whole)
+
+
+def test_rerun_redoes_a_changed_file(tmp_path):
+   basedir = make_cruise(str(tmp_path / 'changed'), FILES)
+   sv_pyramid.build(basedir, 'sh1701', NLEVELS, chunk=2)
+   ### recalibrated under the same name: same pings, different Sv
+   write_Sv(os.path.join(basedir, 'sh1701', 'ek60_nc'), FILES[1][0], FILES[1][1], FILES[1][2], 9, 7)
+   path = os.path.join(basedir, 'sh1701', 'ek60_nc', FILES[1][0] + '_Sv.nc')
+   os.utime(path, (os.path.getatime(path), os.path.getmtime(path) + 10))
+   sv_pyramid.build(basedir, 'sh1701', NLEVELS, chunk=2)
+
+   fresh = make_cruise(str(tmp_path / 'fresh'), FILES, seeds=[0, 7, 2])
+   sv_pyramid.build(fresh, 'sh1701', NLEVELS, chunk=2)
+   assert_same(levels(basedir), levels(fresh))
+
+
+def test_rerun_widens_for_a_file_with_more_range_bins(tmp_path):
+   basedir = make_cruise(str(tmp_path / 'wider'), FILES[:2])
+   sv_pyramid.build(basedir, 'sh1701', NLEVELS, chunk=2)
+   write_Sv(os.path.join(basedir, 'sh1701', 'ek60_nc'), FILES[2][0], FILES[2][1], FILES[2][2], 12, 2)
+   sv_pyramid.build(basedir, 'sh1701', NLEVELS, chunk=2)
+
+   fresh = make_cruise(str(tmp_path / 'fresh'), FILES, nrange=[9, 9, 12])
+   sv_pyramid.build(fresh, 'sh1701', NLEVELS, chunk=2)
+   assert levels(basedir)[('38000', 0)][1].shape == (18, 12)
+   assert_same(levels(basedir), levels(fresh))
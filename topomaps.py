@@ -25,24 +25,27 @@ def make_map(extent, figsize=(12, 12), projection=ccrs.PlateCarree()):
     return fig, ax
 
 
-def add_etopo2(extent, ax, levels=None):
-    import iris
-    url = (
-        "http://gamone.whoi.edu/thredds/dodsC/usgs/data0/bathy/ETOPO2v2c_f4.nc"
-    )
-    cube = iris.load_cube(url)
-    lon = iris.Constraint(x=lambda cell: extent[0] <= cell <= extent[1])
-    lat = iris.Constraint(y=lambda cell: extent[2] <= cell <= extent[3])
-    cube = cube.extract(lon & lat)
-    lons = cube.coord("x").points
-    lats = cube.coord("y").points
+def add_etopo2(extent, ax, levels=None, cachedir=None):
+    import bathy_cache
+    if bathy_cache.is_populated(cachedir):
+        # Local tiled copy (see bathy_cache.py); no network access.
+        lons, lats, data = bathy_cache.subset(extent, cachedir)
+    else:
+        import iris
+        cube = iris.load_cube(bathy_cache.ETOPO2_URL)
+        lon = iris.Constraint(x=lambda cell: extent[0] <= cell <= extent[1])
+        lat = iris.Constraint(y=lambda cell: extent[2] <= cell <= extent[3])
+        cube = cube.extract(lon & lat)
+        lons = cube.coord("x").points
+        lats = cube.coord("y").points
+        data = cube.data
     if not levels:
         levels = sorted(
             set(
                 np.r_[
-                    np.linspace(cube.data.min(), -500, 5),  # bathy
+                    np.linspace(np.nanmin(data), -500, 5),  # bathy
                     [-400, -145, -10],  # coast
-                    np.linspace(100, cube.data.max(), 5),  # topo
+                    np.linspace(100, np.nanmax(data), 5),  # topo
                 ].astype(int)
             )
         )
@@ -50,7 +53,7 @@ def add_etopo2(extent, ax, levels=None):
     ax.contourf(
         lons,
         lats,
-        cube.data,
+        data,
         levels=levels,
         colors=LAND_GREY,
         zorder=0,
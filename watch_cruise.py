@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+"""
+Command line tool for keeping a cruise's echograms and ship tracks up to date while the survey is running.
+
+Polls ek60_raw every --interval seconds. A .raw file counts as complete once a later .raw file has appeared (the
+sounder closes one file before starting the next) or nothing has been written to it for --settle seconds. Each
+complete file that is not in the conversion manifest yet is then, all in this one long-running process:
+   indexed     -- ping times, positions and channel config straight from the .raw (see raw_index.py), printed
+                  with any parameter changes, and drawn as the day's quick-look track,
+                  ship_track_01day/[cruise]-DYYYYMMDD-quicklook.png, ahead of conversion
+   converted   -- as raw2netCDF.py would, and recorded in the same manifest
+   summarized  -- upserted into the summary index and [cruise]_summary.csv, as survey_hake.py would
+   calibrated  -- to _Sv.nc, --ping-chunk pings at a time (see calibrate_hake.py)
+   added to the navigation store and the catalog (see navstore.py and catalog.py)
+and only the echogram and ship track plots of the 10-file chunks the new files fall in are redrawn (see
+plot_hake_daily.py). Earlier files are never reprocessed. After each pass the time from each new file's last write
+to its updated plots is printed (and recorded in the run log, see runlog.py, as stage 'latency'), which is at most
+about --interval plus the processing time.
+
+The cruise-wide products (ping timing report, 10-day tracks) are left for a batch run of run_cruise.py. Don't run
+raw2netCDF.py against the same cruise while this is watching it; both write the conversion manifest.
+
+example: python watch_cruise.py /media/paulr/ncei_data/shimada/ sh1707 --interval 30
+example: python watch_cruise.py /media/paulr/ncei_data/shimada/ sh1707 --once    (a single pass, e.g. from cron)
+
+"""
+
+
+import os
+import time
+import argparse
+from glob import glob
+import echopype
+from hake_utils import log_error, file_day
+from raw2netCDF import convert_file, plan_conversions, remove_outputs
+from conversion_manifest import manifest_path, load_manifest, save_manifest, scan_raw, make_entry
+from survey_hake import summarize
+from summary_index import index_path, load_index, save_index, upsert, export_csv
+from calibrate_hake import calibrate_files, PING_CHUNK
+import navstore
+import catalog
+import raw_index
+import plot_hake_daily
+import render_pool
+import runlog
+
+
+def complete_files(raws, settle, now=None):
+   ### raws is scan_raw()'s {name: (path, size, mtime)}; keep the files the sounder has finished writing
+   now = time.time() if now is None else now
+   names = sorted(raws)
+   return {name: raws[name] for k, name in enumerate(names) if k < len(names) - 1 or now - raws[name][2] >= settle}
+
+
+def process(basedir, cruisename, settle=60.0, ping_chunk=PING_CHUNK):
+   ### One pass: bring every newly completed .raw file all the way through to its plots.
+   ### Returns [(raw path, mtime)] for the files handled.
+   cruisedir = os.path.join(basedir, cruisename)
+   rawdir = os.path.join(cruisedir, 'ek60_raw')
+   ncsdir = os.path.join(cruisedir, 'ek60_nc')
+   errsdir = os.path.join(cruisedir, 'ek60_convert_error')
+   plotsdir = os.path.join(cruisedir, 'ping_interval')
+
+   manifest_file = manifest_path(basedir, cruisename)
+   manifest = load_manifest(manifest_file)
+   todo = plan_conversions(manifest, complete_files(scan_raw(rawdir), settle), set(os.listdir(ncsdir)))
+   save_manifest(manifest, manifest_file)
+   if not todo:
+      return []
+
+   ### index the new files first (a few seconds) and report them, and redraw each day's quick-look track from the
+   ### index of all its .raw files, so positions and parameter changes show up before the minutes of conversion
+   with runlog.measure('raw_index'):
+      raw_index.update(cruisedir, [path for name, path, size, mtime, sha1 in todo])
+      for name, path, size, mtime, sha1 in todo:
+         if os.path.exists(raw_index.index_path(cruisedir, path)):
+            raw_index.report(path, raw_index.load(cruisedir, path))
+   for day in sorted(set(filter(None, (file_day(path) for name, path, size, mtime, sha1 in todo)))):
+      pngname = os.path.join(cruisedir, 'ship_track_01day', cruisename + '-' + day + '-quicklook.png')
+      with runlog.measure('quicklook', pngname) as m:
+         try:
+            rawfiles = sorted(glob(os.path.join(rawdir, '*' + day + '*raw')))
+            raw_index.update(cruisedir, rawfiles)
+            raw_index.plot_track([raw_index.load(cruisedir, f) for f in rawfiles if os.path.exists(raw_index.index_path(cruisedir, f))], pngname)
+         except Exception as e:
+            print('An error occurred: ' + str(e))
+            m['ok'], m['error'] = False, str(e)
+
+   ### convert
+   version = getattr(echopype, '__version__', 'unknown')
+   new_ncs, sources = [], {}
+   for name, path, size, mtime, sha1 in todo:
+      print("Converting " + path)
+      ### a .raw file that changed since it was last converted leaves its old outputs and plots behind
+      remove_outputs(ncsdir, manifest.get(name))
+      outputs, ok = convert_file(path, ncsdir, errsdir)
+      manifest[name] = make_entry(path, size, mtime, sha1, outputs, version, 'converted' if ok else 'error')
+      save_manifest(manifest, manifest_file)
+      new_ncs += outputs
+      if ok:
+         for nc in outputs:
+            sources[os.path.basename(nc).split('.')[0]] = nc
+      else:
+         filebase = os.path.splitext(name)[0]
+         sources[filebase] = os.path.join(errsdir, filebase + '-error-log.txt')
+
+   ### summarize
+   indexfile = index_path(basedir, cruisename)
+   index = load_index(indexfile)
+   for timestamp in sorted(sources):
+      timestamp, row = summarize((timestamp, sources[timestamp], errsdir, plotsdir))
+      if row is not None:
+         st = os.stat(sources[timestamp])
+         upsert(index, timestamp, sources[timestamp], st.st_size, st.st_mtime, row)
+   with runlog.measure('write'):
+      save_index(index, indexfile)
+      export_csv(index, os.path.join(cruisedir, cruisename + '_summary.csv'))
+
+   ### calibrate, update navigation and the catalog, then redraw the affected plots of each day touched
+   calibrate_files(new_ncs, errsdir, ping_chunk=ping_chunk)
+   with runlog.measure('navigation'):
+      navstore.update(cruisedir, new_ncs)
+      cat = catalog.load(cruisedir)
+   jobs = []
+   for day in sorted(set(filter(None, map(file_day, new_ncs)))):
+      jobs += plot_hake_daily.echogram_jobs(cruisedir, day, changed=new_ncs)
+      jobs += plot_hake_daily.track_jobs(cruisedir, day, cat, changed=new_ncs)
+   render_pool.run(jobs)
+
+   return [(path, mtime) for name, path, size, mtime, sha1 in todo]
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Process .raw files as they arrive and keep the daily plots current')
+   parser.add_argument('basedir')
+   parser.add_argument('cruisename')
+   parser.add_argument('--interval', type=float, default=30.0, help='seconds between polls of ek60_raw (default: 30)')
+   parser.add_argument('--settle', type=float, default=60.0, help='treat the newest .raw file as complete once unchanged for this many seconds (default: 60)')
+   parser.add_argument('--ping-chunk', type=int, default=PING_CHUNK, help='pings per calibration chunk (default: %d)' % PING_CHUNK)
+   parser.add_argument('--once', action='store_true', help='make a single pass and exit')
+   args = parser.parse_args()
+
+   errsdir = os.path.join(args.basedir, args.cruisename, 'ek60_convert_error')
+   runlog.start(os.path.join(args.basedir, args.cruisename))
+   with runlog.measure('imports'):
+      plot_hake_daily.load_plotting()
+   print("Watching " + os.path.join(args.basedir, args.cruisename, 'ek60_raw'))
+   try:
+      while True:
+         t0 = time.time()
+         try:
+            handled = process(args.basedir, args.cruisename, args.settle, args.ping_chunk)
+         except Exception as e:
+            ### keep watching; one bad pass shouldn't stop the quick-look plots for the rest of the survey
+            print('An error occurred: ' + str(e))
+            log_error(os.path.join(errsdir, 'watch-errors.txt'), "Watch pass failed")
+            handled = []
+         done = time.time()
+         for path, mtime in handled:
+            print("Updated plots for " + os.path.basename(path) + " %.0f s after it was last written" % (done - mtime))
+            runlog.record('latency', path, wall_s=done - mtime)
+         if args.once:
+            break
+         time.sleep(max(0, args.interval - (done - t0)))
+   except KeyboardInterrupt:
+      pass
+   finally:
+      runlog.finish()
+
+
+
+if __name__ == '__main__':
+    main()